@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+import re
 import sys
 
 import pip
 from setuptools import find_packages, setup
 
-_SISUA_VERSION = '0.4.5'
+# the version is only defined in `sisua/__init__.py`
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sisua',
+                       '__init__.py'), 'r') as f:
+  _SISUA_VERSION = re.search(r"^__version__ = ['\"]([^'\"]+)['\"]", f.read(),
+                             re.M).group(1)
 
 if not (sys.version_info.major == 3 and sys.version_info.minor == 7):
   raise RuntimeError("Sorry, we only support Python=3.7!")
@@ -1,9 +1,37 @@
-from sisua.analysis import Posterior
+__version__ = '0.4.5'
+
+import importlib
+
 from sisua.data import (MARKER_ADT_GENE, MARKER_ADTS, MARKER_ATAC, MARKER_GENES,
                         OMIC, PROTEIN_PAIR_NEGATIVE, PROTEIN_PAIR_POSITIVE,
                         get_dataset, get_dataset_meta)
-from sisua.data.single_cell_dataset import SingleCellOMIC
-from sisua.data.utils import standardize_protein_name
-from sisua.models import (MISA, SCALE, SCVI, SISUA, VAE, DeepCountAutoencoder,
-                          NetConf, RVmeta, SingleCellModel)
-from sisua.train import SisuaExperimenter
+
+# PEP 562: the heavy (TensorFlow) modules are only imported at the first
+# access of their attributes, so data-only users never import TensorFlow.
+_LAZY_ATTRIBUTES = {
+    'Posterior': 'sisua.analysis',
+    'SingleCellOMIC': 'sisua.data.single_cell_dataset',
+    'standardize_protein_name': 'sisua.data.utils',
+    'MISA': 'sisua.models',
+    'SCALE': 'sisua.models',
+    'SCVI': 'sisua.models',
+    'SISUA': 'sisua.models',
+    'VAE': 'sisua.models',
+    'DeepCountAutoencoder': 'sisua.models',
+    'NetConf': 'sisua.models',
+    'RVmeta': 'sisua.models',
+    'SingleCellModel': 'sisua.models',
+    'SisuaExperimenter': 'sisua.train',
+}
+
+
+def __getattr__(name):
+  if name in _LAZY_ATTRIBUTES:
+    attr = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = attr
+    return attr
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+  return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
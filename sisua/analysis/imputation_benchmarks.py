@@ -6,6 +6,7 @@ import numpy as np
 import pandas as pd
 import seaborn
 from matplotlib import pyplot as plt
+from scipy import sparse
 from scipy.stats import kde
 from six import string_types
 from sklearn.neighbors import KernelDensity
@@ -16,7 +17,8 @@ from odin.utils import as_tuple, cache_memory, catch_warnings_ignore
 from odin.visual import plot_figure, to_axis
 from sisua.data import get_dataset
 from sisua.data.const import MARKER_ADT_GENE
-from sisua.data.utils import standardize_protein_name
+from sisua.data.correlation import paired_correlation
+from sisua.data.utils import build_var_indices, standardize_protein_name
 
 
 # ===========================================================================
@@ -31,13 +33,21 @@ def get_imputed_indices(x_org, x_imp):
   return np.array(ids)
 
 
-def correlation_scores(X, y, gene_name, protein_name, return_series=False):
+def correlation_scores(X,
+                       y,
+                       gene_name,
+                       protein_name,
+                       return_series=False,
+                       gene_indices=None):
   r""" Spearman and Pearson correlation scores
 
   Arguments:
     return_series : bool
         if True, return the gene and protein series, instead of
         calculating spearman, or pearson correlation scores
+    gene_indices : dict (optional)
+        precomputed `build_var_indices(gene_name, suffix=True)`, e.g.
+        `SingleCellOMIC.get_var_indices(suffix=True)` which is cached.
 
   Returns:
     `correlation_scores` or `correlation_series`
@@ -46,8 +56,6 @@ def correlation_scores(X, y, gene_name, protein_name, return_series=False):
     correlation_series : dict(protein_name/gene_name=(gene_series, prot_series))
 
   """
-  from scipy.stats import pearsonr, spearmanr
-
   gene_name = np.asarray(gene_name).ravel().tolist()
   protein_name = np.asarray(protein_name).ravel().tolist()
 
@@ -60,31 +68,39 @@ def correlation_scores(X, y, gene_name, protein_name, return_series=False):
 
   # pre-processing protein name
   protein_name = [standardize_protein_name(i) for i in protein_name]
+  if gene_indices is None:
+    gene_indices = build_var_indices(gene_name, suffix=True)
+  prot_indices = {}
+  for i, name in enumerate(protein_name):
+    prot_indices.setdefault(name, i)
   # mapping from protein index to gene index
   prot2gene = {}
   for prot, gene in MARKER_ADT_GENE.items():
-    if prot in protein_name:
-      index = [i for i, name in enumerate(gene_name) if gene == name]
-      if len(index) == 0:  # still not found anything
-        index = [
-            i for i, name in enumerate(gene_name) if gene == name.split('_')[-1]
-        ]
-      if len(index) == 1:  # found
-        prot2gene[protein_name.index(prot)] = index[0]
-      elif len(index) >= 2:
+    if prot in prot_indices and gene in gene_indices:
+      index = gene_indices[gene]
+      if index < 0:
         raise RuntimeError("Found multiple gene index with the same name")
+      prot2gene[prot_indices[prot]] = index
 
   # get the series and calculating scores
   scores = {}
   series = {}
   if len(prot2gene) > 0:
-    for prot, gene in prot2gene.items():
-      x_ = X[:, gene]
-      y_ = y[:, prot]
+    prots, genes = zip(*prot2gene.items())
+    if not return_series:
+      if not sparse.issparse(X):
+        X = np.asarray(X)
+      if not sparse.issparse(y):
+        y = np.asarray(y)
+      spearman, pearson = paired_correlation(X[:, list(genes)],
+                                             y[:, list(prots)],
+                                             method=('spearman', 'pearson'))
+    for i, (prot, gene) in enumerate(zip(prots, genes)):
       name = protein_name[prot] + '/' + gene_name[gene]
-      series[name] = (x_, y_)
-      if not return_series:
-        scores[name] = (spearmanr(x_, y_).correlation, pearsonr(x_, y_)[0])
+      if return_series:
+        series[name] = (X[:, gene], y[:, prot])
+      else:
+        scores[name] = (spearman[i], pearson[i])
 
   if return_series:
     series = OrderedDict(
@@ -99,32 +115,152 @@ def correlation_scores(X, y, gene_name, protein_name, return_series=False):
 # ===========================================================================
 # Metrics
 # ===========================================================================
+def _dense_rows(x) -> np.ndarray:
+  if sparse.issparse(x):
+    x = x.toarray()
+  x = np.asarray(x)
+  if not np.issubdtype(x.dtype, np.floating):
+    x = x.astype(np.float32)
+  return x
+
+
+class ImputationScorer(object):
+  r""" Accumulate the imputation scores from row blocks of the original,
+  corrupted and imputed matrices, so the scores are computed in a single
+  vectorized pass without holding the whole matrices.
+
+  The scores (smaller is better) are:
+    - 'imputation_med' : median of the absolute distances between all the
+      original and imputed values.
+    - 'imputation_mean' : mean of the per-cell medians of the absolute
+      distances, only for the corrupted cells.
+    - 'imputation_std' : standard deviation of the per-cell medians.
+
+  Arguments:
+    max_distances : an Integer or None. If None (default), all distances are
+      kept (i.e. the exact median). Otherwise, maximum number of distances
+      kept for the median, when exceeded, a uniform random subsample of this
+      size is kept and the median is estimated from it (e.g. `2**22` for
+      large datasets), if 0, no median is computed.
+    seed : an Integer, random seed for subsampling the distances.
+
+  Example:
+  ```
+  scorer = ImputationScorer()
+  for s, e in batching(batch_size=1024, n=X_org.shape[0]):
+    scorer.update(X_org[s:e], X_crr[s:e], X_imp[s:e])
+  scores = scorer.result()
+  ```
+  """
+
+  def __init__(self, max_distances=None, seed=1):
+    self.max_distances = None if max_distances is None else int(max_distances)
+    self._rand = np.random.RandomState(seed)
+    # distances and their random keys, the subsample is the distances with
+    # the smallest keys (i.e. bottom-k sampling)
+    self._distances = []
+    self._keys = []
+    self._n_buffered = 0
+    # running statistics of the per-cell medians
+    self._n_cells = 0
+    self._mean = 0.
+    self._m2 = 0.
+
+  def _compact(self):
+    distances = np.concatenate(self._distances)
+    keys = np.concatenate(self._keys)
+    if len(keys) > self.max_distances:
+      ids = np.argpartition(keys, self.max_distances - 1)[:self.max_distances]
+      distances = distances[ids]
+      keys = keys[ids]
+    self._distances = [distances]
+    self._keys = [keys]
+    self._n_buffered = len(keys)
+
+  def update(self, original, corrupted, imputed) -> 'ImputationScorer':
+    r""" Add a block of cells, `original` and `corrupted` could be
+    `scipy.sparse.spmatrix`, `imputed` could be memory-mapped """
+    original = _dense_rows(original)
+    corrupted = _dense_rows(corrupted)
+    imputed = _dense_rows(imputed)
+    assert original.shape == corrupted.shape == imputed.shape, \
+      (f"Shape mismatch original:{original.shape} corrupted:{corrupted.shape}"
+       f" imputed:{imputed.shape}")
+    d = np.abs(original - imputed)
+    # per-cell medians of the corrupted cells (Chan's parallel update)
+    is_corrupted = np.sum(original, axis=1) != np.sum(corrupted, axis=1)
+    if np.any(is_corrupted):
+      medians = np.median(d[is_corrupted], axis=1).astype(np.float64)
+      n = len(medians)
+      mean = np.mean(medians)
+      m2 = np.sum((medians - mean)**2)
+      total = self._n_cells + n
+      delta = mean - self._mean
+      self._mean += delta * n / total
+      self._m2 += m2 + delta**2 * self._n_cells * n / total
+      self._n_cells = total
+    # distances for the median
+    if self.max_distances is None:
+      self._distances.append(d.ravel())
+    elif self.max_distances > 0 and d.size > 0:
+      self._distances.append(d.ravel())
+      self._keys.append(self._rand.rand(d.size).astype(np.float32))
+      self._n_buffered += d.size
+      if self._n_buffered > 2 * self.max_distances:
+        self._compact()
+    return self
+
+  def result(self) -> dict:
+    if self.max_distances is not None and len(self._keys) > 0:
+      self._compact()
+    if len(self._distances) > 0:
+      med = float(np.median(np.concatenate(self._distances)))
+    else:
+      med = np.nan
+    n = self._n_cells
+    return {
+        'imputation_med': med,
+        'imputation_mean': self._mean if n > 0 else 0,
+        'imputation_std': np.sqrt(self._m2 / n) if n > 0 else 0,
+    }
+
+
+def imputation_scores(original,
+                      corrupted,
+                      imputed,
+                      batch_size=4096,
+                      max_distances=None,
+                      seed=1) -> dict:
+  r""" All imputation scores computed by `ImputationScorer` in a single pass
+  over blocks of `batch_size` cells, the median is exact unless
+  `max_distances` is given """
+  assert original.shape == corrupted.shape == imputed.shape
+  scorer = ImputationScorer(max_distances=max_distances, seed=seed)
+  for s in range(0, original.shape[0], batch_size):
+    e = s + batch_size
+    scorer.update(original[s:e], corrupted[s:e], imputed[s:e])
+  return scorer.result()
+
+
 def imputation_score(original, imputed):
   """ Median of medians for all distances """
   assert original.shape == imputed.shape
-  nonzeros = np.nonzero(original)
-  d = np.abs(original - imputed)  # [nonzeros]
-  return float(np.median(d))
+  return imputation_scores(original, original, imputed,
+                           max_distances=None)['imputation_med']
 
 
 def imputation_mean_score(original, corrupted, imputed):
   """ Mean of medians for each cell imputation score """
   assert original.shape == corrupted.shape == imputed.shape
-  imputation_cells = []
-  for cell_org, cell_crt, cell_imp in zip(original, corrupted, imputed):
-    if np.sum(cell_org) != np.sum(cell_crt):
-      imputation_cells.append(np.median(np.abs(cell_org - cell_imp)))
-  return np.mean(imputation_cells) if len(imputation_cells) > 0 else 0
+  return imputation_scores(original, corrupted, imputed,
+                           max_distances=0)['imputation_mean']
 
 
 def imputation_std_score(original, corrupted, imputed):
   # Standard deviation of medians for each cell imputation score
   assert original.shape == corrupted.shape == imputed.shape
-  imputation_cells = []
-  for cell_org, cell_crt, cell_imp in zip(original, corrupted, imputed):
-    if np.sum(cell_org) != np.sum(cell_crt):
-      imputation_cells.append(np.median(np.abs(cell_org - cell_imp)))
-  return np.std(imputation_cells) if len(imputation_cells) > 0 else 0
+  return imputation_scores(original, corrupted, imputed,
+                           max_distances=0)['imputation_std']
 
 
 # ===========================================================================
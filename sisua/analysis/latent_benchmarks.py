@@ -1,15 +1,18 @@
 from __future__ import absolute_import, division, print_function
 
 import itertools
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 
 import numpy as np
 import scipy as sp
 from matplotlib import gridspec
 from matplotlib import pyplot as plt
-from sklearn.cluster import KMeans
+from scipy.optimize import linear_sum_assignment
+from scipy.stats import norm
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.metrics import (adjusted_mutual_info_score, adjusted_rand_score,
-                             normalized_mutual_info_score, silhouette_score)
+                             normalized_mutual_info_score, silhouette_samples,
+                             silhouette_score)
 from sklearn.mixture import GaussianMixture
 from sklearn.multiclass import OneVsRestClassifier
 from sklearn.svm import SVC
@@ -50,23 +53,69 @@ def unsupervised_clustering_accuracy(y, y_pred):
   Unsupervised Clustering Accuracy
   Author: scVI
   https://github.com/YosefLab/scVI/blob/a585f7d096f04ab0d50cadfdf8c2c9f78d907c19/scvi/inference/posterior.py#L637
+
+  Return:
+    accuracy, and the matching `[n_clusters, 2]` of (predicted, true) indices
   """
-  # from scipy.optimize import linear_sum_assignment
-  from sklearn.utils.linear_assignment_ import linear_assignment
+  y = np.asarray(y).ravel()
+  y_pred = np.asarray(y_pred).ravel()
   assert len(y_pred) == len(y)
-  u = np.unique(np.concatenate((y, y_pred)))
+  u, ids = np.unique(np.concatenate((y, y_pred)), return_inverse=True)
   n_clusters = len(u)
-  mapping = dict(zip(u, range(n_clusters)))
-  reward_matrix = np.zeros((n_clusters, n_clusters), dtype=np.int64)
-  for y_pred_, y_ in zip(y_pred, y):
-    if y_ in mapping:
-      reward_matrix[mapping[y_pred_], mapping[y_]] += 1
-  cost_matrix = reward_matrix.max() - reward_matrix
-  ind = linear_assignment(cost_matrix)
-  return sum([reward_matrix[i, j] for i, j in ind]) * 1.0 / y_pred.size, ind
-
-
-def clustering_scores(latent, labels, n_labels, prediction_algorithm='both'):
+  ids_true, ids_pred = ids[:len(y)], ids[len(y):]
+  reward_matrix = np.bincount(ids_pred * n_clusters + ids_true,
+                              minlength=n_clusters**2).reshape(
+                                  n_clusters, n_clusters)
+  rows, cols = linear_sum_assignment(reward_matrix, maximize=True)
+  ind = np.stack([rows, cols], axis=1)
+  return reward_matrix[rows, cols].sum() * 1.0 / y_pred.size, ind
+
+
+def sampled_silhouette_score(latent,
+                             labels,
+                             n_samples=2000,
+                             ci=0.95,
+                             random_state=5218):
+  r""" Silhouette score estimated from a random subsample of `n_samples`
+  points (the pairwise distances is `O(n_samples^2)` instead of
+  `O(n^2)`), with the normal-approximation confidence interval of the mean
+  silhouette.
+
+  Return:
+    score, (low, high)
+  """
+  labels = np.asarray(labels).ravel()
+  rand = np.random.RandomState(random_state)
+  if n_samples is not None and n_samples < len(labels):
+    ids = rand.choice(len(labels), size=int(n_samples), replace=False)
+    latent = latent[ids]
+    labels = labels[ids]
+  s = silhouette_samples(latent, labels)
+  score = float(np.mean(s))
+  half_width = norm.ppf(0.5 + ci / 2) * np.std(s) / np.sqrt(len(s))
+  return score, (score - half_width, score + half_width)
+
+
+_EXECUTOR = None
+
+
+def _get_executor():
+  global _EXECUTOR
+  if _EXECUTOR is None:
+    from concurrent.futures import ThreadPoolExecutor
+    _EXECUTOR = ThreadPoolExecutor(max_workers=1)
+  return _EXECUTOR
+
+
+def clustering_scores(latent,
+                      labels,
+                      n_labels,
+                      prediction_algorithm='both',
+                      n_init=None,
+                      mini_batch=False,
+                      silhouette_size=None,
+                      random_state=5218,
+                      asynchronous=False):
   """ Clustering Scores:
 
    * silhouette_score (higher is better, best is 1, worst is -1)
@@ -80,7 +129,26 @@ def clustering_scores(latent, labels, n_labels, prediction_algorithm='both'):
   ----------
   labels : categorical labels (i.e. single classes or one-hot encoded)
   prediction_algorithm : {'knn', 'gmm', 'both'}
+  n_init : number of k-means initializations, by default, 200 for `KMeans`
+    and 3 for `MiniBatchKMeans`
+  mini_batch : if True, use `MiniBatchKMeans` for the 'knn' algorithm
+  silhouette_size : if given, the silhouette score is estimated from
+    this number of sampled points, and 'ASW_ci' (half-width of the 95%
+    confidence interval) is returned as well
+  asynchronous : if True, the scores are computed in a background thread,
+    and a `concurrent.futures.Future` of the dictionary is returned
   """
+  if asynchronous:
+    return _get_executor().submit(clustering_scores,
+                                  latent=latent,
+                                  labels=labels,
+                                  n_labels=n_labels,
+                                  prediction_algorithm=prediction_algorithm,
+                                  n_init=n_init,
+                                  mini_batch=mini_batch,
+                                  silhouette_size=silhouette_size,
+                                  random_state=random_state,
+                                  asynchronous=False)
   # simple normalization to 0-1, then pick the argmax
   if labels.ndim == 2:
     min_val = np.min(labels, axis=0, keepdims=True)
@@ -88,33 +156,47 @@ def clustering_scores(latent, labels, n_labels, prediction_algorithm='both'):
     labels = (labels - min_val) / (max_val - min_val)
     labels = np.argmax(labels, axis=-1)
 
-  if prediction_algorithm == 'knn':
-    km = KMeans(n_labels, n_init=200, random_state=5218)
-    labels_pred = km.fit_predict(latent)
-  elif prediction_algorithm == 'gmm':
-    gmm = GaussianMixture(n_labels, random_state=5218)
-    gmm.fit(latent)
-    labels_pred = gmm.predict(latent)
-  elif prediction_algorithm == 'both':
-    score1 = clustering_scores(latent,
-                               labels,
-                               n_labels=n_labels,
-                               prediction_algorithm='knn')
-    score2 = clustering_scores(latent,
-                               labels,
-                               n_labels=n_labels,
-                               prediction_algorithm='gmm')
-    return {k: (v + score2[k]) / 2 for k, v in score1.items()}
+  if prediction_algorithm == 'both':
+    algorithms = ('knn', 'gmm')
+  elif prediction_algorithm in ('knn', 'gmm'):
+    algorithms = (prediction_algorithm,)
   else:
     raise ValueError("Not support for prediction_algorithm: '%s'" %
                      prediction_algorithm)
   #
+  scores = defaultdict(list)
   with catch_warnings_ignore(FutureWarning):
-    asw_score = silhouette_score(latent, labels)
-    ari_score = adjusted_rand_score(labels, labels_pred)
-    nmi_score = normalized_mutual_info_score(labels, labels_pred)
-    uca_score = unsupervised_clustering_accuracy(labels, labels_pred)[0]
-  return dict(ASW=asw_score, ARI=ari_score, NMI=nmi_score, UCA=uca_score)
+    for algo in algorithms:
+      if algo == 'knn':
+        if mini_batch:
+          km = MiniBatchKMeans(n_labels,
+                               n_init=3 if n_init is None else n_init,
+                               random_state=random_state)
+        else:
+          km = KMeans(n_labels,
+                      n_init=200 if n_init is None else n_init,
+                      random_state=random_state)
+        labels_pred = km.fit_predict(latent)
+      else:
+        gmm = GaussianMixture(n_labels, random_state=random_state)
+        gmm.fit(latent)
+        labels_pred = gmm.predict(latent)
+      scores['ARI'].append(adjusted_rand_score(labels, labels_pred))
+      scores['NMI'].append(normalized_mutual_info_score(labels, labels_pred))
+      scores['UCA'].append(
+          unsupervised_clustering_accuracy(labels, labels_pred)[0])
+    # the silhouette only depends on the true labels
+    if silhouette_size is None:
+      asw_score = silhouette_score(latent, labels)
+    else:
+      asw_score, (low, _) = sampled_silhouette_score(
+          latent,
+          labels,
+          n_samples=silhouette_size,
+          random_state=random_state)
+      scores['ASW_ci'] = asw_score - low
+  scores = {k: np.mean(v) for k, v in scores.items()}
+  return dict(ASW=asw_score, **scores)
 
 
 # ===========================================================================
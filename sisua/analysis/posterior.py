@@ -16,7 +16,7 @@ import pandas as pd
 import seaborn as sns
 import tensorflow as tf
 from matplotlib import pyplot as plt
-from scipy.stats import pearsonr, spearmanr
+from scipy import sparse
 from six import string_types
 from sklearn.feature_selection import (mutual_info_classif,
                                        mutual_info_regression)
@@ -27,7 +27,7 @@ from sklearn.preprocessing import StandardScaler
 from odin import visual as vs
 from odin.backend import log_norm
 from odin.bay import distributions as tfd
-from odin.bay import vi
+from odin.bay import concat_distributions, vi
 from odin.bay.vi import Criticizer, discretizing
 from odin.fuel import Dataset
 from odin.stats import is_binary, is_discrete
@@ -36,10 +36,9 @@ from odin.utils import (MPI, as_tuple, cache_memory, catch_warnings_ignore,
 from odin.visual import (Visualizer, plot_aspect, plot_confusion_matrix,
                          plot_figure, plot_frame, plot_save, plot_scatter,
                          to_axis2D)
-from sisua.analysis.imputation_benchmarks import (correlation_scores,
-                                                  imputation_mean_score,
-                                                  imputation_score,
-                                                  imputation_std_score)
+from sisua.analysis.imputation_benchmarks import (ImputationScorer,
+                                                  correlation_scores,
+                                                  imputation_scores)
 from sisua.analysis.latent_benchmarks import (clustering_scores,
                                               plot_distance_heatmap,
                                               plot_latents_binary,
@@ -49,6 +48,7 @@ from sisua.data import (MARKER_ADT_GENE, MARKER_ADTS, MARKER_ATAC, MARKER_GENES,
                         OMIC, PROTEIN_PAIR_NEGATIVE, PROTEIN_PAIR_POSITIVE,
                         SingleCellOMIC, apply_artificial_corruption,
                         get_dataset)
+from sisua.data.correlation import correlation_matrix
 from sisua.data.path import EXP_DIR
 
 
@@ -62,6 +62,74 @@ def _iter_2list(l1, l2):
       yield i, j
 
 
+def _to_imputed(o: tfd.Distribution) -> tfd.Distribution:
+  r""" Remove the zero-inflation (i.e. the dropout) from the output
+  distribution """
+  is_independent = 0
+  if isinstance(o, tfd.Independent):
+    is_independent = o.reinterpreted_batch_ndims
+    o = o.distribution
+  if isinstance(o, tfd.ZeroInflated):
+    o = o.count_distribution
+  if is_independent > 0:
+    o = tfd.Independent(o, reinterpreted_batch_ndims=is_independent)
+  return o
+
+
+def _dense(x) -> np.ndarray:
+  if sparse.issparse(x):
+    x = x.toarray()
+  return np.asarray(x, dtype=np.float32)
+
+
+def _sample_mean(o: tfd.Distribution) -> np.ndarray:
+  r""" Mean of the distribution averaged over the MCMC samples """
+  x = o.mean().numpy()
+  if x.ndim == 3:
+    x = np.mean(x, axis=0)
+  return x
+
+
+def _sample_llk(o: tfd.Distribution, x: np.ndarray) -> float:
+  r""" Sum over the cells of the log-likelihood marginalized over the MCMC
+  samples (i.e. the same reduction as `Posterior.cal_llk`) """
+  llk = o.log_prob(x)
+  if llk.shape.ndims == 1:
+    llk = tf.expand_dims(llk, axis=0)
+  n_samples = tf.cast(tf.shape(llk)[0], llk.dtype)
+  llk = tf.reduce_logsumexp(llk, axis=0) - tf.math.log(n_samples)
+  return float(tf.reduce_sum(llk).numpy())
+
+
+def _streaming_median(iter_blocks, count, max_value, n_bins=4096) -> float:
+  r""" Exact median of `count` non-negative values given by `iter_blocks()`,
+  the first pass counts the values in `n_bins` bins within `[0, max_value]`,
+  the second pass only keeps the values in the bin(s) of the median. """
+  if count == 0:
+    return np.nan
+  if max_value <= 0:
+    return 0.
+  to_bin = lambda x: np.minimum((x / max_value * n_bins).astype(np.int64),
+                                n_bins - 1)
+  hist = np.zeros(shape=(n_bins,), dtype=np.int64)
+  for x in iter_blocks():
+    hist += np.bincount(to_bin(x), minlength=n_bins)
+  cumsum = np.cumsum(hist)
+  ranks = sorted(set([(count - 1) // 2, count // 2]))
+  bins = [int(np.searchsorted(cumsum, k, side='right')) for k in ranks]
+  selected = {b: [] for b in bins}
+  for x in iter_blocks():
+    ids = to_bin(x)
+    for b in selected:
+      selected[b].append(x[ids == b])
+  values = []
+  for k, b in zip(ranks, bins):
+    x = np.concatenate(selected[b])
+    k = k - (cumsum[b - 1] if b > 0 else 0)
+    values.append(np.partition(x, k)[k])
+  return float(np.mean(values))
+
+
 # ===========================================================================
 # The Posterior
 # ===========================================================================
@@ -74,6 +142,20 @@ class Posterior(Visualizer):
     protein : a `numpy.ndarray` with shape `[n_samples, n_protein]`
     batch_size : an Integer, batch size for the prediction tasks.
     sample_shape : an Integer, number of MCMC samples for evaluation
+    streaming : a Boolean. If True, the predictions are reduced batch by
+      batch, only the (imputed and reconstructed) means, the latent
+      distributions and the accumulated statistics for log-likelihoods and
+      imputation scores are kept, instead of all the output distributions
+      with `[sample_shape, n_cells, n_features]` parameters. In this mode,
+      the 'imputed' and 'reconstructed' data are arrays of the means.
+    spill_dir : a String (optional). If given, the means are stored in
+      memory-mapped `.npy` files in this folder instead of memory
+      (only for `streaming=True`).
+    max_distances : an Integer (optional). If None, the median for the
+      imputation scores is exact, in streaming mode, it takes two extra
+      passes over the stored imputed means. Otherwise, the median is
+      estimated from a random subsample of `max_distances` distances (see
+      `sisua.analysis.imputation_benchmarks.ImputationScorer`).
     verbose : a Boolean, turn on verbose
 
   Example:
@@ -115,6 +197,9 @@ class Posterior(Visualizer):
                sample_shape=10,
                random_state=1,
                reduce_latents=partial(tf.concat, axis=1),
+               streaming=False,
+               spill_dir=None,
+               max_distances=None,
                name=None,
                verbose=True):
     super(Posterior, self).__init__()
@@ -124,6 +209,13 @@ class Posterior(Visualizer):
     self.verbose = int(verbose)
     self.sample_shape = int(sample_shape)
     self.batch_size = int(batch_size)
+    self.streaming = bool(streaming)
+    self.spill_dir = spill_dir
+    self.max_distances = max_distances
+    # accumulated statistics for streaming mode
+    self._llk = dict()
+    self._imputation_scorers = dict()
+    self._imputation_stats = dict()
     self.rand = random_state \
       if isinstance(random_state, np.random.RandomState) else \
         np.random.RandomState(seed=random_state)
@@ -170,6 +262,9 @@ class Posterior(Visualizer):
         self.get_criticizer(factor_omic=factor_omic)
 
   def _initialize(self):
+    if self.streaming:
+      self._initialize_streaming()
+      return
     scm = self.scm
     sco = self.sco_corrupted
     outputs, latents = scm.predict(
@@ -180,7 +275,114 @@ class Posterior(Visualizer):
         sample_shape=self.sample_shape,
         verbose=self.verbose,
     )
-    # infer output OMICs
+    self._infer_output_omics(outputs)
+    # variables' description
+    self._n_latents = len(tf.nest.flatten(latents))
+    self._n_outputs = len(tf.nest.flatten(outputs))
+    ## default inputs
+    for om in self.input_omics:
+      self.omics_data[(om, 'corrupted')] = sco.get_omic(om)
+    # latent is the same for all
+    self.omics_data[(OMIC.latent.name, 'corrupted')] = tf.nest.flatten(latents)
+    # infer if the distribution is imputed
+    for l, o in zip(scm.output_layers, tf.nest.flatten(outputs)):
+      self.omics_data[(l.name, 'reconstructed')] = o
+      self.omics_data[(l.name, 'imputed')] = _to_imputed(o)
+    self._create_dataset()
+
+  def _allocate(self, key, shape, dtype=np.float32) -> np.ndarray:
+    if self.spill_dir is None:
+      return np.empty(shape=shape, dtype=dtype)
+    if not os.path.exists(self.spill_dir):
+      os.makedirs(self.spill_dir)
+    path = os.path.join(self.spill_dir, f"{self.name}_{'_'.join(key)}.npy")
+    return np.lib.format.open_memmap(path,
+                                     mode='w+',
+                                     dtype=dtype,
+                                     shape=shape)
+
+  def _initialize_streaming(self):
+    r""" Same as `_initialize` but the output distributions of each batch are
+    reduced to their means and the accumulated statistics right away. """
+    from tqdm import tqdm
+    scm = self.scm
+    sco = self.sco_corrupted
+    n_obs = sco.n_obs
+    org_omics = set(om.name for om in self.sco_original.omics)
+    prog = tqdm(sco.create_dataset(self.scm.output_layers[0].name,
+                                   batch_size=self.batch_size,
+                                   shuffle=0,
+                                   drop_remainder=False),
+                desc="Predicting",
+                disable=not self.verbose)
+    arrays = OrderedDict()
+    latents = []
+    llk = defaultdict(lambda: defaultdict(float))
+    # the exact median is computed afterward from the stored means
+    scorers = defaultdict(lambda: ImputationScorer(
+        max_distances=0 if self.max_distances is None else self.max_distances))
+    imp_stats = defaultdict(lambda: dict(count=0, max=0.))
+    start = 0
+    for data in prog:
+      pX_Z, qZ_X = scm(**data, training=False, sample_shape=self.sample_shape)
+      outputs = tf.nest.flatten(pX_Z)
+      if start == 0:
+        self._infer_output_omics(outputs)
+        self._n_latents = len(tf.nest.flatten(qZ_X))
+        self._n_outputs = len(outputs)
+      end = start + int(tf.nest.flatten(data['inputs'])[0].shape[0])
+      latents.append(tf.nest.flatten(qZ_X))
+      for l, rec in zip(scm.output_layers, outputs):
+        name = l.name
+        imp = _to_imputed(rec)
+        for data_type, o in (('reconstructed', rec), ('imputed', imp)):
+          mean = _sample_mean(o)
+          if (name, data_type) not in arrays:
+            arrays[(name, data_type)] = self._allocate(
+                (name, data_type), shape=(n_obs, mean.shape[1]))
+          arrays[(name, data_type)][start:end] = mean
+        if name not in org_omics:
+          continue
+        x_org = _dense(self.sco_original.get_omic(name)[start:end])
+        x_cor = _dense(self.sco_corrupted.get_omic(name)[start:end])
+        # log-likelihood
+        for (i, o), (j, x) in product((('imp', imp), ('rec', rec)),
+                                      (('org', x_org), ('cor', x_cor))):
+          llk[name][f"llk_{name}_{i}_{j}"] += _sample_llk(o, x)
+        # imputation scores
+        x_imp = arrays[(name, 'imputed')][start:end]
+        scorers[name].update(x_org, x_cor, x_imp)
+        stats = imp_stats[name]
+        stats['count'] += x_imp.size
+        if x_imp.size > 0:
+          stats['max'] = max(stats['max'],
+                             float(np.max(np.abs(x_org - x_imp))))
+      start = end
+    prog.clear()
+    prog.close()
+    assert start == n_obs, \
+      f"Predicted {start} cells but the dataset contains {n_obs} cells"
+    ## store the reduced statistics
+    for om in self.input_omics:
+      self.omics_data[(om, 'corrupted')] = sco.get_omic(om)
+    with tf.device("/CPU:0"):
+      self.omics_data[(OMIC.latent.name, 'corrupted')] = [
+          concat_distributions([z[idx] for z in latents], axis=0)
+          for idx in range(self._n_latents)
+      ]
+    for key, x in arrays.items():
+      if isinstance(x, np.memmap):
+        x.flush()
+      self.omics_data[key] = x
+    self._llk = {
+        name: {k: v / n_obs for k, v in scores.items()}
+        for name, scores in llk.items()
+    }
+    self._imputation_scorers = dict(scorers)
+    self._imputation_stats = dict(imp_stats)
+    self._create_dataset()
+
+  def _infer_output_omics(self, outputs):
     dim2omic = defaultdict(list)
     for om in self.input_omics:
       dim2omic[self.sco_original.get_dim(om)].append(om)
@@ -198,27 +400,9 @@ class Posterior(Visualizer):
           raise RuntimeError(f"Cannot infer OMIC type for output {o}")
         om = oms[0]
       self.output_omics.append(om.name)
-    # variables' description
-    self._n_latents = len(tf.nest.flatten(latents))
-    self._n_outputs = len(tf.nest.flatten(outputs))
-    ## default inputs
-    for om in self.input_omics:
-      self.omics_data[(om, 'corrupted')] = sco.get_omic(om)
-    # latent is the same for all
-    self.omics_data[(OMIC.latent.name, 'corrupted')] = tf.nest.flatten(latents)
-    # infer if the distribution is imputed
-    for l, o in zip(scm.output_layers, tf.nest.flatten(outputs)):
-      self.omics_data[(l.name, 'reconstructed')] = o
-      is_independent = 0
-      if isinstance(o, tfd.Independent):
-        is_independent = o.reinterpreted_batch_ndims
-        o = o.distribution
-      if isinstance(o, tfd.ZeroInflated):
-        o = o.count_distribution
-      if is_independent > 0:
-        o = tfd.Independent(o, reinterpreted_batch_ndims=is_independent)
-      self.omics_data[(l.name, 'imputed')] = o
-    ### create the SingleCellOMIC dataset for analysis
+
+  def _create_dataset(self):
+    r""" create the SingleCellOMIC dataset for analysis """
     sco = self.sco_original.copy()
     for om in self.input_omics:
       if (om, 'imputed') in self.omics_data:
@@ -855,7 +1039,9 @@ class Posterior(Visualizer):
   def get_correlation_matrix(self,
                              omic1,
                              omic2=None,
-                             corr_type='spearman') -> np.ndarray:
+                             corr_type='spearman',
+                             dtype='float64',
+                             max_memory=None) -> np.ndarray:
     r""" Correlation matrix of shape `[ndim_omic1, ndim_omic2]`
 
     Arguments:
@@ -867,59 +1053,80 @@ class Posterior(Visualizer):
         average - average of spearman and pearson correlation
         lasso - L1 regression feature importance
         mi - mutual information
+        A list of types returns a tuple of matrices (in the same order),
+        'spearman', 'pearson' and 'average' share a single pass.
+      dtype : {'float64', 'float32'}, precision for the spearman and pearson
+        correlation.
+      max_memory : a Scalar (in MB), memory budget for the blocked
+        computation of spearman and pearson correlation.
     """
     omic1 = OMIC.parse(omic1)
     omic2 = omic1 if omic2 is None else OMIC.parse(omic2)
     x1 = self.dataset.get_omic(omic1)
-    x2 = self.dataset.get_omic(omic2)
-    corr_type = str(corr_type).lower().strip()
-    ###
-    if corr_type in ('spearman', 'pearson'):
-      fn = (lambda a, b: spearmanr(a, b, nan_policy='omit')[0]) \
-        if corr_type == 'spearman' else \
-          (lambda a, b: pearsonr(a, b)[0])
-      mat = np.empty(shape=(x1.shape[1], x2.shape[1]), dtype=np.float64)
-      for i1, a in enumerate(x1.T):
-        for i2, b in enumerate(x2.T):
-          mat[i1, i2] = fn(a, b)
-    ###
-    elif corr_type == 'lasso':
-      lasso = Lasso(random_state=1, alpha=0.05, max_iter=2000)
-      lasso.fit(x1, x2)
-      # coef_ is [n_target, n_features], so we need transpose here
-      mat = np.transpose(np.absolute(lasso.coef_))
-    ###
-    elif corr_type == 'average':
-      mat = (self.get_correlation_matrix(omic1, omic2, corr_type='spearman') +
-             self.get_correlation_matrix(omic1, omic2, corr_type='pearson')) / 2
-    ###
-    elif corr_type == 'mi':
-      mat = np.empty(shape=(x1.shape[1], x2.shape[1]), dtype=np.float64)
-      discrete_features = [is_discrete(i) for i in x1.T]
-      discrete_targets = [is_discrete(i) for i in x2.T]
-      for i, (discrete, target) in enumerate(zip(discrete_targets, x2.T)):
-        if discrete:
-          y = mutual_info_classif(X=x1,
-                                  y=target,
-                                  discrete_features=discrete_features,
-                                  random_state=1)
-        else:
-          y = mutual_info_regression(X=x1,
-                                     y=target,
-                                     discrete_features=discrete_features,
-                                     random_state=1)
-
-        mat[:, i] = y
-    else:
-      raise ValueError("Support corr_type values are: 'spearman', 'pearson', "
-                       "'lasso', 'average', 'mi'")
-    return mat
+    x2 = x1 if omic2 == omic1 else self.dataset.get_omic(omic2)
+    return_tuple = not isinstance(corr_type, string_types)
+    corr_types = [str(i).lower().strip() for i in as_tuple(corr_type)]
+    ### spearman and pearson from one shared pass
+    methods = set()
+    for corr_type in corr_types:
+      if corr_type in ('spearman', 'pearson'):
+        methods.add(corr_type)
+      elif corr_type == 'average':
+        methods |= {'spearman', 'pearson'}
+    methods = tuple(sorted(methods))
+    linear = dict(
+        zip(
+            methods,
+            correlation_matrix(x1,
+                               x2,
+                               method=methods,
+                               dtype=dtype,
+                               max_memory=max_memory))) if methods else {}
+    all_mat = []
+    for corr_type in corr_types:
+      ###
+      if corr_type in ('spearman', 'pearson'):
+        mat = linear[corr_type]
+      ###
+      elif corr_type == 'lasso':
+        lasso = Lasso(random_state=1, alpha=0.05, max_iter=2000)
+        lasso.fit(x1, x2)
+        # coef_ is [n_target, n_features], so we need transpose here
+        mat = np.transpose(np.absolute(lasso.coef_))
+      ###
+      elif corr_type == 'average':
+        mat = (linear['spearman'] + linear['pearson']) / 2
+      ###
+      elif corr_type == 'mi':
+        mat = np.empty(shape=(x1.shape[1], x2.shape[1]), dtype=np.float64)
+        discrete_features = [is_discrete(i) for i in x1.T]
+        discrete_targets = [is_discrete(i) for i in x2.T]
+        for i, (discrete, target) in enumerate(zip(discrete_targets, x2.T)):
+          if discrete:
+            y = mutual_info_classif(X=x1,
+                                    y=target,
+                                    discrete_features=discrete_features,
+                                    random_state=1)
+          else:
+            y = mutual_info_regression(X=x1,
+                                       y=target,
+                                       discrete_features=discrete_features,
+                                       random_state=1)
+
+          mat[:, i] = y
+      else:
+        raise ValueError("Support corr_type values are: 'spearman', "
+                         "'pearson', 'lasso', 'average', 'mi'")
+      all_mat.append(mat)
+    return tuple(all_mat) if return_tuple else all_mat[0]
 
   @cache_memory
   def cal_llk(self, omic='transcriptomic'):
     r""" Log-likelihood of a given OMIC type """
     omic = OMIC.parse(omic)
     name = omic.name
+    if self.streaming:
+      return dict(self._llk[name])
     x_org = self.sco_original.get_omic(omic)
     x_cor = self.sco_corrupted.get_omic(omic)
     y_rec = self.omics_data[(name, 'reconstructed')]
@@ -982,15 +1189,31 @@ class Posterior(Visualizer):
     """
     omic = self.sco_original.omics[0].name
     X_org = self.omics_data[(omic, 'original')]
+    if self.streaming:
+      scores = self._imputation_scorers[omic].result()
+      if self.max_distances is None:
+        scores['imputation_med'] = self._streaming_imputation_median(omic)
+      return scores
     X_crr = self.omics_data[(omic, 'corrupted')]
     imputed = self.omics_data[(omic, 'imputed')].mean().numpy()
     if imputed.ndim > 2:
       imputed = np.mean(imputed, axis=0)
-    return {
-        'imputation_med': imputation_score(X_org, imputed),
-        'imputation_mean': imputation_mean_score(X_org, X_crr, imputed),
-        'imputation_std': imputation_std_score(X_org, X_crr, imputed),
-    }
+    return imputation_scores(X_org,
+                             X_crr,
+                             imputed,
+                             max_distances=self.max_distances)
+
+  def _streaming_imputation_median(self, omic, batch_size=4096):
+    stats = self._imputation_stats[omic]
+    X_org = self.omics_data[(omic, 'original')]
+    imputed = self.omics_data[(omic, 'imputed')]
+
+    def iter_blocks():
+      for s in range(0, X_org.shape[0], batch_size):
+        e = s + batch_size
+        yield np.abs(_dense(X_org[s:e]) - imputed[s:e]).ravel()
+
+    return _streaming_median(iter_blocks, stats['count'], stats['max'])
 
   @cache_memory
   def _matrix_scores(self,
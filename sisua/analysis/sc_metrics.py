@@ -1,7 +1,10 @@
 from __future__ import absolute_import, division, print_function
 
+import threading
+import time
+import warnings
 from abc import ABCMeta, abstractmethod
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from numbers import Number
 from typing import List, Union
 
@@ -15,17 +18,15 @@ from tensorflow_probability.python.distributions import Distribution
 from odin.bay.distributions import ZeroInflated
 from odin.utils import catch_warnings_ignore
 from sisua.analysis.imputation_benchmarks import (correlation_scores,
-                                                  imputation_mean_score,
-                                                  imputation_score,
-                                                  imputation_std_score)
+                                                  imputation_scores)
 from sisua.analysis.latent_benchmarks import clustering_scores
 from sisua.data import SingleCellOMIC
 from sisua.models import SingleCellModel
-from sisua.models.base import _to_sco
 
 __all__ = [
-    'SingleCellMetric', 'NegativeLogLikelihood', 'ImputationError',
-    'CorrelationScores', 'ClusteringScores'
+    'SingleCellMetric', 'SingleCellMetricGroup', 'MetricScheduler',
+    'NegativeLogLikelihood', 'ImputationError', 'CorrelationScores',
+    'ClusteringScores'
 ]
 
 
@@ -54,7 +55,68 @@ def _to_binary(protein):
   return labels
 
 
-_CORRUPTED_INPUTS = {}
+# mapping from the inputs' configuration to the prepared (true, corrupted)
+# inputs, with least-recently-used eviction
+_PREPARED_INPUTS = OrderedDict()
+_MAX_PREPARED_INPUTS = 8
+_PREPARED_LOCK = threading.Lock()
+
+
+def _to_sco(inputs) -> List[SingleCellOMIC]:
+  if not isinstance(inputs, (tuple, list)):
+    inputs = [inputs]
+  return [
+      i if isinstance(i, SingleCellOMIC) else SingleCellOMIC(i)
+      for i in inputs
+  ]
+
+
+def _prepare_inputs(inputs, n_samples=None, dropout_rate=0., retain_rate=0.2,
+                    distribution='binomial', seed=1):
+  r""" Return the (subsampled) inputs and their corrupted version (only the
+  first input is corrupted), the results are cached by the identity of
+  `inputs` and the arguments. """
+  key = (id(inputs), n_samples, dropout_rate, retain_rate, distribution, seed)
+  with _PREPARED_LOCK:
+    if key in _PREPARED_INPUTS:
+      _PREPARED_INPUTS.move_to_end(key)
+      return _PREPARED_INPUTS[key][1]
+  y_true = _to_sco(inputs)
+  n_obs = y_true[0].n_obs
+  if n_samples is not None and n_samples < n_obs:
+    rand = np.random.RandomState(seed)
+    ids = np.sort(rand.choice(n_obs, size=int(n_samples), replace=False))
+    y_true = [i[ids] for i in y_true]
+  if dropout_rate > 0:
+    y_crpt = [
+        y_true[0].corrupt(dropout_rate=dropout_rate,
+                          retain_rate=retain_rate,
+                          distribution=distribution,
+                          inplace=False,
+                          seed=seed)
+    ] + y_true[1:]
+  else:
+    y_crpt = y_true
+  with _PREPARED_LOCK:
+    # keep the reference to `inputs`, so its id is not reused while cached
+    _PREPARED_INPUTS[key] = (inputs, (y_true, y_crpt))
+    while len(_PREPARED_INPUTS) > _MAX_PREPARED_INPUTS:
+      _PREPARED_INPUTS.popitem(last=False)
+  return y_true, y_crpt
+
+
+def _predict(model, y_crpt, sample_shape, batch_size):
+  r""" Predict the outputs and latents distributions in the cells' order """
+  ds = y_crpt[0].create_dataset(model.output_layers[0].name,
+                                batch_size=batch_size,
+                                shuffle=0,
+                                drop_remainder=False)
+  outputs, latents = model.predict(ds, sample_shape=sample_shape, verbose=0)
+  if not isinstance(outputs, (tuple, list)):
+    outputs = [outputs]
+  if not isinstance(latents, (tuple, list)):
+    latents = [latents]
+  return outputs, latents
 
 
 # ===========================================================================
@@ -76,6 +138,13 @@ class SingleCellMetric(Callback):
   freq : `int` (default=`3`)
     frequency of evaluating the metric, some metrics are very computational
     intensive and could slow down the training progress significantly
+  n_samples : `int` (default=`None`)
+    if given, the metric is evaluated on a fixed random subsample of
+    `n_samples` cells
+  dropout_rate, retain_rate, corrupt_distribution :
+    artificial corruption of the inputs (no corruption if `dropout_rate=0`)
+  seed : `int` (default=`1`)
+    seed for the subsample and the corruption
   """
 
   def __init__(self,
@@ -85,6 +154,11 @@ class SingleCellMetric(Callback):
                sample_shape=1,
                batch_size=64,
                freq=3,
+               n_samples=None,
+               dropout_rate=0.,
+               retain_rate=0.2,
+               corrupt_distribution='binomial',
+               seed=1,
                name=None,
                **kwargs):
     super(SingleCellMetric, self).__init__(**kwargs)
@@ -93,6 +167,11 @@ class SingleCellMetric(Callback):
     self.inputs = inputs
     self.extras = extras
     self.freq = int(freq)
+    self.n_samples = n_samples
+    self.dropout_rate = float(dropout_rate)
+    self.retain_rate = float(retain_rate)
+    self.corrupt_distribution = corrupt_distribution
+    self.seed = int(seed)
     self._name = name
     # store the last epoch that the metric was calculated
     self._last_epoch = 0
@@ -113,45 +192,22 @@ class SingleCellMetric(Callback):
            y_pred: List[Distribution], latents: List[Distribution], extras):
     raise NotImplementedError
 
-  def __call__(self, inputs=None, sample_shape=None):
+  def prepare_inputs(self, inputs=None):
+    r""" Return the list of true inputs and corrupted inputs """
     if inputs is None:
       inputs = self.inputs
-    if sample_shape is None:
-      sample_shape = self.sample_shape
-    model = self.model
-
-    if not isinstance(inputs, (tuple, list)):
-      inputs = [inputs]
-    inputs = _to_sco(inputs, model.omic_outputs)
-    if model.corruption_rate is not None:
-      corruption_text = str(model.corruption_dist) + str(model.corruption_rate)
-      inputs_corrupt = [
-          (data.corrupt(corruption_rate=model.corruption_rate,
-                        corruption_dist=model.corruption_dist,
-                        inplace=False) \
-           if str(id(data)) + corruption_text not in _CORRUPTED_INPUTS else
-           _CORRUPTED_INPUTS[str(id(data)) + corruption_text]) \
-             if idx == 0 else data
-          for idx, data in enumerate(inputs)
-      ]
-      _CORRUPTED_INPUTS[str(id(inputs[0])) +
-                        corruption_text] = inputs_corrupt[0]
-    else:
-      inputs_corrupt = inputs
-
-    outputs, latents = model.predict(inputs_corrupt,
-                                     sample_shape=self.sample_shape,
-                                     batch_size=self.batch_size,
-                                     verbose=0,
-                                     apply_corruption=False)
-    if not isinstance(outputs, (tuple, list)):
-      outputs = [outputs]
-    if not isinstance(latents, (tuple, list)):
-      latents = [latents]
-
-    metrics = self.call(y_true=inputs,
+    return _prepare_inputs(inputs,
+                           n_samples=self.n_samples,
+                           dropout_rate=self.dropout_rate,
+                           retain_rate=self.retain_rate,
+                           distribution=self.corrupt_distribution,
+                           seed=self.seed)
+
+  def evaluate(self, y_true, y_crpt, outputs, latents):
+    r""" Calculate the metrics from given predictions """
+    metrics = self.call(y_true=y_true,
                         y_pred=outputs,
-                        y_crpt=inputs_corrupt,
+                        y_crpt=y_crpt,
                         latents=latents,
                         extras=self.extras)
     if metrics is None:
@@ -167,6 +223,16 @@ class SingleCellMetric(Callback):
     }
     return metrics
 
+  def __call__(self, inputs=None, sample_shape=None):
+    if sample_shape is None:
+      sample_shape = self.sample_shape
+    y_true, y_crpt = self.prepare_inputs(inputs)
+    outputs, latents = _predict(self.model,
+                                y_crpt,
+                                sample_shape=sample_shape,
+                                batch_size=self.batch_size)
+    return self.evaluate(y_true, y_crpt, outputs, latents)
+
   def on_epoch_end(self, epoch, logs=None):
     """Called at the end of an epoch.
 
@@ -209,6 +275,235 @@ class SingleCellMetric(Callback):
           history[key + '_epoch'].append(self._last_epoch)
 
 
+# ===========================================================================
+# Group of metrics
+# ===========================================================================
+class SingleCellMetricGroup(Callback):
+  r""" Evaluate multiple `SingleCellMetric` with a single prediction pass for
+  each distinct inputs and `sample_shape`, the outputs and latents are
+  dispatched to the `call` of every metric.
+
+  The time spent for the predictions and for each metric is accumulated,
+  the failed metrics are skipped with a warning and their errors are
+  recorded, see `report`.
+
+  Parameters
+  ----------
+  metrics : list of `SingleCellMetric`, the metrics are not given to `fit` as
+    callbacks, only this group is.
+
+  Example
+  -------
+  >>> group = SingleCellMetricGroup([
+  >>>     NegativeLogLikelihood(inputs=x_valid),
+  >>>     ImputationError(inputs=x_valid),
+  >>>     CorrelationScores(inputs=x_valid, extras=y_valid)
+  >>> ])
+  >>> model.fit(x_train, callbacks=[group])
+  >>> print(group.report())
+  """
+
+  def __init__(self, metrics: List[SingleCellMetric]):
+    super(SingleCellMetricGroup, self).__init__()
+    self.metrics = list(tf.nest.flatten(metrics))
+    for m in self.metrics:
+      assert isinstance(m, SingleCellMetric), \
+        f"Only support SingleCellMetric, but given: {type(m)}"
+    # mapping name -> [n_calls, total_seconds]
+    self.timing = OrderedDict()
+    # mapping name -> [n_errors, last_error]
+    self.errors = OrderedDict()
+    self._timing_lock = threading.Lock()
+    self._last_epoch = -1
+
+  def set_model(self, model: SingleCellModel):
+    assert isinstance(
+        model, SingleCellModel), "This callback only support SingleCellModel"
+    self.model = model
+    for m in self.metrics:
+      m.set_model(model)
+    return self
+
+  def _record_time(self, name, start):
+    duration = time.time() - start
+    with self._timing_lock:
+      n, total = self.timing.get(name, (0, 0.))
+      self.timing[name] = (n + 1, total + duration)
+
+  def _record_error(self, name, error):
+    error = f"{type(error).__name__}: {error}"
+    warnings.warn(f"Error evaluating {name}, {error}")
+    with self._timing_lock:
+      n, _ = self.errors.get(name, (0, None))
+      self.errors[name] = (n + 1, error)
+
+  def _groups(self, metrics):
+    r""" Return list of `((y_true, y_crpt, sample_shape, batch_size),
+    metrics)` that share the same prediction """
+    groups = OrderedDict()
+    for m in metrics:
+      y_true, y_crpt = m.prepare_inputs()
+      key = (id(y_crpt[0]), m.sample_shape, m.batch_size)
+      if key not in groups:
+        groups[key] = ((y_true, y_crpt, m.sample_shape, m.batch_size), [])
+      groups[key][1].append(m)
+    return list(groups.values())
+
+  def evaluate(self, metrics=None, model=None, groups=None) -> dict:
+    r""" Evaluate the given metrics (all metrics by default) using the
+    predictions of `model` (the fitted model by default) """
+    if model is None:
+      model = self.model
+    if groups is None:
+      groups = self._groups(self.metrics if metrics is None else metrics)
+    results = {}
+    for (y_true, y_crpt, sample_shape, batch_size), metrics in groups:
+      start = time.time()
+      outputs, latents = _predict(model,
+                                  y_crpt,
+                                  sample_shape=sample_shape,
+                                  batch_size=batch_size)
+      self._record_time('predict', start)
+      for m in metrics:
+        start = time.time()
+        try:
+          results.update(m.evaluate(y_true, y_crpt, outputs, latents))
+        except Exception as e:
+          self._record_error(m.name, e)
+        self._record_time(m.name, start)
+    return results
+
+  def report(self) -> str:
+    r""" Time spent for the predictions and each metric, and the errors of
+    the failed metrics """
+    with self._timing_lock:
+      timing = list(self.timing.items())
+      errors = list(self.errors.items())
+    text = "Evaluation time:\n"
+    for name, (n, total) in timing:
+      text += f" {name:<24} calls:{n:<5d} total:{total:.2f}s " \
+        f"mean:{total / max(n, 1):.2f}s\n"
+    if len(errors) > 0:
+      text += "Errors:\n"
+      for name, (n, error) in errors:
+        text += f" {name:<24} errors:{n:<4d} last:{error}\n"
+    return text[:-1]
+
+  def on_epoch_end(self, epoch, logs=None):
+    metrics = [m for m in self.metrics if epoch % m.freq == 0]
+    if len(metrics) > 0 and logs is not None:
+      self._last_epoch = epoch
+      for key, val in self.evaluate(metrics).items():
+        logs[key] = val
+        logs[key + '_epoch'] = epoch
+
+  def on_train_end(self, logs=None):
+    if self.model.epochs != self._last_epoch:
+      self._last_epoch = self.model.epochs
+      history = self.model.history.history
+      for key, val in self.evaluate().items():
+        history.setdefault(key, []).append(val)
+        history.setdefault(key + '_epoch', []).append(self._last_epoch)
+
+
+# ===========================================================================
+# Asynchronous evaluation
+# ===========================================================================
+class MetricScheduler(SingleCellMetricGroup):
+  r""" Evaluate multiple `SingleCellMetric` on a background thread, so the
+  training loop is not blocked.
+
+  At the end of each epoch, the weights of the model are copied, and all the
+  due metrics are evaluated by a shadow model holding this snapshot. The
+  metrics with the same inputs and `sample_shape` share a single prediction
+  pass (see `SingleCellMetricGroup`). The results are merged into the `logs`
+  of the epoch at which they become ready (with the key `'{name}_epoch'` for
+  the evaluated epoch), and all pending evaluations are finished and recorded
+  to the history at the end of training.
+
+  Parameters
+  ----------
+  metrics : list of `SingleCellMetric`, the metrics are not given to `fit` as
+    callbacks, only this scheduler is.
+  max_pending : `int` (default=`1`)
+    maximum number of evaluations waiting in the queue, the evaluation of an
+    epoch is skipped if the queue is full.
+
+  Example
+  -------
+  >>> scheduler = MetricScheduler([
+  >>>     NegativeLogLikelihood(inputs=x_valid, n_samples=2000),
+  >>>     ClusteringScores(inputs=x_valid, extras=y_valid, n_samples=2000)
+  >>> ])
+  >>> model.fit(x_train, callbacks=[scheduler])
+  """
+
+  def __init__(self, metrics: List[SingleCellMetric], max_pending=1):
+    super(MetricScheduler, self).__init__(metrics)
+    self.max_pending = int(max_pending)
+    self._executor = None
+    self._pending = []
+    self._shadow = None
+
+  def _shadow_model(self, weights, batch):
+    r""" Model with the same architecture holding the snapshot weights, the
+    variables are created by calling it on the first batch """
+    if self._shadow is None:
+      self._shadow = self.model.__class__(**self.model.init_args)
+      self._shadow(**batch, training=False)
+    self._shadow.set_weights(weights)
+    return self._shadow
+
+  def _evaluate(self, epoch, weights, groups):
+    (_, y_crpt, _, batch_size), _ = groups[0]
+    ds = y_crpt[0].create_dataset(self.model.output_layers[0].name,
+                                  batch_size=batch_size,
+                                  shuffle=0)
+    shadow = self._shadow_model(weights, next(iter(ds)))
+    return epoch, self.evaluate(model=shadow, groups=groups)
+
+  def _submit(self, epoch, metrics):
+    groups = self._groups(metrics)
+    if self._executor is None:
+      from concurrent.futures import ThreadPoolExecutor
+      self._executor = ThreadPoolExecutor(max_workers=1)
+    self._pending.append(
+        self._executor.submit(self._evaluate, epoch, self.model.get_weights(),
+                              groups))
+    self._last_epoch = epoch
+
+  def _collect(self, wait=False):
+    r""" Return list of (epoch, results) of the finished evaluations """
+    finished = []
+    for f in list(self._pending):
+      if wait or f.done():
+        finished.append(f.result())
+        self._pending.remove(f)
+    return finished
+
+  def on_epoch_end(self, epoch, logs=None):
+    if logs is not None:
+      for evaluated_epoch, results in self._collect():
+        for key, val in results.items():
+          logs[key] = val
+          logs[key + '_epoch'] = evaluated_epoch
+    metrics = [m for m in self.metrics if epoch % m.freq == 0]
+    if len(metrics) > 0 and len(self._pending) < self.max_pending:
+      self._submit(epoch, metrics)
+
+  def on_train_end(self, logs=None):
+    if self.model.epochs != self._last_epoch:
+      self._submit(self.model.epochs, self.metrics)
+    history = self.model.history.history
+    for evaluated_epoch, results in self._collect(wait=True):
+      for key, val in results.items():
+        history.setdefault(key, []).append(val)
+        history.setdefault(key + '_epoch', []).append(evaluated_epoch)
+    if self._executor is not None:
+      self._executor.shutdown(wait=True)
+      self._executor = None
+
+
 # ===========================================================================
 # Losses
 # ===========================================================================
@@ -274,13 +569,13 @@ class ImputationError(SingleCellMetric):
     y_pred = y_pred.mean()
     if y_pred.shape.ndims == 3:
       y_pred = tf.reduce_mean(y_pred, axis=0)
+    scores = imputation_scores(original=y_true.X,
+                               corrupted=y_crpt.X,
+                               imputed=y_pred.numpy(),
+                               max_distances=None)
     return {
-        'imp_med':
-            imputation_score(original=y_true.X, imputed=y_pred),
-        'imp_mean':
-            imputation_mean_score(original=y_true.X,
-                                  corrupted=y_crpt.X,
-                                  imputed=y_pred)
+        'imp_med': scores['imputation_med'],
+        'imp_mean': scores['imputation_mean'],
     }
 
 
@@ -328,11 +623,13 @@ class CorrelationScores(SingleCellMetric):
     if y_pred.shape.ndims == 3:
       y_pred = tf.reduce_mean(y_pred, axis=0)
 
-    scores = correlation_scores(X=y_pred,
-                                y=protein.X,
-                                gene_name=y_true.var['geneid'],
-                                protein_name=protein.var['protid'],
-                                return_series=False)
+    scores = correlation_scores(
+        X=y_pred,
+        y=protein.X,
+        gene_name=y_true.var_names,
+        protein_name=protein.var_names,
+        return_series=False,
+        gene_indices=y_true.get_var_indices(suffix=True))
     if len(scores) == 0:
       return {}
     spearman = []
@@ -361,6 +658,15 @@ class ClusteringScores(SingleCellMetric):
   freq : `int` (default=`3`)
     frequency of evaluating the metric, some metrics are very computational
     intensive and could slow down the training progress significantly
+  mini_batch : `bool` (default=`False`)
+    if True, use `MiniBatchKMeans` instead of `KMeans`, much faster for large
+    dataset but the scores are different from the exact algorithm
+  n_init : `int` (default=`None`)
+    number of k-means initializations, if None, 200 for `KMeans` and 3 for
+    `MiniBatchKMeans`
+  silhouette_size : `int` (default=`None`)
+    number of sampled cells for estimating the silhouette score (the
+    'ASW_ci' is also returned), if None, use all cells (quadratic cost)
 
   Returns
   -------
@@ -373,8 +679,21 @@ class ClusteringScores(SingleCellMetric):
   Example
   -------
   >>> ClusteringScores(extras=y_train, freq=1)
+  >>> # scalable approximation for large dataset
+  >>> ClusteringScores(extras=y_train, mini_batch=True, silhouette_size=2000)
   """
 
+  def __init__(self,
+               *args,
+               mini_batch=False,
+               n_init=None,
+               silhouette_size=None,
+               **kwargs):
+    super(ClusteringScores, self).__init__(*args, **kwargs)
+    self.mini_batch = bool(mini_batch)
+    self.n_init = n_init
+    self.silhouette_size = silhouette_size
+
   def call(self, y_true: List[SingleCellOMIC], y_crpt: List[SingleCellOMIC],
            y_pred: List[Distribution], latents: List[Distribution], extras):
     y_true = y_true[0]
@@ -390,11 +709,16 @@ class ClusteringScores(SingleCellMetric):
     scores_avg = defaultdict(list)
     # support multiple latents also
     for idx, z in enumerate(latents):
-      for key, val in clustering_scores(latent=z.mean().numpy(),
-                                        labels=labels,
-                                        n_labels=protein.var.shape[0]).items():
+      for key, val in clustering_scores(
+          latent=z.mean().numpy(),
+          labels=labels,
+          n_labels=protein.var.shape[0],
+          n_init=self.n_init,
+          mini_batch=self.mini_batch,
+          silhouette_size=self.silhouette_size).items():
         # since all score higher is better, we want them as loss value
-        val = -val
+        if key != 'ASW_ci':
+          val = -val
         scores['%s_%d' % (key, idx)] = val
         scores_avg[key].append(val)
     # average scores
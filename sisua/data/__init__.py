@@ -1,25 +1,44 @@
 from __future__ import absolute_import, division, print_function
 
-import copy
-import os
+import importlib
 from collections import OrderedDict
 from functools import partial
-from numbers import Number
-from typing import Tuple
 
 import numpy as np
 
-from odin.stats import describe, sparsity_percentage, train_valid_test_split
-from odin.utils import cache_memory, catch_warnings_ignore, one_hot
+from odin.utils import catch_warnings_ignore
+from sisua.data.cache import (get_snapshot_path, read_snapshot,
+                              remove_snapshot, write_snapshot)
 from sisua.data.const import (MARKER_ADT_GENE, MARKER_ADTS, MARKER_ATAC,
                               MARKER_GENES, OMIC, PROTEIN_PAIR_NEGATIVE,
                               PROTEIN_PAIR_POSITIVE, UNIVERSAL_RANDOM_SEED)
 from sisua.data.path import CONFIG_PATH, DATA_DIR, EXP_DIR
-from sisua.data.single_cell_dataset import SingleCellOMIC
-from sisua.data.utils import (apply_artificial_corruption, get_gene_id2name,
-                              get_library_size, is_binary_dtype,
-                              is_categorical_dtype, standardize_protein_name,
-                              validating_dataset)
+
+# PEP 562: `SingleCellOMIC` (scanpy, TensorFlow) and the preprocessing
+# utilities are only imported at the first access
+_LAZY_ATTRIBUTES = {
+    'SingleCellOMIC': 'sisua.data.single_cell_dataset',
+    'apply_artificial_corruption': 'sisua.data.utils',
+    'get_gene_id2name': 'sisua.data.utils',
+    'get_library_size': 'sisua.data.utils',
+    'is_binary_dtype': 'sisua.data.utils',
+    'is_categorical_dtype': 'sisua.data.utils',
+    'standardize_protein_name': 'sisua.data.utils',
+    'track_raw_files': 'sisua.data.utils',
+    'validating_dataset': 'sisua.data.utils',
+}
+
+
+def __getattr__(name):
+  if name in _LAZY_ATTRIBUTES:
+    attr = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = attr
+    return attr
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+  return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
 
 
 def get_dataset_meta():
@@ -227,6 +246,7 @@ def get_dataset_meta():
 
 def get_dataset_summary(return_html=False):
   import pandas as pd
+  from sisua.data.utils import standardize_protein_name
   all_datasets = []
   for name, fn in sorted(get_dataset_meta().items()):
     ds = fn(override=False)
@@ -246,7 +266,10 @@ def get_dataset_summary(return_html=False):
   return df
 
 
-def get_dataset(dataset_name, override=False, verbose=True) -> SingleCellOMIC:
+def get_dataset(dataset_name,
+                override=False,
+                verbose=True,
+                cache=True) -> 'SingleCellOMIC':
   r""" Check `get_dataset_meta` for more information
 
   List of all dataset available: ['call', 'callall', 'mpal', 'mpalall',
@@ -262,6 +285,13 @@ def get_dataset(dataset_name, override=False, verbose=True) -> SingleCellOMIC:
     'regulatorytall', 'cd4t', 'cd4tall', '5k', '5kall', '18k', '18kall',
     '4k', '4kall', '10k', '10kall']
 
+  Arguments:
+    override : a Boolean, re-run the preprocessing and the snapshot.
+    cache : a Boolean, if True, the preprocessed `SingleCellOMIC` is stored as
+      a binary snapshot (see `sisua.data.cache`) under `DATA_DIR`, then,
+      memory-mapped on the next calls. The snapshot is invalidated if sisua
+      version, the loader arguments or the MD5 of the raw data changed.
+
   Return:
     mRNA data : `SingleCellOMIC`
     label data: `SingleCellOMIC`. If label data is not availabel, then None
@@ -273,6 +303,9 @@ def get_dataset(dataset_name, override=False, verbose=True) -> SingleCellOMIC:
     X_train.assert_matching_cells(y_train)
     X_test.assert_matching_cells(y_test)
   """
+  from sisua.data.single_cell_dataset import SingleCellOMIC
+  from sisua.data.utils import (is_binary_dtype, track_raw_files,
+                                validating_dataset)
   data_meta = get_dataset_meta()
   # ====== special case: get all dataset ====== #
   dataset_name = str(dataset_name).lower().strip()
@@ -280,22 +313,38 @@ def get_dataset(dataset_name, override=False, verbose=True) -> SingleCellOMIC:
     raise RuntimeError(
         'Cannot find dataset with name: "%s", all dataset include: %s' %
         (dataset_name, ", ".join(list(data_meta.keys()))))
-  with catch_warnings_ignore(FutureWarning):
-    ds = data_meta[dataset_name](override=override, verbose=verbose)
+  loader = data_meta[dataset_name]
+  # ******************** snapshot ******************** #
+  if cache:
+    snapshot = get_snapshot_path(dataset_name, loader)
+    if override:
+      remove_snapshot(snapshot)
+    else:
+      sco = read_snapshot(snapshot, verbose=verbose)
+      if sco is not None:
+        return sco
+  with track_raw_files() as raw_files:
+    with catch_warnings_ignore(FutureWarning):
+      ds = loader(override=override, verbose=verbose)
   # ******************** create SCO ******************** #
   if isinstance(ds, SingleCellOMIC):
-    return ds
+    sc = ds
   # ******************** return ******************** #
-  validating_dataset(ds)
-  with catch_warnings_ignore(FutureWarning):
-    sc = SingleCellOMIC(X=ds['X'],
-                        cell_id=ds['X_row'],
-                        gene_id=ds['X_col'],
-                        name=dataset_name)
-    if 'y' in ds:
-      y = ds['y']
-      if is_binary_dtype(y):
-        sc.add_omic(OMIC.celltype, y, ds['y_col'])
-      else:
-        sc.add_omic(OMIC.proteomic, y, ds['y_col'])
+  else:
+    validating_dataset(ds)
+    with catch_warnings_ignore(FutureWarning):
+      sc = SingleCellOMIC(X=ds['X'],
+                          cell_id=ds['X_row'],
+                          gene_id=ds['X_col'],
+                          name=dataset_name)
+      if 'y' in ds:
+        y = ds['y']
+        if is_binary_dtype(y):
+          sc.add_omic(OMIC.celltype, y, ds['y_col'])
+        else:
+          sc.add_omic(OMIC.proteomic, y, ds['y_col'])
+  if cache:
+    write_snapshot(snapshot, sc, raw_files)
+    if verbose:
+      print(f"Saved snapshot of '{dataset_name}' to {snapshot}")
   return sc
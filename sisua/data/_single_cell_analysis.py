@@ -17,7 +17,6 @@ import tensorflow as tf
 from anndata._core.aligned_mapping import AxisArrays
 from bigarray import MmapArrayWriter
 from scipy.sparse import issparse
-from scipy.stats import pearsonr, spearmanr
 from six import string_types
 from sklearn.cluster import MiniBatchKMeans, SpectralClustering
 from sklearn.decomposition import IncrementalPCA
@@ -33,8 +32,9 @@ from odin.stats import (describe, is_discrete, sparsity_percentage,
 from odin.utils import (MPI, IndexedList, as_tuple, batching, cache_memory,
                         catch_warnings_ignore, cpu_count, is_primitive)
 from odin.utils.crypto import md5_checksum
-from sisua.data._single_cell_base import BATCH_SIZE, _OMICbase
+from sisua.data._single_cell_base import BATCH_SIZE, _as_batch, _OMICbase
 from sisua.data.const import MARKER_ADT_GENE, MARKER_ADTS, MARKER_GENES, OMIC
+from sisua.data.correlation import correlation_matrix
 from sisua.data.utils import (apply_artificial_corruption, get_library_size,
                               is_binary_dtype, is_categorical_dtype,
                               standardize_protein_name)
@@ -101,13 +101,14 @@ class _OMICanalyzer(_OMICbase):
     if not (0. < retain_rate < 1. or 0. < dropout_rate < 1.):
       return om
     for o in omic:
-      apply_artificial_corruption(om.numpy(o),
-                                  dropout=dropout_rate,
-                                  retain_rate=retain_rate,
-                                  distribution=distribution,
-                                  copy=False,
-                                  seed=seed)
-      om._calculate_statistics(o)
+      _, rows = apply_artificial_corruption(om._ensure_writable(o),
+                                            dropout=dropout_rate,
+                                            retain_rate=retain_rate,
+                                            distribution=distribution,
+                                            copy=False,
+                                            seed=seed,
+                                            return_rows=True)
+      om._calculate_statistics(o, rows=rows)
     return om
 
   def filter_highly_variable_genes(self,
@@ -304,8 +305,10 @@ class _OMICanalyzer(_OMICbase):
     omics._record('filter_cells', locals())
     omics.apply_indices(cells_subset, observation=True)
     omics._name += '_filtercell'
-    # recalculate library info
-    omics._calculate_statistics()
+    # the total counts of the remained cells are unchanged, only the library
+    # mean and variance are updated
+    for o in omics.omics:
+      omics._calculate_statistics(o, rows=())
     return omics
 
   def probabilistic_embedding(self,
@@ -316,6 +319,8 @@ class _OMICanalyzer(_OMICbase):
                               clip_quartile=0.,
                               remove_zeros=True,
                               ci_threshold=-0.68,
+                              algorithm='auto',
+                              n_jobs=1,
                               seed=1,
                               pbe: Optional[ProbabilisticEmbedding] = None):
     r""" Fit a GMM on each feature column to get the probability or binary
@@ -327,6 +332,9 @@ class _OMICanalyzer(_OMICbase):
       np.ndarray : binary X
 
     Arguments:
+      algorithm : {'auto', 'sklearn', 'batched'}, algorithm for fitting the
+        GMMs, 'auto' uses the vectorized 'batched' EM for 100 or more features.
+      n_jobs : number of processes for 'sklearn' algorithm.
       pbe : {`sisua.ProbabilisticEmbedding`, `None`}, optional pretrained
         instance of `ProbabilisticEmbedding`
     """
@@ -337,8 +345,10 @@ class _OMICanalyzer(_OMICbase):
     # separately in advance.
     omic = OMIC.parse(omic)
     X = self.numpy(omic)
-    if X.shape[1] >= 100:
-      warnings.warn("%d GMM will be trained!" % self.shape[1])
+    if algorithm == 'auto':
+      algorithm = 'batched' if X.shape[1] >= 100 else 'sklearn'
+    if X.shape[1] >= 100 and algorithm == 'sklearn':
+      warnings.warn("%d GMM will be trained!" % X.shape[1])
     name = omic.name
     pbe_name = '%s_pbe' % name
     prob_name = '%s_prob' % name
@@ -359,6 +369,8 @@ class _OMICanalyzer(_OMICbase):
               clip_quartile=clip_quartile,
               remove_zeros=remove_zeros,
               ci_threshold=ci_threshold,
+              algorithm=algorithm,
+              n_jobs=n_jobs,
               random_state=seed)
           with catch_warnings_ignore(ConvergenceWarning):
             pbe.fit(X)
@@ -404,18 +416,15 @@ class _OMICanalyzer(_OMICbase):
     n_components = min(n_components, X.shape[1])
     ### train new PCA model
     if algo == 'pca':
-      X_ = np.empty(shape=(X.shape[0], n_components), dtype=X.dtype)
+      dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float32
+      X_ = np.empty(shape=(X.shape[0], n_components), dtype=dtype)
       model = IncrementalPCA(n_components=n_components)
       # fitting
       for start, end in batching(BATCH_SIZE, n=X.shape[0]):
-        chunk = X[start:end]
-        chunk = chunk.toarray() if issparse(chunk) else chunk
-        model.partial_fit(chunk)
+        model.partial_fit(_as_batch(X[start:end], dtype))
       # transforming
       for start, end in batching(BATCH_SIZE, n=X.shape[0]):
-        chunk = X[start:end]
-        chunk = chunk.toarray() if issparse(chunk) else chunk
-        X_[start:end] = model.transform(chunk)
+        X_[start:end] = model.transform(_as_batch(X[start:end], dtype))
     ### TSNE
     elif algo == 'tsne':
       from odin.ml import fast_tsne
@@ -457,7 +466,7 @@ class _OMICanalyzer(_OMICbase):
     om._record('expm1', locals())
     _expm1 = lambda x: (np.expm1(x.data, out=x.data)
                         if issparse(x) else np.expm1(x, out=x))
-    X = om.numpy(omic)
+    X = om._ensure_writable(omic)
     for s, e in batching(n=self.n_obs, batch_size=BATCH_SIZE):
       X[s:e] = _expm1(X[s:e])
     om._calculate_statistics(omic)
@@ -514,6 +523,7 @@ class _OMICanalyzer(_OMICbase):
       omic = self.current_omic
     om = self if inplace else self.copy()
     om._record('normalize', locals())
+    om._ensure_writable(omic)
     if omic != OMIC.transcriptomic:
       org_X = om._X
       om._X = om.numpy(omic)
@@ -690,13 +700,11 @@ class _OMICanalyzer(_OMICbase):
                               random_state=random_state)
       # better suffering the batch
       for s, e in batching(BATCH_SIZE, self.n_obs, seed=random_state):
-        x = X[s:e]
-        model.partial_fit(x)
+        model.partial_fit(_as_batch(X[s:e], np.float32))
       # make prediction
       labels = []
       for s, e in batching(BATCH_SIZE, self.n_obs):
-        x = X[s:e]
-        labels.append(model.predict(x))
+        labels.append(model.predict(_as_batch(X[s:e], np.float32)))
       labels = np.concatenate(labels, axis=0)
     ## fit KNN
     elif algo == 'knn':
@@ -961,6 +969,8 @@ class _OMICanalyzer(_OMICbase):
 
     """
     self._record('calculate_quality_metrics', locals())
+    if log1p:
+      self._ensure_writable()
     cell_qc, gene_qc = sc.pp.calculate_qc_metrics(
         self,
         percent_top=as_tuple(percent_top, t=int)
@@ -1213,29 +1223,12 @@ class _OMICanalyzer(_OMICbase):
     ### prepare the data
     x1 = self.numpy(omic1)
     x2 = self.numpy(omic2)
-    n_om1 = x1.shape[1]
-    n_om2 = x2.shape[1]
-
-    def _corr(ids):
-      results = []
-      if not isinstance(ids[0], tuple):
-        ids = [ids]
-      for i1, i2 in ids:
-        y1 = x1[:, i1]
-        y2 = x2[:, i2]
-        with catch_warnings_ignore(RuntimeWarning):
-          p = pearsonr(y1, y2)[0]
-          s = spearmanr(y1, y2, nan_policy='omit').correlation
-          # remove all NaNs
-          results.append((i1, i2, p, s))
-      yield results
-
-    ### multiprocessing
-    jobs = list(itertools.product(range(n_om1), range(n_om2)))
-    ncpu = max(1, cpu_count() - 1)
-    results = []
-    for res in MPI(jobs, func=_corr, ncpu=ncpu, batch=len(jobs) // ncpu):
-      results += res
+    pearson, spearman = correlation_matrix(x1,
+                                           x2,
+                                           method=('pearson', 'spearman'))
+    results = [(i1, i2, p, s) for (i1, i2), p, s in zip(
+        itertools.product(range(x1.shape[1]), range(x2.shape[1])),
+        pearson.ravel(), spearman.ravel())]
     ### sorted by decreasing order
     all_correlations = sorted(
         results,
@@ -3,6 +3,9 @@ from __future__ import absolute_import, division, print_function
 import inspect
 import itertools
 import os
+import pickle
+import shutil
+import time
 import warnings
 from contextlib import contextmanager
 from numbers import Number
@@ -27,13 +30,16 @@ from odin.utils import (IndexedList, MD5object, as_tuple, batching,
                         cache_memory, catch_warnings_ignore, ctext,
                         is_primitive)
 from sisua.data.const import MARKER_GENES, OMIC
-from sisua.data.utils import (apply_artificial_corruption, get_library_size,
-                              is_binary_dtype, is_categorical_dtype,
+from sisua.data.sparse_mmap import read_sparse_mmap, write_sparse_mmap
+from sisua.data.utils import (apply_artificial_corruption, build_var_indices,
+                              get_total_counts, is_binary_dtype,
+                              is_categorical_dtype, library_statistics,
                               standardize_protein_name)
 from sisua.label_threshold import ProbabilisticEmbedding
 
 # Heuristic constants
 BATCH_SIZE = 4096
+_STORE_META = 'meta'
 
 # TODO: take into account obsp and varp
 
@@ -59,6 +65,52 @@ def get_all_omics(sco: sc.AnnData):
   return o
 
 
+def _is_memmap(x) -> bool:
+  r""" Return True if the (dense or sparse) array is backed by a file """
+  if sparse.issparse(x):
+    return _is_memmap(x.data) or _is_memmap(x.indices)
+  # copies of a memmap are still `np.memmap` instance but without the mmap
+  return isinstance(x, np.memmap) and getattr(x, '_mmap', None) is not None
+
+
+def _as_batch(x: Union[np.ndarray, sparse.spmatrix], dtype=None) -> np.ndarray:
+  r""" Densify (if sparse) and cast a chunk of rows, only the chunk is
+  loaded into memory in case of memory-mapped array """
+  if sparse.issparse(x):
+    x = x.toarray()
+  else:
+    x = np.asarray(x)
+  if dtype is not None:
+    x = x.astype(dtype, copy=False)
+  return x
+
+
+def _tensor_slices(x: Union[np.ndarray, sparse.spmatrix],
+                   dtype=None,
+                   block_size=256) -> tf.data.Dataset:
+  r""" Create `tf.data.Dataset` slices along the first dimension, sparse
+  matrix is sliced as `tf.SparseTensor` to avoid densifying the whole
+  matrix, memory-mapped array is read (and casted to `dtype`) by blocks of
+  `block_size` contiguous rows (one `tf.numpy_function` call per block), then
+  unbatched """
+  if _is_memmap(x):
+    n_obs, n_features = x.shape
+    dtype = tf.as_dtype(np.float32 if dtype is None else dtype)
+    block_size = int(block_size)
+    read_block = lambda s: _as_batch(x[s:s + block_size], dtype.as_numpy_dtype)
+    return tf.data.Dataset.range(0, n_obs, block_size).map(
+        lambda s: tf.reshape(tf.numpy_function(read_block, [s], dtype),
+                             (-1, n_features)),
+        tf.data.experimental.AUTOTUNE).unbatch()
+  if sparse.issparse(x):
+    x = x.tocoo()
+    x = tf.SparseTensor(indices=np.stack([x.row, x.col],
+                                         axis=1).astype(np.int64),
+                        values=x.data,
+                        dense_shape=x.shape)
+  return tf.data.Dataset.from_tensor_slices(x)
+
+
 def _check_array(x: Union[np.ndarray, sparse.spmatrix]):
   if isinstance(x, sparse.spmatrix):
     if isinstance(x, sparse.coo_matrix):
@@ -66,6 +118,55 @@ def _check_array(x: Union[np.ndarray, sparse.spmatrix]):
   return x
 
 
+def _corrupt_tensor(x: tf.Tensor, seeds: tf.Tensor, dropout_rate: float,
+                    retain_rate: float, distribution: str) -> tf.Tensor:
+  r""" Stateless version of `apply_artificial_corruption` for a single cell,
+  each count is selected for corruption with probability `dropout_rate`.
+
+  Arguments:
+    seeds : a Tensor of shape `[2, 2]`, the seeds for the selection and for
+      the corruption.
+  """
+  shape = tf.shape(x)
+  selected = tf.logical_and(
+      tf.random.stateless_uniform(shape, seed=seeds[0]) < dropout_rate,
+      tf.not_equal(x, 0))
+  if distribution == 'uniform':
+    corrupted = x * tf.cast(
+        tf.random.stateless_uniform(shape, seed=seeds[1]) < retain_rate,
+        x.dtype)
+  else:
+    corrupted = tf.random.stateless_binomial(shape,
+                                             seed=seeds[1],
+                                             counts=tf.floor(x),
+                                             probs=retain_rate,
+                                             output_dtype=x.dtype)
+  return tf.where(selected, corrupted, x)
+
+
+def _gather_rows(x: Union[np.ndarray, sparse.spmatrix],
+                 indices: np.ndarray,
+                 dtype=np.float32) -> tuple:
+  r""" Gather rows of a dense, sparse or memory-mapped matrix, only the
+  gathered rows are read. Sparse rows are returned as the components
+  `(indices, values, dense_shape)` of a `tf.SparseTensor` """
+  x = x[indices]
+  if sparse.issparse(x):
+    # row-major order of the non-zeros is required by `tf.sparse.to_dense`
+    x = x.tocsr()
+    x.sort_indices()
+    x = x.tocoo()
+    return (np.stack([x.row, x.col], axis=1).astype(np.int64),
+            x.data.astype(dtype, copy=False),
+            np.array(x.shape, dtype=np.int64))
+  return (np.asarray(x, dtype=dtype),)
+
+
+def _stats_matrix(total_counts) -> np.ndarray:
+  return np.hstack([total_counts.reshape(-1, 1)] +
+                   list(library_statistics(total_counts)))
+
+
 # ===========================================================================
 # Main
 # ===========================================================================
@@ -79,6 +180,7 @@ class _OMICbase(sc.AnnData, MD5object):
                omic: OMIC = OMIC.transcriptomic,
                name: Optional[str] = None,
                duplicated_var: bool = False,
+               calculate_statistics: bool = True,
                **kwargs):
     omic = OMIC.parse(omic)
     # directly first time init from file
@@ -106,15 +208,17 @@ class _OMICbase(sc.AnnData, MD5object):
         dtype = X.dtype
       if name is None:
         name = "scOMICS"
+      X = _check_array(X)
       if not duplicated_var:
-        # check duplicated var_names
+        # check duplicated var_names, only copy the data if necessary
         gene_id = np.asarray(gene_id)
         u, c = np.unique(gene_id, return_counts=True)
-        ids = np.ones(shape=(len(gene_id),), dtype=np.bool)
-        for v in u[c > 1]:
-          ids[gene_id == v] = False
-        gene_id = gene_id[ids]
-        X = _check_array(X)[:, ids]
+        if np.any(c > 1):
+          ids = np.ones(shape=(len(gene_id),), dtype=np.bool)
+          for v in u[c > 1]:
+            ids[gene_id == v] = False
+          gene_id = gene_id[ids]
+          X = X[:, ids]
       kwargs['dtype'] = dtype
       kwargs['obs'] = pd.DataFrame(index=cell_id)
       kwargs['var'] = pd.DataFrame(index=gene_id)
@@ -132,7 +236,8 @@ class _OMICbase(sc.AnnData, MD5object):
     # The class is created for first time
     if not isinstance(X, sc.AnnData):
       self.obs['indices'] = np.arange(self.X.shape[0], dtype='int64')
-      self._calculate_statistics(omic)
+      if calculate_statistics:
+        self._calculate_statistics(omic)
 
   def set_verbose(self, verbose):
     r""" If True, print out all method call and its arguments """
@@ -220,23 +325,32 @@ class _OMICbase(sc.AnnData, MD5object):
       assert np.all(sco.obs.iloc[:, 0] == self.obs.iloc[:, 0])
     return self
 
-  def _calculate_statistics(self, omic=None):
+  def _calculate_statistics(self, omic=None, rows=None):
+    r""" Invalidate or update the library statistics of given OMIC.
+
+    Arguments:
+      rows : indices (or boolean mask) of the modified rows. If None, the
+        statistics are dropped and lazily recomputed by one chunked pass at
+        the first access. Otherwise, only the total counts of given rows are
+        recomputed, an empty list only refreshes the library mean and variance
+        (e.g. after subsetting the rows).
+    """
     if omic is None:
       omic = self.current_omic
     else:
       omic = OMIC.parse(omic)
-    X = self.numpy(omic)
-    # start processing
-    if sparse.issparse(X):
-      total_counts = np.sum(X, axis=1)
-      if total_counts.ndim < 2:
-        total_counts = np.expand_dims(total_counts, axis=-1)
-    else:
-      total_counts = np.sum(X, axis=1, keepdims=True)
-    log_counts, local_mean, local_var = get_library_size(X,
-                                                         return_log_count=True)
-    self.obsm[omic.name + '_stats'] = np.hstack(
-        [total_counts, log_counts, local_mean, local_var])
+    name = omic.name + '_stats'
+    if name not in self.obsm:
+      return self
+    if rows is None:
+      del self.obsm[name]
+      return self
+    total_counts = np.array(self.obsm[name][:, 0], dtype=np.float64)
+    rows = np.asarray(rows)
+    if rows.size > 0:
+      total_counts[rows] = get_total_counts(self.numpy(omic), rows=rows)
+    self.obsm[name] = _stats_matrix(total_counts)
+    return self
 
   def __getitem__(self, index):
     r"""Returns a sliced view of the object."""
@@ -254,10 +368,16 @@ class _OMICbase(sc.AnnData, MD5object):
           % (key, str(X.shape), om.n_vars)
     return om
 
+  def _invalidate_var_indices(self, omic=None):
+    omic = self.current_omic if omic is None else OMIC.parse(omic)
+    for suffix in ('', '_suffix'):
+      self.uns.pop(f"{omic.name}_var_indices{suffix}", None)
+
   def _inplace_subset_var(self, index):
     var_uns = f"{self.current_omic.name}_var"
     obj = super()._inplace_subset_var(index)
     self.uns[var_uns] = self.var
+    self._invalidate_var_indices()
     return obj
 
   def apply_indices(self, indices, observation=True):
@@ -287,6 +407,7 @@ class _OMICbase(sc.AnnData, MD5object):
       self._var = self._var.iloc[indices]
       self._varm = AxisArrays(
           self, 1, vals={i: j[indices] for i, j in self._varm.items()})
+      self._invalidate_var_indices()
     return self
 
   # ******************** properties ******************** #
@@ -324,19 +445,21 @@ class _OMICbase(sc.AnnData, MD5object):
   def get_n_var(self, omic) -> int:
     return self.get_var(omic).shape[0]
 
-  def get_var_indices(self, omic=None) -> dict:
+  def get_var_indices(self, omic=None, suffix=False) -> dict:
     r""" Mapping from variable name to its integer index (i.e. column index)
     of the data matrix.
+
+    If `suffix=True`, the name after the last '_' is also mapped (e.g. both
+    'ENSG00000_CD4' and 'CD4'), see `sisua.data.utils.build_var_indices`.
     """
     if omic is None:
       omic = self._current_omic
     else:
       omic = OMIC.parse(omic)
-    name = f"{omic.name}_var_indices"
+    name = f"{omic.name}_var_indices{'_suffix' if suffix else ''}"
     if name not in self.uns:
-      self.uns[name] = {
-          name: i for i, name in enumerate(self.get_var(omic).index)
-      }
+      self.uns[name] = build_var_indices(self.get_var(omic).index,
+                                         suffix=suffix)
     return self.uns[name]
 
   def get_var(self, omic=None) -> pd.DataFrame:
@@ -390,8 +513,14 @@ class _OMICbase(sc.AnnData, MD5object):
       self._calculate_statistics(omic)
     return self
 
-  def numpy(self, omic=None):
-    r""" Return observation ndarray in `obsm` or `obs` """
+  def numpy(self, omic=None, dtype=None):
+    r""" Return observation ndarray in `obsm` or `obs`
+
+    Arguments:
+      dtype : if given, return a casted copy loaded into memory, otherwise,
+        the stored array is returned as it is (i.e. memory-mapped OMIC stays
+        on disk in its stored dtype).
+    """
     if omic is None:
       omic = self._current_omic
     omic_name = omic.name if hasattr(omic, 'name') else str(omic)
@@ -400,15 +529,46 @@ class _OMICbase(sc.AnnData, MD5object):
       x = self.obs[omic_name].values
       if hasattr(x, 'to_numpy'):
         x = x.to_numpy()
-      return x
+      return x if dtype is None else x.astype(dtype)
     # obsm
     omic = OMIC.parse(omic)
     for om in list(omic):
       if om.name in self.obsm:
-        return self.obsm[om.name]
+        x = self.obsm[om.name]
+        if dtype is None:
+          return x
+        # casting chunk by chunk to avoid a full copy in the original dtype
+        if sparse.issparse(x):
+          x = x.tocsr()
+          return sparse.csr_matrix(
+              (np.asarray(x.data, dtype=dtype), np.array(x.indices),
+               np.array(x.indptr)),
+              shape=x.shape)
+        arr = np.empty(shape=x.shape, dtype=dtype)
+        for s, e in batching(batch_size=BATCH_SIZE, n=x.shape[0]):
+          arr[s:e] = x[s:e]
+        return arr
     # not found
     raise ValueError(f"OMIC not found, give: {omic}, support: {self.omics}")
 
+  def _ensure_writable(self, omic=None):
+    r""" Copy-on-write before any inplace transformation, read-only
+    memory-mapped or integer OMIC is loaded into memory as float32, otherwise,
+    the stored array is returned. """
+    if omic is None:
+      omic = self._current_omic
+    omic = OMIC.parse(omic)
+    X = self.numpy(omic)
+    data = X.data if sparse.issparse(X) else X
+    is_float = np.issubdtype(data.dtype, np.floating)
+    if is_float and data.flags.writeable:
+      return X
+    X = self.numpy(omic, dtype=data.dtype if is_float else np.float32)
+    self.obsm[omic.name] = X
+    if omic == self._current_omic:
+      self._X = X
+    return X
+
   def labels(self, omic=OMIC.proteomic):
     omic = OMIC.parse(omic)
     for om in list(omic):
@@ -462,11 +622,22 @@ class _OMICbase(sc.AnnData, MD5object):
     r""" Return a matrix of shape `[n_obs, 4]`.
 
     The columns are: 'total_counts', 'log_counts', 'local_mean', 'local_var'
+    (float64), computed at the first access after the OMIC is modified.
     """
     if omic is None:
       omic = self._current_omic
     omic = OMIC.parse(omic)
-    return self.obsm[omic.name + '_stats']
+    name = omic.name + '_stats'
+    if name in self.obsm:
+      return self.obsm[name]
+    # a view derives the statistics of its parent population (computed and
+    # stored on the parent if necessary), storing new array would turn the
+    # view into an actual copy
+    if self.is_view:
+      return np.asarray(self._adata_ref.stats(omic))[self._oidx]
+    stats = _stats_matrix(get_total_counts(self.numpy(omic)))
+    self.obsm[name] = stats
+    return stats
 
   def get_library_size(self, omic=None):
     r""" Return the mean and variance for library size modeling in log-space """
@@ -494,7 +665,10 @@ class _OMICbase(sc.AnnData, MD5object):
 
   # ====== statistics ====== #
   def sparsity(self, omic=None):
-    return sparsity_percentage(self.numpy(omic))
+    X = self.numpy(omic)
+    if sparse.issparse(X):
+      return 1. - X.count_nonzero() / max(1, np.prod(X.shape))
+    return sparsity_percentage(X)
 
   def counts_per_cell(self, omic=None):
     r""" Return total number of counts per cell. This method
@@ -502,7 +676,7 @@ class _OMICbase(sc.AnnData, MD5object):
     counts = 0
     X = self.numpy(omic)
     for s, e in batching(batch_size=BATCH_SIZE, n=X.shape[1]):
-      counts += np.sum(X[:, s:e], axis=1)
+      counts += np.asarray(X[:, s:e].sum(axis=1)).ravel()
     return counts
 
   def counts_per_gene(self, omic=None):
@@ -511,7 +685,7 @@ class _OMICbase(sc.AnnData, MD5object):
     counts = 0
     X = self.numpy(omic)
     for s, e in batching(batch_size=BATCH_SIZE, n=X.shape[0]):
-      counts += np.sum(X[s:e], axis=0)
+      counts += np.asarray(X[s:e].sum(axis=0)).ravel()
     return counts
 
   # ******************** logging and io ******************** #
@@ -536,14 +710,121 @@ class _OMICbase(sc.AnnData, MD5object):
     r""" Shortcut for creating `RVmeta` for given OMIC type """
     return self.get_rv(omic, distribution)
 
+  def save(self, path: str, remove_exist: bool = False) -> str:
+    r""" Save this dataset to an on-disk store which could be opened lazily
+    by `SingleCellOMIC.open`. Every array in `obsm` is written in its own
+    dtype, batch by batch: dense array as `.npy` file and sparse matrix as
+    memory-mapped CSR (`sisua.data.sparse_mmap`).
+
+    Arguments:
+      path : a String, path to the output folder
+      remove_exist : a Boolean, override existed folder
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    if os.path.exists(path):
+      if not remove_exist:
+        raise RuntimeError(f"Path '{path}' exists, set remove_exist=True to "
+                           "override.")
+      shutil.rmtree(path)
+    os.makedirs(path)
+    arrays = {}
+    objects = {}
+    for key, x in self.obsm.items():
+      if sparse.issparse(x):
+        write_sparse_mmap(os.path.join(path, key),
+                          x.tocsr(),
+                          batch_size=BATCH_SIZE)
+        arrays[key] = True
+      elif isinstance(x, np.ndarray):
+        f = np.lib.format.open_memmap(os.path.join(path, f"{key}.npy"),
+                                      mode='w+',
+                                      dtype=x.dtype,
+                                      shape=x.shape)
+        for s, e in batching(batch_size=BATCH_SIZE, n=x.shape[0]):
+          f[s:e] = x[s:e]
+        f.flush()
+        del f
+        arrays[key] = False
+      else:
+        objects[key] = x
+    # unpicklable object (e.g. tensorflow model) is skipped
+    uns = {}
+    for key, val in self.uns.items():
+      try:
+        pickle.dumps(val)
+        uns[key] = val
+      except Exception as e:
+        warnings.warn(f"Skip saving uns['{key}'], error: {e}")
+    meta = dict(name=self.name,
+                current_omic=self.current_omic.name,
+                omics=[om.name for om in self.omics],
+                obs=self.obs,
+                arrays=arrays,
+                objects=objects,
+                uns=uns,
+                history=self.history)
+    with open(os.path.join(path, _STORE_META), 'wb') as f:
+      pickle.dump(meta, f)
+    return path
+
+  @classmethod
+  def open(cls, path: str, mode: str = 'r'):
+    r""" Open a store created by `SingleCellOMIC.save`, all OMICs in `obsm`
+    stay memory-mapped in their stored dtype, hence, only the accessed rows
+    are loaded into memory (and casted per batch by `create_dataset`).
+
+    Arguments:
+      path : a String, path to the store folder
+      mode : {'r', 'r+', 'c'}, mode for `numpy.memmap`. With read-only mode,
+        any inplace transformation (e.g. `normalize`, `corrupt`) loads the
+        modified OMIC into memory.
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    with open(os.path.join(path, _STORE_META), 'rb') as f:
+      meta = pickle.load(f)
+    obsm = {}
+    for key, is_sparse in meta['arrays'].items():
+      if is_sparse:
+        obsm[key] = read_sparse_mmap(os.path.join(path, key), mode=mode)
+      else:
+        obsm[key] = np.load(os.path.join(path, f"{key}.npy"), mmap_mode=mode)
+    obsm.update(meta['objects'])
+    main = OMIC.parse(meta['current_omic'])
+    X = obsm[main.name]
+    var = meta['uns'][f"{main.name}_var"]
+    sco = cls(X,
+              cell_id=meta['obs'].index,
+              gene_id=var.index,
+              dtype=X.dtype,
+              omic=main,
+              name=meta['name'],
+              duplicated_var=True,
+              calculate_statistics=False)
+    sco.obs = meta['obs']
+    for key, x in obsm.items():
+      if key != main.name:
+        sco.obsm[key] = x
+    for key, val in meta['uns'].items():
+      sco.uns[key] = val
+    sco.var = var
+    sco.uns[f"{main.name}_var"] = sco.var
+    for name in meta['omics']:
+      sco._omics |= OMIC.parse(name)
+    sco._history = meta['history']
+    return sco
+
   def create_dataset(self,
                      omics: OMIC = None,
                      labels_percent=0,
                      batch_size=64,
                      drop_remainder=False,
                      shuffle=1000,
-                     cache='',
+                     cache=None,
                      framework='tensorflow',
+                     corruption=None,
+                     pipeline='gather',
+                     sparse_batch=False,
+                     num_workers=0,
                      seed=1) -> tf.data.Dataset:
     r""" Create dataset for training using one or multiple OMIC data
 
@@ -554,12 +835,48 @@ class _OMICbase(sc.AnnData, MD5object):
         var will be include, the length of the list is coordinated to the `omics`
       labels_percent : a Scalar [0., 1.]. If > 0, create a mask with given
         percent set to True.
+      cache : a String, path to cache file or '' for caching in memory, only
+        for `pipeline='slices'`. Memory-mapped OMICs are read and casted to
+        float32 on demand, hence, they are only cached if a path is given.
+      corruption : a Dictionary (optional), arguments for corrupting each
+        cell on-the-fly (after caching) instead of `corrupt` a copy of the
+        data:
+          - 'omic' : which OMIC types are corrupted (default: the current
+            OMIC, or the first one of `omics`).
+          - 'dropout_rate', 'retain_rate', 'distribution' : the same as
+            `corrupt` (though each count is selected with probability
+            `dropout_rate` instead of exactly `dropout_rate` percent).
+          - 'fixed' : a Boolean (default=False). If False, a fresh corruption
+            is drawn for every epoch, otherwise, the corruption is a
+            deterministic function of `(seed, cell index)`, i.e. the same
+            corrupted batch is reconstructed on demand for evaluation.
+        The library size is computed from the original data.
+      pipeline : {'gather', 'slices'}.
+          - 'gather' : only the cell indices are shuffled and batched, then
+            each batch of rows is gathered from the (dense, sparse or
+            memory-mapped) storage, no copy of the data is kept by the
+            pipeline.
+          - 'slices' : the legacy pipeline, each OMIC is sliced by
+            `tf.data.Dataset.from_tensor_slices` (i.e. embedded in the
+            graph), then processed cell by cell.
+      sparse_batch : a Boolean. If True, the sparse OMICs are returned as
+        `tf.SparseTensor` batches (only for `pipeline='gather'`), so they
+        could be densified on device by `tf.sparse.to_dense` within the
+        training step.
+      framework : {'tensorflow', 'pytorch'}. If 'pytorch', return a
+        `torch.utils.data.DataLoader` (see `sisua.data.torch_dataset`) which
+        yields the same dictionary of `inputs`, `library` and `mask`.
+      num_workers : an Integer, number of loading processes, only for
+        `framework='pytorch'`.
     """
     if omics is None:
       omics = self.current_omic
     framework = str(framework).lower().strip()
     assert framework in ('tf', 'pt', 'tensorflow', 'pytorch'), \
       f"Only support tensorflow or pytorch framework, given: {framework}"
+    pipeline = str(pipeline).lower().strip()
+    assert pipeline in ('gather', 'slices'), \
+      f"Only support 'gather' or 'slices' pipeline, given: {pipeline}"
     if isinstance(omics, OMIC):
       omics = list(omics)
     omics = [OMIC.parse(o) for o in tf.nest.flatten(omics)]
@@ -568,27 +885,170 @@ class _OMICbase(sc.AnnData, MD5object):
     library = []
     for o in omics:
       library.append(np.concatenate(self.get_library_size(o), axis=-1))
-    # create the dataset
-    ds = [tf.data.Dataset.from_tensor_slices(i) for i in inputs] + \
-      [tf.data.Dataset.from_tensor_slices(i) for i in library]
-    if len(ds) > 0:
-      ds = tf.data.Dataset.zip(tuple(ds))
+    if framework in ('pt', 'pytorch'):
+      assert corruption is None, \
+        "On-the-fly corruption is only supported by tensorflow pipeline."
+      try:
+        from sisua.data.torch_dataset import create_dataloader
+      except ImportError:
+        raise ImportError("pip install torch")
+      return create_dataloader(inputs,
+                               library,
+                               labels_percent=labels_percent,
+                               batch_size=batch_size,
+                               drop_remainder=drop_remainder,
+                               shuffle=shuffle is not None and shuffle > 0,
+                               num_workers=num_workers,
+                               seed=seed)
+    if corruption is not None:
+      corruption = dict(corruption)
+      corrupt_omic = corruption.pop('omic', None)
+      if corrupt_omic is None:
+        corrupt_omic = self.current_omic \
+          if self.current_omic in omics else omics[0]
+      corrupt_omic = OMIC.parse(corrupt_omic)
+      corrupt_ids = [i for i, o in enumerate(omics) if o in corrupt_omic]
+      corrupt_fixed = bool(corruption.pop('fixed', False))
+      corrupt_kw = dict(dropout_rate=float(corruption.pop('dropout_rate',
+                                                          0.2)),
+                        retain_rate=float(corruption.pop('retain_rate', 0.2)),
+                        distribution=str(
+                            corruption.pop('distribution',
+                                           'binomial')).lower())
+      assert len(corruption) == 0, \
+        f"Unknown arguments for corruption: {list(corruption.keys())}"
+      assert corrupt_kw['distribution'] in ('binomial', 'uniform'), \
+        f"Unknown corruption distribution: {corrupt_kw['distribution']}"
     # for labels_percent
     labels_percent = np.clip(labels_percent, 0., 1.)
     if len(omics) == 1:
       labels_percent = 0.
     gen = tf.random.experimental.Generator.from_seed(seed=seed)
+    n_obs = self.n_obs
+
+    def row_seeds(index, i):
+      return tf.stack([[seed, 2 * index + 2 * n_obs * i],
+                       [seed, 2 * index + 2 * n_obs * i + 1]])
+
+    def corrupting(data, index):
+      inputs = tf.nest.flatten(data['inputs'])
+      for i in corrupt_ids:
+        x = inputs[i]
+        if corrupt_fixed:
+          x = tf.sparse.to_dense(x) if isinstance(x, tf.SparseTensor) else x
+          # a batch of cells, each has its own seeds
+          if index.shape.ndims == 1:
+            x = tf.map_fn(lambda a: _corrupt_tensor(a[0], row_seeds(a[1], i),
+                                                    **corrupt_kw), (x, index),
+                          dtype=x.dtype)
+          else:
+            x = _corrupt_tensor(x, row_seeds(index, i), **corrupt_kw)
+        else:
+          seeds = tf.transpose(gen.make_seeds(2))
+          # the corruption is element-wise, only the non-zeros are processed
+          if isinstance(x, tf.SparseTensor):
+            x = tf.SparseTensor(indices=x.indices,
+                                values=_corrupt_tensor(x.values, seeds,
+                                                       **corrupt_kw),
+                                dense_shape=x.dense_shape)
+          else:
+            x = _corrupt_tensor(x, seeds, **corrupt_kw)
+        inputs[i] = x
+      data['inputs'] = inputs[0] if len(inputs) == 1 else inputs
+      return data
+
+    def to_dict(inputs, library, mask):
+      return dict(inputs=inputs[0] if len(inputs) == 1 else inputs,
+                  library=library[0] if len(library) == 1 else library,
+                  mask=mask)
+
+    ###### gather batch of rows from the storage
+    if pipeline == 'gather':
+      arrays = inputs + library
+      n_features = [x.shape[1] for x in arrays]
+      is_sparse = [sparse.issparse(x) for x in arrays]
+      Tout = []
+      for s in is_sparse:
+        Tout += [tf.int64, tf.float32, tf.int64] if s else [tf.float32]
+
+      def read_rows(index):
+        # sorted indices for sequential read of the storage
+        index = np.sort(index)
+        return [index] + [
+            i for x in arrays for i in _gather_rows(x, index, np.float32)
+        ]
+
+      def gather(index):
+        outputs = tf.numpy_function(read_rows, [index], [tf.int64] + Tout)
+        index = outputs[0]
+        index.set_shape((None,))
+        outputs = outputs[1:]
+        data = []
+        for dim, s in zip(n_features, is_sparse):
+          if s:
+            indices, values, shape = outputs[:3]
+            outputs = outputs[3:]
+            indices.set_shape((None, 2))
+            values.set_shape((None,))
+            x = tf.SparseTensor(indices=indices,
+                                values=values,
+                                dense_shape=tf.reshape(shape, (2,)))
+            x = tf.sparse.reshape(x, (-1, dim))
+            if not sparse_batch:
+              x = tf.sparse.to_dense(x)
+          else:
+            x = outputs[0]
+            outputs = outputs[1:]
+            x.set_shape((None, dim))
+          data.append(x)
+        n = tf.shape(index)[0]
+        if labels_percent == 0.:
+          mask = tf.zeros(shape=(n,), dtype=tf.bool)
+        else:
+          mask = gen.uniform(shape=(n, 1)) < labels_percent
+        data = to_dict(data[:len(omics)], data[len(omics):], mask)
+        if corruption is not None:
+          data = corrupting(data, index)
+        return data
+
+      ds = tf.data.Dataset.range(n_obs)
+      # shuffling the indices is cheap, the whole dataset is reshuffled
+      if shuffle is not None and shuffle > 0:
+        ds = ds.shuffle(n_obs, seed=seed, reshuffle_each_iteration=True)
+      ds = ds.batch(batch_size, drop_remainder)
+      ds = ds.map(gather, tf.data.experimental.AUTOTUNE)
+      ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+      return ds
+
+    ###### legacy: slices of cells
+    ds = [_tensor_slices(i) for i in inputs] + \
+      [_tensor_slices(i) for i in library]
+    if cache == '' and any(_is_memmap(i) for i in inputs):
+      cache = None
+    if corruption is not None:
+      ds.append(tf.data.Dataset.range(n_obs))
+    if len(ds) > 0:
+      ds = tf.data.Dataset.zip(tuple(ds))
 
     def masking(*data):
+      if corruption is not None:
+        index = data[-1]
+        data = data[:-1]
+      data = [
+          tf.sparse.to_dense(i) if isinstance(i, tf.SparseTensor) else i
+          for i in data
+      ]
+      data = [
+          i if i.dtype.is_floating else tf.cast(i, tf.float32) for i in data
+      ]
       if labels_percent == 0.:
         mask = False
       else:
         mask = gen.uniform(shape=(1,)) < labels_percent
-      inputs = data[:len(omics)]
-      library = data[len(omics):]
-      return dict(inputs=inputs[0] if len(inputs) == 1 else inputs,
-                  library=library[0] if len(library) == 1 else library,
-                  mask=mask)
+      data = to_dict(data[:len(omics)], data[len(omics):], mask)
+      if corruption is not None:
+        return data, index
+      return data
 
     ds = ds.map(masking, tf.data.experimental.AUTOTUNE)
     # post processing
@@ -597,10 +1057,32 @@ class _OMICbase(sc.AnnData, MD5object):
     # shuffle must be called after cache
     if shuffle is not None and shuffle > 0:
       ds = ds.shuffle(int(shuffle))
+    # corruption must be applied after cache
+    if corruption is not None:
+      ds = ds.map(corrupting, tf.data.experimental.AUTOTUNE)
     ds = ds.batch(batch_size, drop_remainder)
     ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
     return ds
 
+  def benchmark_dataset(self, n_batches=100, verbose=True, **kwargs) -> float:
+    r""" Iterate `n_batches` of the dataset returned by
+    `create_dataset(**kwargs)` and return the throughput in samples/second,
+    the first batch (i.e. the pipeline warm-up) is not timed. """
+    ds = iter(self.create_dataset(**kwargs))
+    next(ds)
+    n_samples = 0
+    start = time.perf_counter()
+    for _, data in zip(range(int(n_batches)), ds):
+      x = tf.nest.flatten(data['inputs'])[0]
+      n_samples += int(x.dense_shape[0] if isinstance(x, tf.SparseTensor) \
+        else x.shape[0])
+    duration = time.perf_counter() - start
+    throughput = n_samples / max(duration, 1e-8)
+    if verbose:
+      print(f"{self.name}: {n_samples} samples in {duration:.2f}s "
+            f"({throughput:.2f} samples/sec)")
+    return throughput
+
   def _get_str(self):
     text = super().__repr__()
     text = text.replace('AnnData object', self.name)
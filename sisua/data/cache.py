@@ -0,0 +1,145 @@
+r""" Binary snapshot of the preprocessed `SingleCellOMIC` returned by
+`get_dataset`, a warm load simply memory-maps the stored arrays (zero-copy).
+
+A snapshot is keyed by the dataset name, the arguments of its loader and the
+version of sisua, and it is invalidated when the MD5 of any raw file used for
+building the dataset changes.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import pickle
+import shutil
+from functools import partial
+from hashlib import md5
+
+from odin.utils.crypto import md5_checksum
+from sisua.data.path import DATA_DIR
+
+__all__ = [
+    'CACHE_DIR',
+    'get_snapshot_path',
+    'read_snapshot',
+    'write_snapshot',
+    'remove_snapshot',
+]
+
+CACHE_DIR = os.path.join(DATA_DIR, 'snapshots')
+_FINGERPRINT = 'fingerprint'
+_STORE = 'store'
+
+
+# ===========================================================================
+# Helpers
+# ===========================================================================
+def _loader_signature(loader) -> str:
+  args = []
+  while isinstance(loader, partial):
+    args.append((loader.args, sorted(loader.keywords.items())))
+    loader = loader.func
+  name = f"{getattr(loader, '__module__', '')}." \
+    f"{getattr(loader, '__qualname__', str(loader))}"
+  return f"{name}{args}"
+
+
+def _file_stat(path):
+  st = os.stat(path)
+  return (st.st_size, st.st_mtime_ns)
+
+
+def _check_file_stats(files: dict, root='', full=False, missing_ok=False):
+  r""" Validate the files recorded as `{name: ((size, mtime), md5)}` (relative
+  to `root`), the MD5 of a file is only recomputed if its size or modification
+  time changed (or `full=True`), the new stat of an unchanged file is updated
+  inplace.
+
+  Return:
+    (valid, updated) : whether all files are unchanged, and whether `files`
+      was updated
+  """
+  updated = False
+  for name, (stat, md5_file) in list(files.items()):
+    path = os.path.join(root, name)
+    if not os.path.exists(path):
+      if missing_ok:
+        continue
+      return False, updated
+    new_stat = _file_stat(path)
+    if not full and new_stat == stat:
+      continue
+    if md5_checksum(path) != md5_file:
+      return False, updated
+    if new_stat != stat:
+      files[name] = (new_stat, md5_file)
+      updated = True
+  return True, updated
+
+
+def _is_valid(fingerprint: dict, path: str) -> bool:
+  # the raw file could be removed (e.g. for saving space), the snapshot is
+  # self-contained and still valid
+  valid, updated = _check_file_stats(fingerprint, missing_ok=True)
+  if valid and updated:
+    with open(os.path.join(path, _FINGERPRINT), 'wb') as f:
+      pickle.dump(fingerprint, f)
+  return valid
+
+
+# ===========================================================================
+# Main
+# ===========================================================================
+def get_snapshot_path(dataset_name: str, loader) -> str:
+  r""" Path to the snapshot of given dataset created by given loader """
+  from sisua import __version__
+  key = md5(f"{dataset_name}|{_loader_signature(loader)}|{__version__}".encode(
+      'utf-8')).hexdigest()
+  return os.path.join(CACHE_DIR, f"{dataset_name}_{key}")
+
+
+def remove_snapshot(path: str):
+  if os.path.exists(path):
+    shutil.rmtree(path)
+
+
+def read_snapshot(path: str, verbose=False):
+  r""" Return the memory-mapped `SingleCellOMIC` or None if the snapshot does
+  not exist or is invalidated (the invalidated snapshot is removed). """
+  from sisua.data.single_cell_dataset import SingleCellOMIC
+  fingerprint = os.path.join(path, _FINGERPRINT)
+  if not os.path.isfile(fingerprint):
+    return None
+  with open(fingerprint, 'rb') as f:
+    fingerprint = pickle.load(f)
+  if not _is_valid(fingerprint, path):
+    if verbose:
+      print(f"Raw data of snapshot {path} changed, remove and rebuild!")
+    remove_snapshot(path)
+    return None
+  return SingleCellOMIC.open(os.path.join(path, _STORE), mode='r')
+
+
+def write_snapshot(path: str, sco, raw_files=()) -> str:
+  r""" Save the `SingleCellOMIC` and the fingerprint of its raw files, the
+  snapshot is written to a temporary folder then renamed, so concurrent
+  processes never read a partial snapshot. """
+  fingerprint = {
+      raw: (_file_stat(raw), md5_checksum(raw))
+      for raw in sorted(raw_files)
+      if os.path.isfile(raw)
+  }
+  tmp_path = f"{path}.tmp{os.getpid()}"
+  remove_snapshot(tmp_path)
+  os.makedirs(tmp_path)
+  sco.save(os.path.join(tmp_path, _STORE))
+  with open(os.path.join(tmp_path, _FINGERPRINT), 'wb') as f:
+    pickle.dump(fingerprint, f)
+  # a folder without fingerprint is an invalid snapshot (e.g. interrupted
+  # removal), it cannot be replaced by `os.rename`
+  if os.path.exists(path) and \
+    not os.path.isfile(os.path.join(path, _FINGERPRINT)):
+    remove_snapshot(path)
+  try:
+    os.rename(tmp_path, path)
+  except OSError:  # written by other process
+    remove_snapshot(tmp_path)
+  return path
@@ -0,0 +1,261 @@
+from __future__ import absolute_import, division, print_function
+
+from typing import Optional, Tuple, Union
+
+import numpy as np
+from scipy import sparse
+from scipy.stats import rankdata
+from six import string_types
+
+__all__ = ['correlation_matrix', 'paired_correlation']
+
+_METHODS = ('pearson', 'spearman')
+# default memory budget (in MB) for caching the standardized blocks of `x2`
+_CACHE_MEMORY = 1024
+
+
+# ===========================================================================
+# Helpers
+# ===========================================================================
+def _dense_columns(x, start, end, dtype) -> np.ndarray:
+  x = x[:, start:end]
+  if sparse.issparse(x):
+    x = x.toarray()
+  return np.array(x, dtype=dtype)
+
+
+def _rank(x: np.ndarray) -> np.ndarray:
+  r""" Rank each column (average rank for ties), NaNs are kept as NaNs and
+  ignored while ranking """
+  nans = np.isnan(x)
+  if not np.any(nans):
+    return rankdata(x, axis=0).astype(x.dtype, copy=False)
+  ranks = np.full_like(x, np.nan)
+  for i, (col, mask) in enumerate(zip(x.T, ~nans.T)):
+    ranks[mask, i] = rankdata(col[mask])
+  return ranks
+
+
+class _Standardized(object):
+  r""" Column-standardized (and optionally ranked) block, the columns are
+  centered and scaled to unit norm, so the Pearson correlation between two
+  blocks is a single matrix product. """
+
+  def __init__(self, x: np.ndarray, rank: bool):
+    if rank:
+      x = _rank(x)
+    self.mask = ~np.isnan(x)
+    self.has_nan = not np.all(self.mask)
+    if self.has_nan:
+      # only center for numerical stability, the scaling depends on the
+      # pairwise-complete observations
+      x = x - np.nanmean(x, axis=0, keepdims=True)
+      x[~self.mask] = 0.
+      self.mask = self.mask.astype(x.dtype)
+    else:
+      x = x - np.mean(x, axis=0, keepdims=True)
+      with np.errstate(divide='ignore', invalid='ignore'):
+        x /= np.sqrt(np.sum(x**2, axis=0, keepdims=True))
+    self.x = x
+
+  @property
+  def nbytes(self):
+    return self.x.nbytes + self.mask.nbytes
+
+
+def _standardize(x, start, end, ranks, dtype) -> dict:
+  r""" Mapping `rank -> _Standardized` of the columns `[start, end)` """
+  block = _dense_columns(x, start, end, dtype)
+  return {r: _Standardized(block, rank=r) for r in ranks}
+
+
+def _block_corr(a: _Standardized, b: _Standardized) -> np.ndarray:
+  if not (a.has_nan or b.has_nan):
+    return np.dot(a.x.T, b.x)
+  ma = a.mask if a.has_nan else np.ones_like(a.x)
+  mb = b.mask if b.has_nan else np.ones_like(b.x)
+  # pairwise-complete observations (a and b are zeros for missing values)
+  n = np.dot(ma.T, mb)
+  sa = np.dot(a.x.T, mb)
+  sb = np.dot(ma.T, b.x)
+  saa = np.dot((a.x**2).T, mb)
+  sbb = np.dot(ma.T, b.x**2)
+  sab = np.dot(a.x.T, b.x)
+  cov = sab - sa * sb / n
+  var_a = saa - sa**2 / n
+  var_b = sbb - sb**2 / n
+  return cov / np.sqrt(var_a * var_b)
+
+
+def _paired_corr(a: _Standardized, b: _Standardized) -> np.ndarray:
+  r""" The same as `np.diag(_block_corr(a, b))` without the matrix product """
+  if not (a.has_nan or b.has_nan):
+    return np.sum(a.x * b.x, axis=0)
+  ma = a.mask if a.has_nan else np.ones_like(a.x)
+  mb = b.mask if b.has_nan else np.ones_like(b.x)
+  n = np.sum(ma * mb, axis=0)
+  sa = np.sum(a.x * mb, axis=0)
+  sb = np.sum(ma * b.x, axis=0)
+  saa = np.sum(a.x**2 * mb, axis=0)
+  sbb = np.sum(ma * b.x**2, axis=0)
+  sab = np.sum(a.x * b.x, axis=0)
+  cov = sab - sa * sb / n
+  var_a = saa - sa**2 / n
+  var_b = sbb - sb**2 / n
+  return cov / np.sqrt(var_a * var_b)
+
+
+# ===========================================================================
+# Main
+# ===========================================================================
+def correlation_matrix(
+    x1: Union[np.ndarray, sparse.spmatrix],
+    x2: Union[np.ndarray, sparse.spmatrix] = None,
+    method: Union[str, Tuple[str, ...]] = 'pearson',
+    block_size: int = 256,
+    dtype: Union[str, np.dtype] = 'float64',
+    max_memory: Optional[float] = None
+) -> Union[np.ndarray, Tuple[np.ndarray, ...]]:
+  r""" Correlation matrix of shape `[x1.shape[1], x2.shape[1]]` between all
+  pairs of columns, computed in blocks of `block_size` columns, so only
+  `n_samples * block_size` values of each input are densified at a time.
+
+  All requested methods share the same pass over the data: each block is
+  (rank-transformed then) standardized once and the correlation is a matrix
+  product of the standardized blocks.
+
+  Arguments:
+    x1 : a matrix `[n_samples, n_features1]`, dense, sparse or memory-mapped.
+    x2 : a matrix `[n_samples, n_features2]`, if None, pairwise correlation
+      of `x1` columns is returned.
+    method : {'pearson', 'spearman'} or tuple of them.
+    block_size : an Integer, number of columns processed at a time.
+    dtype : {'float64', 'float32'}, precision of the computation and the
+      outputs, float32 halves the memory and is faster for large matrices.
+    max_memory : a Scalar (in MB). If given, `block_size` is the largest
+      number of columns that keeps the standardized blocks and their
+      temporaries within the budget (the outputs are not counted). The
+      standardized blocks of `x2` are cached within the same budget (1024MB
+      if not given), so each block is ranked and standardized only once,
+      the blocks exceeding the budget are recomputed for each block of `x1`.
+
+  Return:
+    a matrix or tuple of matrices (in the same order as `method`).
+
+  Note:
+    NaNs are omitted pairwise (i.e. the same as `nan_policy='omit'`), the
+    ranks for Spearman are computed on all non-NaN values of each column.
+    Constant column results NaN correlation.
+  """
+  return_tuple = not isinstance(method, string_types)
+  methods = [str(m).lower().strip() for m in np.atleast_1d(method)]
+  for m in methods:
+    assert m in _METHODS, \
+      f"Only support correlation methods: {_METHODS}, given: {m}"
+  symmetric = x2 is None or x2 is x1
+  if symmetric:
+    x2 = x1
+  assert x1.shape[0] == x2.shape[0], \
+    f"Number of samples mismatch {x1.shape[0]} and {x2.shape[0]}"
+  # column slicing is efficient for CSC
+  if sparse.issparse(x1):
+    x1 = x1.tocsc()
+  if sparse.issparse(x2):
+    x2 = x1 if symmetric else x2.tocsc()
+  n1 = x1.shape[1]
+  n2 = x2.shape[1]
+  dtype = np.dtype(dtype)
+  ranks = sorted(set(m == 'spearman' for m in methods))
+  if max_memory is not None:
+    # two standardized blocks per rank type, each block needs up to 4 arrays
+    # of [n_samples, block_size] (data, mask and the NaN temporaries)
+    bytes_per_column = x1.shape[0] * dtype.itemsize * 4 * 2 * len(ranks)
+    block_size = int(max_memory * 1024**2 // bytes_per_column)
+  block_size = max(1, int(block_size))
+  outputs = {m: np.empty(shape=(n1, n2), dtype=dtype) for m in methods}
+  cache = {}
+  cache_bytes = 0
+  cache_budget = (_CACHE_MEMORY if max_memory is None else max_memory) * 1024**2
+  for s1 in range(0, n1, block_size):
+    e1 = min(s1 + block_size, n1)
+    # in the symmetric case, the cached block is not used anymore
+    if symmetric and s1 in cache:
+      std1 = cache.pop(s1)
+      cache_bytes -= sum(i.nbytes for i in std1.values())
+    else:
+      std1 = _standardize(x1, s1, e1, ranks, dtype)
+    for s2 in range(s1 if symmetric else 0, n2, block_size):
+      e2 = min(s2 + block_size, n2)
+      if symmetric and s1 == s2:
+        std2 = std1
+      elif s2 in cache:
+        std2 = cache[s2]
+      else:
+        std2 = _standardize(x2, s2, e2, ranks, dtype)
+        nbytes = sum(i.nbytes for i in std2.values())
+        if cache_bytes + nbytes <= cache_budget:
+          cache[s2] = std2
+          cache_bytes += nbytes
+      for m in methods:
+        r = m == 'spearman'
+        with np.errstate(divide='ignore', invalid='ignore'):
+          corr = np.clip(_block_corr(std1[r], std2[r]), -1., 1.)
+        outputs[m][s1:e1, s2:e2] = corr
+        if symmetric:
+          outputs[m][s2:e2, s1:e1] = corr.T
+  outputs = tuple(outputs[m] for m in methods)
+  return outputs if return_tuple else outputs[0]
+
+
+def paired_correlation(
+    x1: Union[np.ndarray, sparse.spmatrix],
+    x2: Union[np.ndarray, sparse.spmatrix],
+    method: Union[str, Tuple[str, ...]] = 'pearson',
+    block_size: int = 256,
+    dtype: Union[str, np.dtype] = 'float64',
+) -> Union[np.ndarray, Tuple[np.ndarray, ...]]:
+  r""" Correlation between the paired columns `x1[:, i]` and `x2[:, i]`,
+  i.e. the diagonal of `correlation_matrix(x1, x2)` without computing the
+  off-diagonal entries.
+
+  Arguments:
+    x1 : a matrix `[n_samples, n_features]`, dense, sparse or memory-mapped.
+    x2 : a matrix `[n_samples, n_features]`.
+    method : {'pearson', 'spearman'} or tuple of them.
+    block_size : an Integer, number of column pairs processed at a time.
+    dtype : {'float64', 'float32'}, precision of the computation and the
+      outputs.
+
+  Return:
+    a vector `[n_features]` or tuple of vectors (in the same order as
+    `method`).
+  """
+  return_tuple = not isinstance(method, string_types)
+  methods = [str(m).lower().strip() for m in np.atleast_1d(method)]
+  for m in methods:
+    assert m in _METHODS, \
+      f"Only support correlation methods: {_METHODS}, given: {m}"
+  assert x1.shape == x2.shape, \
+    f"Paired columns require the same shape, given {x1.shape} and {x2.shape}"
+  if sparse.issparse(x1):
+    x1 = x1.tocsc()
+  if sparse.issparse(x2):
+    x2 = x2.tocsc()
+  n = x1.shape[1]
+  dtype = np.dtype(dtype)
+  block_size = max(1, int(block_size))
+  outputs = {m: np.empty(shape=(n,), dtype=dtype) for m in methods}
+  for s in range(0, n, block_size):
+    e = min(s + block_size, n)
+    block1 = _dense_columns(x1, s, e, dtype)
+    block2 = _dense_columns(x2, s, e, dtype)
+    for r in sorted(set(m == 'spearman' for m in methods)):
+      std1 = _Standardized(block1, rank=r)
+      std2 = _Standardized(block2, rank=r)
+      with np.errstate(divide='ignore', invalid='ignore'):
+        corr = np.clip(_paired_corr(std1, std2), -1., 1.)
+      for m in methods:
+        if (m == 'spearman') == r:
+          outputs[m][s:e] = corr
+  outputs = tuple(outputs[m] for m in methods)
+  return outputs if return_tuple else outputs[0]
@@ -6,7 +6,6 @@ import gzip
 import os
 import pickle
 import shutil
-from urllib.request import urlretrieve
 
 import numpy as np
 
@@ -16,7 +15,8 @@ from odin.stats import describe
 from odin.utils import batching, one_hot, select_path
 from odin.utils.crypto import decrypt_aes, md5_checksum
 from sisua.data.path import DATA_DIR, DOWNLOAD_DIR
-from sisua.data.utils import remove_allzeros_columns, save_to_dataset
+from sisua.data.utils import (download_file, remove_allzeros_columns,
+                              save_to_dataset)
 
 path = "/home/trung/bio_data/downloads/SuperCentenarian_original/01.UMI.txt.gz"
 
@@ -71,22 +71,6 @@ def read_gzip_csv(path):
   return data, cell_id, gene_id
 
 
-def download_file(url, outpath):
-  from tqdm import tqdm
-  prog = [None]
-
-  def _progress(blocknum, blocksize, size):
-    if prog[0] is None:
-      prog[0] = tqdm(desc=f"Downloading {os.path.basename(url)}",
-                     total=int(size / 1024.) + 1,
-                     unit='kB')
-    prog[0].update(int(blocknum * blocksize / 1024.) - prog[0].n)
-
-  urlretrieve(url=url, filename=outpath, reporthook=_progress)
-  prog[0].clear()
-  prog[0].close()
-
-
 # ===========================================================================
 # Main
 # ===========================================================================
@@ -109,8 +93,9 @@ def read_centenarian(override=False, verbose=False):
   # ******************** preprocessed ******************** #
   if not os.path.exists(os.path.join(preprocessed_path, 'X')):
     labels = download_file(
-        outpath=os.path.join(download_path, os.path.basename(_URL[2])),
         url=_URL[2],
+        filename=os.path.join(download_path, os.path.basename(_URL[2])),
+        override=False,
     )
     data = []
     with gzip.open(labels, mode='rb') as f:
@@ -125,16 +110,18 @@ def read_centenarian(override=False, verbose=False):
     y_col = np.array(y_col)
     #
     raw = download_file(
-        outpath=os.path.join(download_path, os.path.basename(_URL[0])),
         url=_URL[0],
+        filename=os.path.join(download_path, os.path.basename(_URL[0])),
+        override=False,
     )
     if verbose:
       print("Unzip and reading raw UMI ...")
     X_raw, cell_id1, gene_id1 = read_gzip_csv(raw)
     #
     norm = download_file(
-        outpath=os.path.join(download_path, os.path.basename(_URL[1])),
         url=_URL[1],
+        filename=os.path.join(download_path, os.path.basename(_URL[1])),
+        override=False,
     )
     if verbose:
       print("Unzip and reading log-norm UMI ...")
@@ -4,19 +4,21 @@ import shutil
 from collections import defaultdict
 
 import numpy as np
-import scanpy as sc
-from bigarray import MmapArray, MmapArrayWriter
-from scipy.io import mmread
+from scipy import sparse
 
-from odin.utils import md5_checksum, md5_folder, one_hot
+from odin.utils import one_hot
 from sisua.data.const import MARKER_GENES
+from sisua.data.data_loader.dataset10x import _read_mtx
 from sisua.data.path import DATA_DIR
 from sisua.data.single_cell_dataset import SingleCellOMIC
-from sisua.data.utils import read_compressed, validate_data_dir
+from sisua.data.sparse_mmap import SparseMmapWriter, read_sparse_mmap
+from sisua.data.utils import (dispersion_gene_subset, read_compressed,
+                              validate_data_dir, write_manifest)
 
 _URL = r"https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc=GSE132509"
 _MD5_DOWNLOAD = r"1f22e169d590def62e0992d19fe45ba7"
-_MD5_PREPROCESSED = r"00a636e37204da4244415140ebe146e8"
+# the preprocessed folder is only validated by its manifest
+_MD5_PREPROCESSED = r""
 _NAME = 'leukemia_bmmc'
 
 __all__ = ['read_leukemia_BMMC']
@@ -40,7 +42,8 @@ def _create_sco(X, rowname, colname, labels, filtered_genes):
                        gene_id=colname,
                        name=f"cALL{'' if filtered_genes else 'all'}")
   mito = [i for i, gene in enumerate(sco.var_names) if 'MT' == gene[:2]]
-  percent_mito = np.sum(sco.X[:, mito], axis=1) / np.sum(sco.X, axis=1)
+  percent_mito = np.asarray(np.sum(sco.X[:, mito], axis=1)).ravel() / \
+    np.asarray(np.sum(sco.X, axis=1)).ravel()
   sco.obs['percent_mito'] = percent_mito
   # add another omic for labels
   if labels is not None:
@@ -54,6 +57,33 @@ def _create_sco(X, rowname, colname, labels, filtered_genes):
   return sco
 
 
+def _unique_genes(colname) -> np.ndarray:
+  r""" Indices of the gene names that appear only once, all duplicated
+  names are dropped (the same as `SingleCellOMIC(duplicated_var=False)`) """
+  colname = np.asarray(colname)
+  u, c = np.unique(colname, return_counts=True)
+  return np.where(~np.isin(colname, u[c > 1]))[0]
+
+
+def _normalized_moments(X, cells, genes, target_sum=1e4, batch_size=4096):
+  r""" Per-gene mean and variance (`ddof=1`) of the selected cells and genes
+  after `normalize_total(target_sum)`, accumulated `batch_size` cells at a
+  time from the memory-mapped CSR `X`. """
+  s1 = np.zeros((len(genes),), dtype=np.float64)
+  s2 = np.zeros((len(genes),), dtype=np.float64)
+  for s in range(0, len(cells), batch_size):
+    x = X[cells[s:s + batch_size]][:, genes].astype(np.float64)
+    total = np.asarray(x.sum(axis=1)).ravel()
+    total[total == 0] = 1.
+    x = sparse.diags(target_sum / total).dot(x)
+    s1 += np.asarray(x.sum(axis=0)).ravel()
+    s2 += np.asarray(x.multiply(x).sum(axis=0)).ravel()
+  n = len(cells)
+  mean = s1 / n
+  var = (s2 / n - mean**2) * (n / (n - 1))
+  return mean, var
+
+
 def read_leukemia_BMMC(path='~/bio_data/downloads/GSE132509_RAW.tar',
                        filtered_genes=True,
                        override=False,
@@ -93,41 +123,58 @@ def read_leukemia_BMMC(path='~/bio_data/downloads/GSE132509_RAW.tar',
       name = name.split('_')
       name = '_'.join(name[1:])
       data_name[name][feat] = data
-    ## preprocess the data
+    ## preprocess the data, one sample in memory at a time
     if len(os.listdir(preprocessed_path)) == 0:
-      data = []
       labels = []
       rowname = []
+      colname = None
       for k, v in sorted(data_name.items()):
-        barcodes = np.array([str(i, 'utf-8').strip() for i in v['barcodes']],
-                            dtype=str)
+        rowname.append(
+            np.array([str(i, 'utf-8').strip() for i in v['barcodes']],
+                     dtype=str))
+        labels.append(np.array([k] * len(rowname[-1])))
         # gene_id, gene_name
         genes = np.array(
             [str(i, 'utf-8').strip().split('\t') for i in v['genes']],
             dtype=str)[:, 1]
-        # transpose to cell-gene
-        matrix = mmread(v['matrix']).T
-        labels.append(np.array([k] * matrix.shape[0]))
-        rowname.append(barcodes)
-        # convert data to np.uint16, max value is 9810
-        matrix = np.asarray(matrix.astype(np.uint16).todense())
-        data.append(matrix)
-        if verbose:
-          print(f"Read {k} {type(matrix)} {matrix.shape} {matrix.dtype}",
-                f"max:{np.max(matrix)} min:{np.min(matrix)}")
+        if colname is None:
+          colname = genes
+        assert np.all(colname == genes), \
+          f"Genes of sample {k} mismatch the other samples"
+      # the duplicated gene names are excluded from the filtering and the
+      # selection (the store keeps all genes)
+      unique_genes = _unique_genes(colname)
+      mito = np.array([gene[:2] == 'MT' for gene in colname[unique_genes]])
+      n_cells = np.zeros((len(unique_genes),), dtype=np.int64)
+      selected_cells = []
+      with SparseMmapWriter(os.path.join(preprocessed_path, 'X'),
+                            n_features=len(colname),
+                            dtype=np.uint16,
+                            remove_exist=True) as writer:
+        for (k, v), barcodes in zip(sorted(data_name.items()), rowname):
+          # cell-gene CSR, np.uint16 (max value is 9810)
+          matrix = _read_mtx(v['matrix'])
+          matrix.eliminate_zeros()
+          assert matrix.shape == (len(barcodes), len(colname))
+          writer.write(matrix)
+          matrix = matrix[:, unique_genes]
+          # cells filtering: percent_mito <= 0.08 and min_genes=200
+          total = np.asarray(matrix.sum(axis=1), dtype=np.float64).ravel()
+          with np.errstate(divide='ignore', invalid='ignore'):
+            percent_mito = np.asarray(matrix[:, mito].sum(axis=1),
+                                      dtype=np.float64).ravel() / total
+          keep = (percent_mito <= 0.08) & (matrix.getnnz(axis=1) >= 200)
+          selected_cells.append(keep)
+          n_cells += matrix[keep].getnnz(axis=0)
+          if verbose:
+            print(f"Read {k} {matrix.shape} {matrix.dtype} "
+                  f"max:{matrix.max()} min:{matrix.min()}")
+          del matrix
       # final data
-      colname = genes
       rowname = np.concatenate(rowname, axis=0)
       labels = np.concatenate(labels, axis=0)
-      data = np.concatenate(data, axis=0)
-      assert labels.shape[0] == rowname.shape[0]
-      assert data.shape[1] == colname.shape[0]
-      assert data.shape[0] == rowname.shape[0]
-      with MmapArrayWriter(os.path.join(preprocessed_path, 'X'),
-                           shape=(0, data.shape[1]),
-                           dtype=np.uint16,
-                           remove_exist=True) as f:
-        f.write(data)
+      selected_cells = np.where(np.concatenate(selected_cells, axis=0))[0]
+      assert labels.shape[0] == rowname.shape[0] == writer.shape[0]
       for name, x in [
           ('colname', colname),
           ('rowname', rowname),
@@ -135,41 +182,39 @@ def read_leukemia_BMMC(path='~/bio_data/downloads/GSE132509_RAW.tar',
       ]:
         with open(os.path.join(preprocessed_path, name), 'wb') as f:
           pickle.dump(x, f)
-      # extract variables genes
-      sco = _create_sco(data.astype(np.float32), rowname, colname, labels,
-                        False)
-      ids = sco.obs['percent_mito'] <= 0.08
-      sco = sco[ids]
-      sc.pp.filter_cells(sco, min_genes=200)
-      sc.pp.filter_genes(sco, min_cells=3)
-      sc.pp.normalize_total(sco, target_sum=1e4)
-      result = sc.pp.filter_genes_dispersion(sco.X,
-                                             min_mean=0.0125,
-                                             max_mean=3,
-                                             min_disp=0.5,
-                                             log=False,
-                                             n_top_genes=2000)
+      # extract variables genes: filter_genes(min_cells=3),
+      # normalize_total(target_sum=1e4), filter_genes_dispersion
+      selected_genes = unique_genes[n_cells >= 3]
+      mean, var = _normalized_moments(
+          read_sparse_mmap(os.path.join(preprocessed_path, 'X')),
+          cells=selected_cells,
+          genes=selected_genes)
+      gene_subset = dispersion_gene_subset(mean,
+                                           var,
+                                           n_top_genes=2000,
+                                           min_mean=0.0125,
+                                           max_mean=3,
+                                           min_disp=0.5)
       # make sure all marker genes are included
-      gene_subset = result.gene_subset
-      gene_indices = sco.get_var_indices()
+      gene_indices = {j: i for i, j in enumerate(colname[selected_genes])}
       for gene in MARKER_GENES:
         idx = gene_indices.get(gene, None)
         if idx is not None:
           gene_subset[idx] = True
-      sco._inplace_subset_var(gene_subset)
+      top_genes = colname[selected_genes][gene_subset]
+      top_cells = rowname[selected_cells]
       if verbose:
-        print(f"Filtered {len(sco.obs.index.values)} cells and "
-              f"{len(sco.var_names.values)} genes.")
+        print(f"Filtered {len(top_cells)} cells and {len(top_genes)} genes.")
       with open(os.path.join(preprocessed_path, 'top_genes'), 'wb') as f:
-        pickle.dump(sco.var_names.values, f)
+        pickle.dump(top_genes, f)
       with open(os.path.join(preprocessed_path, 'top_cells'), 'wb') as f:
-        pickle.dump(sco.obs.index.values, f)
-      del sco
+        pickle.dump(top_cells, f)
       # md5
+      md5 = write_manifest(preprocessed_path)
       if verbose:
-        print(f"Finish preprocessing: MD5='{md5_folder(preprocessed_path)}'")
+        print(f"Finish preprocessing: MD5='{md5}'")
   ### create the data set
-  X = MmapArray(os.path.join(preprocessed_path, 'X')).astype(np.float32)
+  X = read_sparse_mmap(os.path.join(preprocessed_path, 'X'))
   colname = pickle.load(open(os.path.join(preprocessed_path, 'colname'), 'rb'))
   rowname = pickle.load(open(os.path.join(preprocessed_path, 'rowname'), 'rb'))
   labels = pickle.load(open(os.path.join(preprocessed_path, 'labels'), 'rb'))
@@ -187,4 +232,6 @@ def read_leukemia_BMMC(path='~/bio_data/downloads/GSE132509_RAW.tar',
     ids = [colids[i] for i in genes]
     X = X[:, ids]
     colname = colname[ids]
+  # only the selected cells and genes are casted (the store is np.uint16)
+  X = X.astype(np.float32)
   return _create_sco(X, rowname, colname, labels, filtered_genes)
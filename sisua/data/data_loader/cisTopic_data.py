@@ -2,7 +2,6 @@ import os
 import pickle
 import shutil
 from collections import defaultdict
-from urllib.request import urlretrieve
 
 import numpy as np
 from scipy import sparse
@@ -11,7 +10,8 @@ from odin.utils import md5_checksum, md5_folder, one_hot
 from sisua.data.const import MARKER_GENES, OMIC
 from sisua.data.path import DATA_DIR, DOWNLOAD_DIR
 from sisua.data.single_cell_dataset import SingleCellOMIC
-from sisua.data.utils import read_compressed, validate_data_dir
+from sisua.data.utils import (download_file, read_compressed,
+                              validate_data_dir)
 
 _URL = [
     r"https://github.com/aertslab/cisTopic/raw/3394de3fb57ba5a4e6ab557c7e948e98289ded2c/data/counts_mel.RData",
@@ -46,10 +46,7 @@ def read_melanoma_cisTopicData(filtered_genes=True,
   for url in _URL:
     fname = os.path.basename(url)
     fpath = os.path.join(download_dir, fname)
-    if not os.path.exists(fpath):
-      if verbose:
-        print(f"Downloading file: {fname} ...")
-      urlretrieve(url, filename=fpath)
+    download_file(url=url, filename=fpath, override=False, verbose=verbose)
     data[fname.split(".")[0]] = fpath
   ### preprocess data
   if len(os.listdir(preprocessed_path)) == 0:
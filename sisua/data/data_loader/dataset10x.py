@@ -11,13 +11,17 @@
 # https://support.10xgenomics.com/single-cell-gene-expression/software/pipelines/latest/output/matrices
 from __future__ import absolute_import, division, print_function
 
+import csv
 import gzip
+import io
 import os
 import pickle
 import shutil
 import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Tuple
-from urllib.request import urlretrieve
 
 import numpy as np
 import pandas as pd
@@ -32,6 +36,8 @@ from odin.utils import MPI, batching, ctext, is_gzip_file, select_path
 from sisua.data.const import MARKER_ATAC, MARKER_GENES, OMIC
 from sisua.data.path import DATA_DIR, DOWNLOAD_DIR
 from sisua.data.single_cell_dataset import SingleCellOMIC
+from sisua.data.sparse_mmap import (SparseMmapWriter, is_sparse_mmap,
+                                    read_sparse_mmap)
 from sisua.data.utils import (download_file, remove_allzeros_columns,
                               save_to_dataset, standardize_protein_name)
 
@@ -154,8 +160,91 @@ available_specification = ["filtered", "raw"]
 # ===========================================================================
 # Helpers
 # ===========================================================================
+def _read_table(data, sep) -> np.ndarray:
+  r""" Bulk read a delimited text file into a string matrix using the pandas
+  C parser (streamed from the file object) """
+  table = pd.read_csv(data,
+                      sep=sep,
+                      header=None,
+                      dtype=str,
+                      engine='c',
+                      quoting=csv.QUOTE_NONE,
+                      na_filter=False)
+  return table.values.astype(str)
+
+
+def _parse_mtx_chunk(chunk, value_dtype) -> Tuple[np.ndarray, ...]:
+  table = pd.read_csv(io.BytesIO(chunk),
+                      sep=' ',
+                      header=None,
+                      engine='c',
+                      dtype={
+                          0: np.int32,
+                          1: np.int32,
+                          2: value_dtype
+                      },
+                      na_filter=False)
+  return (table[0].values, table[1].values, table[2].values)
+
+
+def _read_mtx(data, n_threads=4, chunk_size=64 * 1024**2) -> csr_matrix:
+  r""" Read 10x Matrix Market file (`[n_features, n_cells]` coordinate
+  format) and return the transposed `[n_cells, n_features]` CSR matrix.
+
+  The body is streamed in chunks of `chunk_size` bytes (completed to the line
+  boundary) which are parsed by `n_threads` threads, at most `2 * n_threads`
+  chunks of raw text are kept in memory. The values are stored as uint16 if
+  they are integer counts smaller than 65536, otherwise, float32.
+  """
+  header = data.readline()
+  banner = header.decode('utf-8').lower().split()
+  # only the general coordinate format is written by 10x
+  if 'coordinate' not in banner or 'general' not in banner:
+    x = mmread(io.BytesIO(header + data.read()))
+    return csr_matrix(x.T, dtype=np.float32)
+  is_integer = 'integer' in banner
+  # skip the comments, then the size line
+  line = data.readline()
+  while line[:1] == b'%':
+    line = data.readline()
+  n_features, n_cells, nnz = [int(i) for i in line.split()]
+  value_dtype = np.int64 if is_integer else np.float64
+  parse = partial(_parse_mtx_chunk, value_dtype=value_dtype)
+  n_threads = max(1, int(n_threads))
+  parsed = []
+  with ThreadPoolExecutor(max_workers=n_threads) as executor:
+    futures = []
+    while True:
+      chunk = data.read(int(chunk_size))
+      if len(chunk) == 0:
+        break
+      if chunk[-1:] != b'\n':
+        chunk += data.readline()
+      if not chunk.isspace():
+        futures.append(executor.submit(parse, chunk))
+      if len(futures) >= 2 * n_threads:
+        parsed.append(futures.pop(0).result())
+    parsed += [f.result() for f in futures]
+  if len(parsed) == 0:
+    row = col = np.empty((0,), dtype=np.int32)
+    values = np.empty((0,), dtype=value_dtype)
+  else:
+    row, col, values = [np.concatenate(i) for i in zip(*parsed)]
+  assert len(values) == nnz, \
+    f"Matrix Market file declares {nnz} entries, but found {len(values)}"
+  if is_integer and (len(values) == 0 or
+                     (values.min() >= 0 and values.max() < 65536)):
+    values = values.astype(np.uint16)
+  else:
+    values = values.astype(np.float32)
+  # the rows are the features, the columns are the cells (1-based index)
+  return csr_matrix((values, (col - 1, row - 1)),
+                    shape=(n_cells, n_features))
+
+
 def _read_tarinfo(path_name_size_verbose):
   path, name, size, verbose = path_name_size_verbose
+  start_time = time.perf_counter()
   with tarfile.open(path, mode="r:gz") as f:
     if verbose:
       print(f"Extracting '{name}' size {size / 1024. / 1024.:.2f}(MB) ...")
@@ -166,9 +255,9 @@ def _read_tarinfo(path_name_size_verbose):
     name = os.path.basename(name).split('.')[0]
     # metadata
     if name == "peaks":
-      data = np.array([str(line, 'utf-8').strip().split("\t") for line in data])
+      data = _read_table(data, sep="\t")
     elif name == 'barcodes':
-      data = np.array([str(line, 'utf-8')[:-1] for line in data])
+      data = _read_table(data, sep="\t")[:, 0]
     elif name in ('features', 'genes'):
       if 'tsv' in all_ext:
         sep = "\t"
@@ -178,18 +267,15 @@ def _read_tarinfo(path_name_size_verbose):
         sep = " "
       else:
         raise RuntimeError(f"Unknown data format for file {name}, from {path}")
-      data = np.array([str(line, 'utf-8')[:-1].split(sep) for line in data])
-    # read the data matrix
+      data = _read_table(data, sep=sep)
+    # read the data matrix, transposed to [n_cells, n_features]
     elif name == 'matrix':
-      data = mmread(data)
-      if data.dtype == np.int64:
-        data = data.astype(np.int32)
-      elif data.dtype == np.float64:
-        data = data.astype(np.float32)
+      data = _read_mtx(data)
     else:
       raise RuntimeError(f"Unknown downloaded file {name}, from {path}")
   if verbose:
-    print(f" {name}: {type(data)}{data.shape}-{data.dtype}")
+    print(f" {name}: {type(data)}{data.shape}-{data.dtype} "
+          f"in {time.perf_counter() - start_time:.2f}(s)")
   return name, data
 
 
@@ -268,7 +354,7 @@ def read_dataset10x(name,
     ### cell-atac
     if exp == 'cell-atac':
       n_top_genes = 20000  # this is ad-hoc value
-      X = contents['matrix'].T.todense()
+      X = contents['matrix']
       peaks = contents['peaks']
       X_peaks = peaks[:, 2].astype(np.float32) - peaks[:, 1].astype(np.float32)
       X_col_name = np.array([':'.join(i) for i in peaks])
@@ -288,10 +374,7 @@ def read_dataset10x(name,
       X_col = contents['features'] if 'features' in contents else contents[
           'genes']
       # data matrix
-      X = contents['matrix'].T
-      if not isinstance(X, csr_matrix) and hasattr(X, 'tocsr'):
-        X = X.tocsr()
-      X = X.astype('float32')
+      X = contents['matrix'].astype('float32')
       assert X.shape[0] == barcodes.shape[0] and X.shape[1] == X_col.shape[0]
       # antibody and gene are provided
       prot_ids = []
@@ -322,12 +405,13 @@ def read_dataset10x(name,
         z = X[:, pmhc_ids]
         z_col = X_col[pmhc_ids][:, 0]  # the id
         z_col_name = X_col[pmhc_ids][:, 1]  # the name
-      # Gene ID, Gene Name
-      X = X[:, gene_ids].todense()
+      # Gene ID, Gene Name, keep the CSR format for the gene matrix
+      X = X[:, gene_ids]
       X_col_name = X_col[gene_ids][:, 1]  # the name
       X_col = X_col[gene_ids][:, 0]  # the id
-      assert np.min(X) >= 0 and np.max(X) < 65000, \
-        f"Only support uint16 data type, given data with max={np.max(X)}"
+      if X.nnz > 0:
+        assert np.min(X.data) >= 0 and np.max(X.data) < 65000, \
+          f"Only support uint16 data type, given data with max={np.max(X.data)}"
       # data and metadata
       sco = SingleCellOMIC(X,
                            cell_id=barcodes,
@@ -347,21 +431,28 @@ def read_dataset10x(name,
     ### others
     else:
       raise NotImplementedError(f"No support for experiment: {exp}")
-    ### save data and metadata
+    ### save data and metadata, the main OMIC is stored as memory-mapped CSR
+    # matrix, the other (small) OMICs are stored as dense memory-mapped array
     for name, data in save_data:
       outpath = os.path.join(preprocessed_path, name)
       n_samples, n_features = data.shape
       if n_samples == 0 or n_features == 0:
         continue
-      with MmapArrayWriter(outpath,
-                           shape=(0, n_features),
-                           dtype=np.uint16,
-                           remove_exist=True) as f:
+      is_sparse = name == save_metadata['main_omic'] and issparse(data)
+      writer = SparseMmapWriter(outpath,
+                                n_features=n_features,
+                                dtype=np.uint16,
+                                remove_exist=True) if is_sparse else \
+        MmapArrayWriter(outpath,
+                        shape=(0, n_features),
+                        dtype=np.uint16,
+                        remove_exist=True)
+      with writer as f:
         if verbose:
           prog = tqdm(f"Saving {outpath}", total=n_samples, unit='samples')
         for s, e in batching(batch_size=5120, n=n_samples):
           x = data[s:e]
-          if hasattr(x, 'todense'):
+          if not is_sparse and hasattr(x, 'todense'):
             x = x.todense()
           f.write(x)
           if verbose:
@@ -407,10 +498,14 @@ def read_dataset10x(name,
     metadata = pickle.load(f)
   with open(os.path.join(preprocessed_path, 'top_genes'), 'rb') as f:
     top_genes = pickle.load(f)
-  data = {
-      name: MmapArray(os.path.join(preprocessed_path, name)).astype(np.float32)
-      for name in omics
-  }
+  # all OMICs stay memory-mapped in the stored dtype, casting is done per batch
+  data = {}
+  for name in omics:
+    path = os.path.join(preprocessed_path, name)
+    if is_sparse_mmap(path):
+      data[name] = read_sparse_mmap(path)
+    else:
+      data[name] = MmapArray(path)
   main_omic = metadata['main_omic']
   X = data[main_omic]
   var_names = metadata[f'{main_omic}_var']
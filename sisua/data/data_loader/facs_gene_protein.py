@@ -7,7 +7,6 @@ import os
 import pickle
 import shutil
 from io import BytesIO, StringIO
-from urllib.request import urlretrieve
 
 import numpy as np
 import scipy as sp
@@ -15,7 +14,8 @@ import scipy as sp
 from odin.fuel import Dataset
 from odin.utils import crypto
 from sisua.data.path import DOWNLOAD_DIR, DATA_DIR
-from sisua.data.utils import remove_allzeros_columns, save_to_dataset
+from sisua.data.utils import (download_file, remove_allzeros_columns,
+                              save_to_dataset)
 
 _URL = b'aHR0cHM6Ly9zMy5hbWF6b25hd3MuY29tL2FpLWRhdGFzZXRzL0tJX0ZBQ1NfJWRwcm90ZWluLnpp\ncA==\n'
 _FACS_PREPROCESSED = os.path.join(DATA_DIR, 'FACS%d_preprocessed')
@@ -45,7 +45,7 @@ def read_FACS(n_protein, override=False, verbose=False):
     url = str(base64.decodebytes(_URL), 'utf-8') % n_protein
     base_name = os.path.basename(url)
     zip_path = os.path.join(download_path, base_name)
-    urlretrieve(url=url, filename=zip_path)
+    download_file(url=url, filename=zip_path, override=False)
     # ====== extract the data ====== #
     data_dict = {}
     for name, data in crypto.unzip_aes(zip_path,
@@ -120,10 +120,7 @@ def read_full_FACS(override=False, verbose=False):
   ]
   for name, url in file_url:
     filename = os.path.join(download_path, name)
-    if not os.path.exists(filename):
-      if verbose:
-        print("Downloading file '{filename}' ...")
-      urlretrieve(url=url, filename=filename)
+    download_file(url=url, filename=filename, override=False, verbose=verbose)
   # ====== extract the data ====== #
   preprocessed_path = _FACS_PREPROCESSED % 7
   if not os.path.exists(preprocessed_path):
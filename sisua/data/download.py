@@ -0,0 +1,238 @@
+r""" Download manager used by all dataset loaders (via
+`sisua.data.utils.download_file`).
+
+ - Interrupted downloads are resumed by HTTP range requests from the partial
+  file `<filename>.part`.
+ - Large files are fetched in parallel segments (if the server accepts range
+  requests), each segment is resumable on its own.
+ - The MD5 is computed while the data is written (no re-read of the output).
+ - `file://` URLs and local paths are copied, and the environment variable
+  `SISUA_MIRROR` (a local folder, `file://` or `http(s)://` base URL) is
+  tried before the original URL, e.g. for running air-gapped:
+  `SISUA_MIRROR=/mnt/datasets python train.py`
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5 as _md5
+from urllib.error import URLError
+from urllib.parse import urlparse
+from urllib.request import Request, url2pathname, urlopen
+
+__all__ = ['MIRROR_ENV', 'fetch_url']
+
+MIRROR_ENV = 'SISUA_MIRROR'
+_CHUNK_SIZE = 1024 * 1024
+_TIMEOUT = 60
+# files larger than this are downloaded in parallel segments
+_PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+
+# ===========================================================================
+# Helpers
+# ===========================================================================
+def _local_path(url):
+  r""" Return the local path of `file://` URL or plain path, otherwise None """
+  parsed = urlparse(url)
+  if parsed.scheme == 'file':
+    return url2pathname(parsed.path)
+  if parsed.scheme == '' or (len(parsed.scheme) == 1 and os.name == 'nt'):
+    return url
+  return None
+
+
+def _candidates(url, filename):
+  r""" The mirror (if given) then the original URL """
+  urls = []
+  mirror = os.environ.get(MIRROR_ENV, '').strip()
+  if len(mirror) > 0:
+    name = os.path.basename(filename)
+    path = _local_path(mirror)
+    if path is not None:
+      path = os.path.join(os.path.expanduser(path), name)
+      if os.path.isfile(path):
+        urls.append(path)
+    else:
+      urls.append(mirror.rstrip('/') + '/' + name)
+  urls.append(url)
+  return urls
+
+
+def _remote_info(url):
+  r""" Return the size (or None if unknown) and whether range requests are
+  accepted """
+  try:
+    with urlopen(Request(url, method='HEAD'), timeout=_TIMEOUT) as r:
+      size = r.headers.get('Content-Length', None)
+      ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+      return (int(size) if size is not None else None), ranges
+  except (URLError, ValueError, OSError):
+    return None, False
+
+
+def _write(src, dst, hasher, progress):
+  while True:
+    chunk = src.read(_CHUNK_SIZE)
+    if not chunk:
+      break
+    dst.write(chunk)
+    if hasher is not None:
+      hasher.update(chunk)
+    if progress is not None:
+      progress.update(len(chunk))
+
+
+def _hash_file(path, hasher):
+  with open(path, 'rb') as f:
+    _write(f, _NullWriter(), hasher, None)
+  return hasher
+
+
+class _NullWriter(object):
+
+  def write(self, data):
+    pass
+
+
+def _fetch_segment(url, path, start=0, end=None, progress=None,
+                   checksum=False, size=None):
+  r""" Download the bytes `[start, end]` (or till the end if `end=None`) of
+  `url` into `path`, resuming from the existing bytes of `path`.
+
+  Return the MD5 hasher of the whole `path` if `checksum=True`.
+  """
+  hasher = _md5() if checksum else None
+  offset = os.path.getsize(path) if os.path.exists(path) else 0
+  # compare the resume offset to the remote size (`Content-Length`), so a
+  # complete partial file does not request an unsatisfiable range (416)
+  if end is None and size is not None:
+    if start + offset > size:  # stale partial file, restart from scratch
+      os.remove(path)
+      offset = 0
+    elif offset > 0:
+      end = size - 1
+  if end is not None and start + offset > end:
+    if hasher is not None:
+      _hash_file(path, hasher)
+    if progress is not None:
+      progress.update(offset)
+    return hasher
+  headers = {}
+  if start + offset > 0 or end is not None:
+    headers['Range'] = f"bytes={start + offset}-{'' if end is None else end}"
+  with urlopen(Request(url, headers=headers), timeout=_TIMEOUT) as r:
+    mode = 'ab'
+    # the server ignored the range request, restart from scratch
+    if offset > 0 and getattr(r, 'status', None) != 206:
+      mode = 'wb'
+      offset = 0
+    if offset > 0:
+      if hasher is not None:
+        _hash_file(path, hasher)
+      if progress is not None:
+        progress.update(offset)
+    with open(path, mode) as f:
+      _write(r, f, hasher, progress)
+  return hasher
+
+
+def _fetch_parallel(url, path, size, n_segments, progress):
+  r""" Download `n_segments` ranges into separated resumable files, then
+  concatenate them into `path` (computing the MD5 while concatenating) """
+  segment = (size + n_segments - 1) // n_segments
+  ranges = [(s, min(s + segment, size) - 1) for s in range(0, size, segment)]
+  parts = [f"{path}{i}" for i in range(len(ranges))]
+  with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+    futures = [
+        executor.submit(_fetch_segment, url, p, s, e, progress)
+        for p, (s, e) in zip(parts, ranges)
+    ]
+    for f in futures:
+      f.result()
+  for p, (s, e) in zip(parts, ranges):
+    if os.path.getsize(p) != e - s + 1:
+      raise RuntimeError(f"Incomplete segment {p} of {url}, expected "
+                         f"{e - s + 1} bytes but received {os.path.getsize(p)}")
+  hasher = _md5()
+  with open(path, 'wb') as f:
+    for p in parts:
+      with open(p, 'rb') as fp:
+        _write(fp, f, hasher, None)
+  for p in parts:
+    os.remove(p)
+  return hasher
+
+
+# ===========================================================================
+# Main
+# ===========================================================================
+def fetch_url(url, filename, md5=None, n_segments=4, verbose=True) -> str:
+  r""" Download `url` (or copy `file://` URL and local path) to `filename`.
+
+  Arguments:
+    md5 : a String (optional), the expected MD5, if mismatch, the partial
+      download is removed and the next candidate is tried, `RuntimeError` is
+      raised if all candidates failed.
+    n_segments : an Integer, number of parallel connections for files larger
+      than 64MB.
+
+  Return:
+    the `filename`
+  """
+  from tqdm import tqdm
+  folder = os.path.dirname(os.path.abspath(filename))
+  if not os.path.exists(folder):
+    os.makedirs(folder)
+  part = f"{filename}.part"
+  errors = []
+  for candidate in _candidates(url, filename):
+    local = _local_path(candidate)
+    desc = f"Download {os.path.basename(filename)}"
+    try:
+      ### local file or file://
+      if local is not None:
+        if not os.path.isfile(local):
+          raise FileNotFoundError(local)
+        with tqdm(desc=desc,
+                  total=os.path.getsize(local),
+                  unit='B',
+                  unit_scale=True,
+                  disable=not verbose) as progress:
+          hasher = _md5()
+          with open(local, 'rb') as src, open(part, 'wb') as dst:
+            _write(src, dst, hasher, progress)
+      ### remote file
+      else:
+        size, ranges = _remote_info(candidate)
+        with tqdm(desc=desc,
+                  total=size,
+                  unit='B',
+                  unit_scale=True,
+                  disable=not verbose) as progress:
+          if ranges and size is not None and n_segments > 1 and \
+            size >= _PARALLEL_THRESHOLD:
+            hasher = _fetch_parallel(candidate, part, size, int(n_segments),
+                                     progress)
+          else:
+            hasher = _fetch_segment(candidate,
+                                    part,
+                                    progress=progress,
+                                    checksum=True,
+                                    size=size)
+    except (URLError, OSError) as e:
+      errors.append(f"{candidate}: {e}")
+      continue
+    digest = hasher.hexdigest()
+    # e.g. outdated mirror or stale partial file, try the next candidate
+    if md5 is not None and len(md5) > 0 and digest != md5:
+      os.remove(part)
+      errors.append(f"{candidate}: MD5 mismatch, expected {md5} but "
+                    f"downloaded {digest}")
+      continue
+    shutil.move(part, filename)
+    if verbose:
+      print(f"File '{filename}' md5:{digest}")
+    return filename
+  raise RuntimeError(f"Cannot download '{filename}':\n" + '\n'.join(errors))
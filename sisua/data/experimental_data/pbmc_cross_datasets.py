@@ -6,7 +6,6 @@ from functools import partial, reduce
 import numpy as np
 import scanpy as sc
 
-from odin.utils import md5_folder
 from sisua.data.const import MARKER_GENES
 from sisua.data.data_loader.cbmc_CITEseq import read_CITEseq_CBMC
 from sisua.data.data_loader.childhood_leukemia_cALL import read_leukemia_BMMC
@@ -18,7 +17,8 @@ from sisua.data.data_loader.pbmc_CITEseq import read_CITEseq_PBMC
 from sisua.data.data_loader.pbmcecc import read_PBMCeec
 from sisua.data.path import DATA_DIR, EXP_DIR
 from sisua.data.single_cell_dataset import SingleCellOMIC
-from sisua.data.utils import standardize_protein_name
+from sisua.data.utils import (standardize_protein_name, validate_data_dir,
+                              write_manifest)
 
 # ===========================================================================
 # Helpers
@@ -90,11 +90,9 @@ def read_PBMC_crossdataset(name,
     shutil.rmtree(preprocessed_path)
     if verbose:
       print(f"Override preprocessed data at path {preprocessed_path}")
-  if not os.path.exists(preprocessed_path):
-    os.mkdir(preprocessed_path)
+  validate_data_dir(preprocessed_path, _MD5)
   # ******************** preprocessing ******************** #
-  if len(os.listdir(preprocessed_path)) == 0 or \
-    md5_folder(preprocessed_path) != _MD5:
+  if len(os.listdir(preprocessed_path)) == 0:
     datasets = {}
     for i, j in _DATASETS.items():
       ds = j(verbose=verbose)
@@ -153,7 +151,7 @@ def read_PBMC_crossdataset(name,
     # save the indices and top_genes
     with open(os.path.join(preprocessed_path, 'gene_indices'), 'wb') as f:
       pickle.dump([gene_names, indices, top_genes], f)
-    print(f"Preprocessed MD5: {md5_folder(preprocessed_path)}")
+    print(f"Preprocessed MD5: {write_manifest(preprocessed_path)}")
   # ******************** load the dataset ******************** #
   with open(os.path.join(preprocessed_path, 'gene_indices'), 'rb') as f:
     gene_names, indices, top_genes = pickle.load(f)
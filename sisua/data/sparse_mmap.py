@@ -0,0 +1,195 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import pickle
+import shutil
+
+import numpy as np
+from scipy import sparse
+
+__all__ = [
+    'SparseMmapWriter',
+    'read_sparse_mmap',
+    'write_sparse_mmap',
+    'is_sparse_mmap',
+]
+
+_META = 'meta'
+_DATA = 'data'
+_INDICES = 'indices'
+_INDPTR = 'indptr'
+
+
+# ===========================================================================
+# Helpers
+# ===========================================================================
+def is_sparse_mmap(path) -> bool:
+  r""" Return True if given path is a folder created by `SparseMmapWriter` """
+  return os.path.isdir(path) and os.path.isfile(os.path.join(path, _META))
+
+
+def _memmap(path, dtype, shape, mode):
+  # np.memmap does not support zero-size file
+  if np.prod(shape) == 0:
+    return np.empty(shape=shape, dtype=dtype)
+  return np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+
+
+# ===========================================================================
+# Main
+# ===========================================================================
+class SparseMmapWriter(object):
+  r""" Append rows of a Compressed Sparse Row (CSR) matrix into three
+  memory-mappable buffers (`data`, `indices`, `indptr`) stored in a folder,
+  only the given chunk is kept in memory while writing.
+
+  Arguments:
+    path : a String, path to the output folder
+    n_features : an Integer, number of columns of the matrix
+    dtype : dtype of the non-zero values
+    index_dtype : dtype of the column indices
+    remove_exist : a Boolean, remove existed folder
+
+  Example:
+  ```
+  with SparseMmapWriter('/tmp/X', n_features=2000, dtype='uint16') as f:
+    for s, e in batching(batch_size=5120, n=X.shape[0]):
+      f.write(X[s:e])
+  X = read_sparse_mmap('/tmp/X')  # csr_matrix backed by np.memmap
+  ```
+  """
+
+  def __init__(self,
+               path,
+               n_features,
+               dtype='float32',
+               index_dtype='int32',
+               remove_exist=False):
+    path = os.path.abspath(os.path.expanduser(path))
+    if os.path.exists(path):
+      if not remove_exist:
+        raise RuntimeError(f"Path '{path}' exists, set remove_exist=True to "
+                           "override.")
+      if os.path.isdir(path):
+        shutil.rmtree(path)
+      else:
+        os.remove(path)
+    os.makedirs(path)
+    self.path = path
+    self.n_features = int(n_features)
+    self.dtype = np.dtype(dtype)
+    self.index_dtype = np.dtype(index_dtype)
+    self._n_samples = 0
+    self._nnz = 0
+    self._data = open(os.path.join(path, _DATA), 'wb')
+    self._indices = open(os.path.join(path, _INDICES), 'wb')
+    self._indptr = open(os.path.join(path, _INDPTR), 'wb')
+    np.zeros((1,), dtype=np.int64).tofile(self._indptr)
+    self._is_closed = False
+
+  @property
+  def shape(self):
+    return (self._n_samples, self.n_features)
+
+  @property
+  def nnz(self):
+    return self._nnz
+
+  def write(self, x):
+    r""" Append a chunk of rows, `x` could be `numpy.ndarray` or
+    `scipy.sparse.spmatrix` """
+    if self._is_closed:
+      raise RuntimeError("SparseMmapWriter is closed.")
+    if not sparse.isspmatrix_csr(x):
+      x = sparse.csr_matrix(x)
+    assert x.ndim == 2 and x.shape[1] == self.n_features, \
+      f"Expect matrix with {self.n_features} columns, but given: {x.shape}"
+    # canonical format is required for the column indices of each row
+    if not x.has_canonical_format:
+      x = x.copy()
+      x.sum_duplicates()
+    x.data.astype(self.dtype, copy=False).tofile(self._data)
+    x.indices.astype(self.index_dtype, copy=False).tofile(self._indices)
+    (x.indptr[1:].astype(np.int64) + self._nnz).tofile(self._indptr)
+    self._n_samples += x.shape[0]
+    self._nnz += int(x.indptr[-1])
+    return self
+
+  def flush(self):
+    for f in (self._data, self._indices, self._indptr):
+      f.flush()
+    with open(os.path.join(self.path, _META), 'wb') as f:
+      pickle.dump(
+          dict(shape=self.shape,
+               nnz=self.nnz,
+               dtype=self.dtype.str,
+               index_dtype=self.index_dtype.str), f)
+    return self
+
+  def close(self):
+    if not self._is_closed:
+      self.flush()
+      for f in (self._data, self._indices, self._indptr):
+        f.close()
+      self._is_closed = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def __del__(self):
+    try:
+      self.close()
+    except Exception:
+      pass
+
+
+def write_sparse_mmap(path, X, dtype=None, batch_size=5120,
+                      remove_exist=True) -> str:
+  r""" Write the whole matrix `X` (dense, sparse or memory-mapped) to
+  `path` using `SparseMmapWriter`, `batch_size` rows at a time. """
+  if dtype is None:
+    dtype = X.dtype
+  with SparseMmapWriter(path,
+                        n_features=X.shape[1],
+                        dtype=dtype,
+                        remove_exist=remove_exist) as f:
+    for s in range(0, X.shape[0], batch_size):
+      f.write(X[s:s + batch_size])
+  return path
+
+
+def read_sparse_mmap(path, mode='r', dtype=None) -> sparse.csr_matrix:
+  r""" Open a folder written by `SparseMmapWriter` as `scipy.sparse.csr_matrix`
+  without loading the buffers into memory.
+
+  Arguments:
+    mode : {'r', 'r+', 'c'}, mode for `numpy.memmap`
+    dtype : if given, only the `data` buffer is casted (i.e. copied into
+      memory), the `indices` and `indptr` stay memory-mapped.
+  """
+  path = os.path.abspath(os.path.expanduser(path))
+  if not is_sparse_mmap(path):
+    raise ValueError(f"'{path}' is not a SparseMmap folder.")
+  with open(os.path.join(path, _META), 'rb') as f:
+    meta = pickle.load(f)
+  n_samples, n_features = meta['shape']
+  nnz = meta['nnz']
+  data = _memmap(os.path.join(path, _DATA), meta['dtype'], (nnz,), mode)
+  indices = _memmap(os.path.join(path, _INDICES), meta['index_dtype'], (nnz,),
+                    mode)
+  indptr = _memmap(os.path.join(path, _INDPTR), np.int64, (n_samples + 1,),
+                   mode)
+  # scipy prefers matching index dtype, the indptr is small enough to be
+  # converted in memory, while `indices` is kept as memory-mapped
+  if indices.dtype == np.int32 and nnz < np.iinfo(np.int32).max:
+    indptr = np.asarray(indptr, dtype=np.int32)
+  if dtype is not None and np.dtype(dtype) != data.dtype:
+    data = data.astype(dtype)
+  X = sparse.csr_matrix((n_samples, n_features), dtype=data.dtype)
+  X.data = data
+  X.indices = indices
+  X.indptr = indptr
+  return X
@@ -0,0 +1,184 @@
+r""" PyTorch backend of `SingleCellOMIC.create_dataset(framework='pytorch')`,
+the cells are read batch by batch directly from the dense, sparse or
+memory-mapped OMICs without going through TensorFlow.
+
+Example:
+```
+loader = sco.create_dataset(OMIC.transcriptomic | OMIC.proteomic,
+                            framework='pytorch',
+                            batch_size=128,
+                            num_workers=4)
+for data in loader:
+  x, y = data['inputs']
+```
+"""
+from __future__ import absolute_import, division, print_function
+
+import mmap
+from typing import List, Union
+
+import numpy as np
+import torch
+from scipy import sparse
+from torch.utils.data import (BatchSampler, DataLoader, Dataset,
+                              RandomSampler, SequentialSampler, get_worker_info)
+
+__all__ = ['SingleCellTorchDataset', 'create_dataloader']
+
+
+# ===========================================================================
+# Helpers
+# ===========================================================================
+def _is_mapped(x) -> bool:
+  # only the memmap which owns the mapping, a slice of memmap is pickled as
+  # normal array
+  return isinstance(x, np.memmap) and isinstance(x.base, mmap.mmap)
+
+
+def _to_portable(x):
+  r""" Memory-mapped buffers are pickled as their file description, so the
+  data is not copied into the workers """
+  if _is_mapped(x):
+    return ('memmap', x.filename, x.dtype.str, x.shape, x.offset)
+  if sparse.issparse(x) and x.format in ('csr', 'csc'):
+    return (x.format, x.shape, _to_portable(x.data), _to_portable(x.indices),
+            _to_portable(x.indptr))
+  return ('array', x)
+
+
+def _from_portable(spec):
+  kind = spec[0]
+  if kind == 'memmap':
+    _, filename, dtype, shape, offset = spec
+    return np.memmap(filename, dtype=dtype, mode='r', shape=shape,
+                     offset=offset)
+  if kind in ('csr', 'csc'):
+    _, shape, data, indices, indptr = spec
+    cls = sparse.csr_matrix if kind == 'csr' else sparse.csc_matrix
+    x = cls(shape, dtype=_from_portable(data).dtype)
+    x.data = _from_portable(data)
+    x.indices = _from_portable(indices)
+    x.indptr = _from_portable(indptr)
+    return x
+  return spec[1]
+
+
+def _read_rows(x, indices: np.ndarray) -> np.ndarray:
+  x = x[indices]
+  if sparse.issparse(x):
+    x = x.toarray()
+  return np.asarray(x, dtype=np.float32)
+
+
+# ===========================================================================
+# Main
+# ===========================================================================
+class SingleCellTorchDataset(Dataset):
+  r""" Map-style dataset, indexed by a list of cell indices (i.e. a batch
+  from `BatchSampler`), each batch of rows is gathered at once.
+
+  Arguments:
+    inputs : list of OMIC matrices `[n_samples, n_features]`, dense, sparse
+      or memory-mapped.
+    library : list of library size matrices `[n_samples, 2]`
+    labels_percent : a Scalar [0., 1.]. If > 0, create a mask with given
+      percent set to True (the same as `create_dataset`).
+    seed : an Integer, seed for the labels mask, each worker has its own
+      random generator.
+
+  Return:
+    a Dictionary of `inputs`, `library` and `mask` (float32 and boolean
+      `torch.Tensor`)
+  """
+
+  def __init__(self,
+               inputs: List[Union[np.ndarray, sparse.spmatrix]],
+               library: List[np.ndarray],
+               labels_percent: float = 0.,
+               seed: int = 1):
+    super().__init__()
+    self.inputs = list(inputs)
+    self.library = [np.asarray(i, dtype=np.float32) for i in library]
+    assert len(set(x.shape[0] for x in self.inputs + self.library)) == 1, \
+      "Number of samples mismatch between the OMICs"
+    self.labels_percent = float(np.clip(labels_percent, 0., 1.))
+    if len(self.inputs) == 1:
+      self.labels_percent = 0.
+    self.seed = int(seed)
+    self._rng = None
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state['inputs'] = [_to_portable(x) for x in self.inputs]
+    state['_rng'] = None
+    return state
+
+  def __setstate__(self, state):
+    state['inputs'] = [_from_portable(x) for x in state['inputs']]
+    self.__dict__.update(state)
+
+  @property
+  def rng(self) -> np.random.Generator:
+    if self._rng is None:
+      worker = get_worker_info()
+      self._rng = np.random.default_rng(
+          [self.seed, 0 if worker is None else worker.id + 1])
+    return self._rng
+
+  def __len__(self):
+    return self.inputs[0].shape[0]
+
+  def __getitem__(self, index):
+    index = np.atleast_1d(np.asarray(index, dtype=np.int64))
+    # sorted indices for sequential read of the storage
+    index = np.sort(index)
+    inputs = [torch.from_numpy(_read_rows(x, index)) for x in self.inputs]
+    library = [torch.from_numpy(x[index]) for x in self.library]
+    n = len(index)
+    if self.labels_percent == 0.:
+      mask = torch.zeros(n, dtype=torch.bool)
+    else:
+      mask = torch.from_numpy(self.rng.random((n, 1)) < self.labels_percent)
+    return dict(inputs=inputs[0] if len(inputs) == 1 else inputs,
+                library=library[0] if len(library) == 1 else library,
+                mask=mask)
+
+
+def create_dataloader(inputs,
+                      library,
+                      labels_percent=0.,
+                      batch_size=64,
+                      drop_remainder=False,
+                      shuffle=True,
+                      num_workers=0,
+                      pin_memory=None,
+                      seed=1) -> DataLoader:
+  r""" Create `torch.utils.data.DataLoader` of `SingleCellTorchDataset`
+  which yields a whole batch per call (i.e. no per-cell collate).
+
+  Arguments:
+    shuffle : a Boolean, reshuffle the cells at every epoch.
+    num_workers : an Integer, number of worker processes, the batches are
+      returned via shared memory and the memory-mapped OMICs are re-opened
+      (not copied) in each worker.
+    pin_memory : a Boolean, pinned memory for faster host to GPU copy,
+      by default, enabled if CUDA is available.
+  """
+  dataset = SingleCellTorchDataset(inputs,
+                                   library,
+                                   labels_percent=labels_percent,
+                                   seed=seed)
+  if shuffle:
+    sampler = RandomSampler(dataset,
+                            generator=torch.Generator().manual_seed(seed))
+  else:
+    sampler = SequentialSampler(dataset)
+  if pin_memory is None:
+    pin_memory = torch.cuda.is_available()
+  return DataLoader(dataset,
+                    sampler=BatchSampler(sampler,
+                                         batch_size=int(batch_size),
+                                         drop_last=bool(drop_remainder)),
+                    batch_size=None,
+                    num_workers=int(num_workers),
+                    pin_memory=bool(pin_memory))
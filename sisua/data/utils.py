@@ -6,11 +6,11 @@ import os
 import pickle
 import shutil
 import tarfile
+import threading
 import warnings
 import zipfile
 from contextlib import contextmanager
 from copy import deepcopy
-from urllib.request import urlretrieve
 
 import numpy as np
 from scipy import sparse
@@ -20,40 +20,187 @@ from bigarray import MmapArrayWriter
 from odin.fuel import Dataset
 from odin.utils import as_tuple, ctext
 from odin.utils.crypto import md5_checksum, md5_folder
+from sisua.data.cache import _check_file_stats, _file_stat
 
 __all__ = [
     'apply_artificial_corruption',
     'get_library_size',
+    'get_total_counts',
+    'library_statistics',
+    'dispersion_gene_subset',
     'read_compressed',
     'standardize_protein_name',
+    'build_var_indices',
     'get_gene_id2name',
     'validating_dataset',
+    'validate_data_dir',
+    'write_manifest',
     'save_to_dataset',
 ]
 
 
 # ===========================================================================
-# For reading compressed files
+# Validating preprocessed data
 # ===========================================================================
-def validate_data_dir(path_dir, md5):
+def _manifest_path(path_dir):
+  # stored next to the folder, so `md5_folder` of the folder is unchanged
+  return os.path.normpath(path_dir) + '.manifest'
+
+
+def _list_files(path_dir):
+  files = []
+  for root, _, names in os.walk(path_dir):
+    for name in names:
+      files.append(os.path.relpath(os.path.join(root, name), path_dir))
+  return sorted(files)
+
+
+def _dump_manifest(path_dir, manifest):
+  path = _manifest_path(path_dir)
+  tmp_path = f"{path}.tmp{os.getpid()}"
+  with open(tmp_path, 'wb') as f:
+    pickle.dump(manifest, f)
+  os.replace(tmp_path, path)
+
+
+def _read_manifest(path_dir):
+  path = _manifest_path(path_dir)
+  if not os.path.isfile(path):
+    return None
+  try:
+    with open(path, 'rb') as f:
+      return pickle.load(f)
+  except Exception:  # corrupted manifest
+    return None
+
+
+def _check_manifest(path_dir, manifest, full=False) -> bool:
+  r""" The folder contains exactly the files of the manifest and none of
+  them changed (see `sisua.data.cache._check_file_stats`) """
+  files = manifest['files']
+  if _list_files(path_dir) != sorted(files.keys()):
+    return False
+  valid, updated = _check_file_stats(files, root=path_dir, full=full)
+  if valid and updated:
+    _dump_manifest(path_dir, manifest)
+  return valid
+
+
+def _verify_in_background(path_dir, manifest):
+  if not _check_manifest(path_dir, manifest, full=True):
+    # the next load will rebuild the preprocessed data
+    if os.path.exists(_manifest_path(path_dir)):
+      os.remove(_manifest_path(path_dir))
+    warnings.warn(f"Preprocessed data at {path_dir} is corrupted, "
+                  "it will be rebuilt at the next load.")
+
+
+def write_manifest(path_dir, md5=None) -> str:
+  r""" Record the size, modification time and MD5 of all files in the
+  preprocessed folder, called once the preprocessing finished.
+
+  Arguments:
+    md5 : a String (optional), the known MD5 of the folder (i.e. the output
+      of `md5_folder`), otherwise, it is computed.
+
+  Return:
+    the MD5 of the folder
+  """
+  files = {}
+  for name in _list_files(path_dir):
+    path = os.path.join(path_dir, name)
+    files[name] = (_file_stat(path), md5_checksum(path))
+  if md5 is None:
+    md5 = md5_folder(path_dir)
+  _dump_manifest(path_dir, dict(folder=md5, files=files))
+  return md5
+
+
+def validate_data_dir(path_dir, md5, verify=False):
+  r""" Create the preprocessed folder or remove it if its content mismatch
+  the expected MD5.
+
+  The folder is validated by the manifest written by `write_manifest` (i.e.
+  only `stat` of the files), a folder preprocessed without manifest is
+  hashed once and the manifest is created.
+
+  Arguments:
+    md5 : a String, the expected MD5 of the folder, if empty, only the
+      manifest is validated.
+    verify : {False, True, 'background'}, if True, rehash all the files
+      against the manifest, if 'background', rehash in a daemon thread and
+      warn if the folder is corrupted.
+  """
+  if md5 is None:
+    md5 = r""
   if not os.path.exists(path_dir):
     os.makedirs(path_dir)
-  elif md5_folder(path_dir) != md5:
+    return path_dir
+  manifest_path = _manifest_path(path_dir)
+  if len(os.listdir(path_dir)) == 0:
+    if os.path.exists(manifest_path):  # the folder was cleaned
+      os.remove(manifest_path)
+    return path_dir
+  manifest = _read_manifest(path_dir)
+  if manifest is None:
+    # incomplete preprocessing or preprocessed without manifest
+    valid = len(md5) > 0 and md5_folder(path_dir) == md5
+    if valid:
+      write_manifest(path_dir, md5=md5)
+  else:
+    valid = (len(md5) == 0 or manifest['folder'] == md5) and \
+      _check_manifest(path_dir, manifest, full=verify is True)
+  if not valid:
     shutil.rmtree(path_dir)
+    if os.path.exists(manifest_path):
+      os.remove(manifest_path)
     print(f"MD5 preprocessed at {path_dir} mismatch, remove and override!")
     os.makedirs(path_dir)
+  elif verify == 'background' and manifest is not None:
+    threading.Thread(target=_verify_in_background,
+                     args=(path_dir, manifest),
+                     daemon=True).start()
   return path_dir
 
 
-def download_file(url, filename, override, md5=None):
-  f""" Download file and check the MD5 (if provided) """
+# ===========================================================================
+# For reading compressed files
+# ===========================================================================
+# sets of raw files accessed while a dataset is built, used for invalidating
+# the preprocessed snapshot (see `sisua.data.cache`)
+_RAW_FILES_TRACKER = []
+
+
+@contextmanager
+def track_raw_files():
+  r""" Collect absolute path of all raw files downloaded or decompressed
+  (i.e. via `download_file` and `read_compressed`) within the context """
+  files = set()
+  _RAW_FILES_TRACKER.append(files)
+  try:
+    yield files
+  finally:
+    _RAW_FILES_TRACKER.remove(files)
+
+
+def _track_raw_file(path):
+  for files in _RAW_FILES_TRACKER:
+    files.add(os.path.abspath(path))
+
+
+def download_file(url, filename, override=False, md5=None, n_segments=4,
+                  verbose=True):
+  r""" Download file and check the MD5 (if provided), the download is
+  resumable, parallel for large files, and honors the mirror given by the
+  environment variable `SISUA_MIRROR` (see `sisua.data.download`). """
+  from sisua.data.download import fetch_url
   if md5 is None:
     md5 = r""
-  from tqdm import tqdm
+  _track_raw_file(filename)
   if os.path.exists(filename) and os.path.isfile(filename):
     if override:
       os.remove(filename)
-    if len(md5) > 0:
+    elif len(md5) > 0:
       if md5 == md5_checksum(filename):
         return filename
       else:
@@ -61,20 +208,11 @@ def download_file(url, filename, override, md5=None):
         os.remove(filename)
     else:  # no MD5 provide just ignore the download if file exist
       return filename
-  prog = [None]
-
-  def progress(blocknum, blocksize, total):
-    if prog[0] is None:
-      prog[0] = tqdm(desc=f"Download {os.path.basename(filename)}",
-                     total=int(total / 1024. / 1024.) + 1,
-                     unit="MB")
-    prog[0].update(int(blocknum * blocksize / 1024. / 1024.) - prog[0].n)
-
-  urlretrieve(url=url, filename=filename, reporthook=progress)
-  prog[0].clear()
-  prog[0].close()
-  print(f"File '{filename}' md5:{md5_checksum(filename)}")
-  return filename
+  return fetch_url(url,
+                   filename,
+                   md5=md5,
+                   n_segments=n_segments,
+                   verbose=verbose)
 
 
 def read_r_matrix(matrix):
@@ -118,6 +256,7 @@ def read_compressed(in_file,
   if md5_download is None:
     md5_download = ''
   assert os.path.isfile(in_file)
+  _track_raw_file(in_file)
   ext = os.path.splitext(in_file.lower())[-1]
   extracted_name = {}
   opened_files = []
@@ -165,28 +304,66 @@ def read_compressed(in_file,
 # ===========================================================================
 # Data preprocessing
 # ===========================================================================
+def _corrupt_values(values, distribution, retain_rate, rand):
+  if distribution == "uniform":
+    # multiply the entry n with a Ber(retain_rate) random variable.
+    return values * rand.binomial(n=1, p=retain_rate, size=values.shape)
+  # only `retain_rate` of the expression is captured, Bin(n, retain_rate)
+  return rand.binomial(n=values.astype(np.int64), p=retain_rate)
+
+
+def _corrupt_block(values, dropout, distribution, retain_rate, rand):
+  r""" Corrupt a random subset of the non-zero entries of the flat `values`
+  inplace, return the positions of the corrupted entries """
+  nonzeros = np.flatnonzero(values)
+  n = int(np.floor(dropout * len(nonzeros)))
+  if n == 0:
+    return nonzeros[:0]
+  # O(n) sampling without replacement (no permutation of all entries)
+  ix = np.sort(nonzeros[rand.choice(len(nonzeros), size=n, replace=False)])
+  values[ix] = _corrupt_values(values[ix], distribution, retain_rate, rand)
+  return ix
+
+
 def apply_artificial_corruption(x,
                                 dropout=0.0,
                                 distribution='binomial',
                                 retain_rate=0.2,
                                 copy=False,
-                                seed=8):
-  r"""
+                                seed=8,
+                                return_rows=False,
+                                block_size=4096):
+  r""" Randomly select `dropout` percent of the non-zero entries, then
+  corrupt them by binomial thinning (i.e. each count is retained with
+  probability `retain_rate`) or by Bernoulli dropout (`'uniform'`).
+
+  The corruption is applied inplace on the `data` buffer of CSR/CSC matrix
+  (the structure is kept, corrupted entries become explicit zeros) or on
+  each block of `block_size` rows of dense/memory-mapped matrix. Each block
+  has its own random generator seeded by `(seed, block_index)`, the result
+  is reproducible for the same `seed` and `block_size`.
+
+  Arguments:
     x : (n_samples, n_features)
     dropout : scalar (0.0 - 1.0), how many entries (in percent) be selected for
       corruption.
     retain_rate : scalar (0.0 - 1.0), how much percent of counts retained
       their original values.
     distribution : {'uniform', 'binomial'}
+    return_rows : if True, also return the sorted indices of the corrupted
+      rows (i.e. the only rows that need updated library size)
+    block_size : number of rows (or columns for CSC matrix) corrupted at once.
   """
   distribution = str(distribution).lower()
   dropout = float(dropout)
   assert 0 <= dropout < 1, \
   "dropout value must be >= 0 and < 1, given: %f" % dropout
-  rand = np.random.RandomState(seed=seed)
-
+  if distribution not in ('uniform', 'binomial'):
+    raise ValueError(
+        "Only support 2 corruption distribution: 'uniform' and 'binomial', "
+        "but given: '%s'" % distribution)
   if not (0. < dropout < 1. or 0. < retain_rate < 1.):
-    return x
+    return (x, np.empty((0,), dtype=np.int64)) if return_rows else x
   # ====== applying corruption ====== #
   # Original code from scVI, to provide a comparable result,
   # please acknowledge the author of scVI if you are using this
@@ -194,40 +371,89 @@ def apply_artificial_corruption(x,
   # https://github.com/YosefLab/scVI/blob/2357dde15351450e452efa426c516c60a2d5ee96/scvi/dataset/dataset.py#L83
   # the test data won't be corrupted
   corrupted_x = deepcopy(x) if copy else x
-  # multiply the entry n with a Ber(0.9) random variable.
-  if distribution == "uniform":
-    i, j = np.nonzero(x)
-    ix = rand.choice(range(len(i)),
-                     size=int(np.floor(dropout * len(i))),
-                     replace=False)
-    i, j = i[ix], j[ix]
-    # multiply the entry n with a Bin(n, 0.9) random variable.
-    corrupted = np.multiply(
-        x[i, j], \
-        rand.binomial(n=np.ones(len(ix), dtype=np.int32), p=retain_rate))
-  elif distribution == "binomial":
-    # array representing the indices of a grid
-    # [0, 0, 0, ..., 1, 1, 1, ...]
-    # [0, 1, 2, ..., 0, 1, 2, ...]
-    # i, j = (k.ravel() for k in np.indices(x.shape))
-    i, j = np.nonzero(x)  # we prefer only nonzero here
-    ix = rand.choice(range(len(i)),
-                     size=int(np.floor(dropout * len(i))),
-                     replace=False)
-    i, j = i[ix], j[ix]
-    # only 20% expression captured
-    corrupted = rand.binomial(n=(x[i, j]).astype(np.int32), p=retain_rate)
+  if sparse.issparse(corrupted_x) and \
+    not isinstance(corrupted_x, (sparse.csr_matrix, sparse.csc_matrix)):
+    corrupted_x = corrupted_x.tocsr()
+  rows = []
+  block_size = max(1, int(block_size))
+  # ====== sparse: thinning the non-zero values inplace ====== #
+  if sparse.issparse(corrupted_x):
+    indptr = corrupted_x.indptr
+    data = corrupted_x.data
+    for i, s in enumerate(range(0, len(indptr) - 1, block_size)):
+      start = indptr[s]
+      end = indptr[min(s + block_size, len(indptr) - 1)]
+      values = np.array(data[start:end])
+      ix = _corrupt_block(values, dropout, distribution, retain_rate,
+                          np.random.default_rng([seed, i]))
+      if len(ix) > 0:
+        data[start + ix] = values[ix]
+        if return_rows:
+          ix = ix + start
+          rows.append(np.searchsorted(indptr, ix, side='right') - 1 if \
+            isinstance(corrupted_x, sparse.csr_matrix) else \
+              corrupted_x.indices[ix])
+  # ====== dense or memory-mapped: block of rows ====== #
   else:
-    raise ValueError(
-        "Only support 2 corruption distribution: 'uniform' and 'binomial', "
-        "but given: '%s'" % distribution)
-  # applying the corrupted values
-  if isinstance(corrupted_x, sparse.base.spmatrix):
-    corrupted = type(corrupted_x)(corrupted)
-  corrupted_x[i, j] = corrupted
+    n_features = corrupted_x.shape[1]
+    for i, s in enumerate(range(0, corrupted_x.shape[0], block_size)):
+      e = min(s + block_size, corrupted_x.shape[0])
+      values = np.array(corrupted_x[s:e]).ravel()
+      ix = _corrupt_block(values, dropout, distribution, retain_rate,
+                          np.random.default_rng([seed, i]))
+      if len(ix) > 0:
+        corrupted_x[s:e] = values.reshape(e - s, n_features)
+        if return_rows:
+          rows.append(ix // n_features + s)
+  if return_rows:
+    rows = np.unique(np.concatenate(rows)) if len(rows) > 0 else \
+      np.empty((0,), dtype=np.int64)
+    return corrupted_x, rows
   return corrupted_x
 
 
+def get_total_counts(X, rows=None, batch_size=4096) -> np.ndarray:
+  r""" Total counts of each row (i.e. the library size) as a float64 vector,
+  computed `batch_size` rows at a time, so dense, sparse and memory-mapped
+  matrices are never copied (or densified) as a whole.
+
+  Arguments:
+    rows : (optional) integer indices or boolean mask, only the total counts
+      of given rows are returned.
+  """
+  assert X.ndim == 2, "Only support 2-D matrix"
+  if rows is not None:
+    rows = np.asarray(rows)
+    if rows.dtype == np.bool_:
+      rows = np.nonzero(rows)[0]
+  n = X.shape[0] if rows is None else len(rows)
+  total_counts = np.empty(shape=(n,), dtype=np.float64)
+  for s in range(0, n, batch_size):
+    e = min(s + batch_size, n)
+    x = X[s:e] if rows is None else X[rows[s:e]]
+    if sparse.issparse(x):
+      # sparse matrix return `np.matrix` of shape (n_samples, 1)
+      total_counts[s:e] = np.asarray(x.sum(axis=1, dtype=np.float64)).ravel()
+    else:
+      total_counts[s:e] = np.sum(x, axis=1, dtype=np.float64)
+  return total_counts
+
+
+def library_statistics(total_counts):
+  r""" Return the `log_counts`, `local_mean` and `local_var` (i.e. the size
+  factor in log-space) of given total counts, all of shape `(n_samples, 1)`
+  in float64 """
+  total_counts = np.asarray(total_counts, dtype=np.float64).ravel()
+  if not np.all(total_counts >= 0):
+    warnings.warn(f"Some cell in {total_counts.shape[0]} cells contains "
+                  "negative-count, this results NaN log counts!")
+  log_counts = np.log(total_counts + 1e-8)
+  n = log_counts.shape[0]
+  local_mean = np.full((n, 1), np.mean(log_counts), dtype=np.float64)
+  local_var = np.full((n, 1), np.var(log_counts), dtype=np.float64)
+  return np.expand_dims(log_counts, axis=-1), local_mean, local_var
+
+
 def get_library_size(X, return_log_count=False):
   r""" Copyright scVI authors
   https://github.com/YosefLab/scVI/blob/master/README.rst
@@ -247,22 +473,57 @@ def get_library_size(X, return_log_count=False):
     local_mean (n_samples, 1)
     local_var (n_samples, 1)
   """
-  assert X.ndim == 2, "Only support 2-D matrix"
-  total_counts = X.sum(axis=1)
-  if not np.all(total_counts >= 0):
-    warnings.warn(f"Some cell in matrix {X.shape } contains negative-count, "
-                  "this results NaN log counts!")
-  log_counts = np.log(total_counts + 1e-8)
-  local_mean = (np.mean(log_counts) * np.ones(
-      (X.shape[0], 1))).astype(np.float32)
-  local_var = (np.var(log_counts) * np.ones((X.shape[0], 1))).astype(np.float32)
+  log_counts, local_mean, local_var = library_statistics(
+      get_total_counts(X))
+  local_mean = local_mean.astype(np.float32)
+  local_var = local_var.astype(np.float32)
   if not return_log_count:
     return local_mean, local_var
-  if log_counts.ndim < 2:
-    log_counts = np.expand_dims(log_counts, axis=-1)
   return log_counts, local_mean, local_var
 
 
+def dispersion_gene_subset(mean,
+                           var,
+                           n_top_genes=None,
+                           n_bins=20,
+                           min_mean=0.0125,
+                           max_mean=3,
+                           min_disp=0.5) -> np.ndarray:
+  r""" Highly variable genes from the per-gene mean and variance (`ddof=1`)
+  of the normalized counts, the same as the 'seurat' flavor of
+  `scanpy.pp.filter_genes_dispersion(X, log=False)`, but the statistics could
+  be accumulated chunk by chunk instead of holding `X` in memory.
+
+  Return:
+    a boolean mask of the selected genes
+  """
+  import pandas as pd
+  mean = np.array(mean, dtype=np.float64)
+  var = np.array(var, dtype=np.float64)
+  mean[mean == 0] = 1e-12
+  dispersion = var / mean
+  df = pd.DataFrame(dict(mean=mean, dispersion=dispersion))
+  df['mean_bin'] = pd.cut(df['mean'], bins=n_bins)
+  grouped = df.groupby('mean_bin', observed=True)['dispersion']
+  disp_mean_bin = grouped.mean()
+  disp_std_bin = grouped.std(ddof=1)
+  # a single gene in the bin has NaN std, its normalized dispersion is 1
+  one_gene_per_bin = disp_std_bin.isnull()
+  disp_std_bin[one_gene_per_bin] = disp_mean_bin[one_gene_per_bin].values
+  disp_mean_bin[one_gene_per_bin] = 0
+  bins = df['mean_bin'].values
+  dispersion_norm = ((df['dispersion'].values - disp_mean_bin[bins].values) /
+                     disp_std_bin[bins].values).astype(np.float32)
+  if n_top_genes is not None:
+    values = dispersion_norm[~np.isnan(dispersion_norm)]
+    values[::-1].sort()
+    cut_off = values[min(int(n_top_genes), len(values)) - 1]
+    return dispersion_norm >= cut_off
+  dispersion_norm[np.isnan(dispersion_norm)] = 0
+  return np.logical_and.reduce(
+      (mean > min_mean, mean < max_mean, dispersion_norm > min_disp))
+
+
 # ===========================================================================
 # Helpers
 # ===========================================================================
@@ -322,6 +583,31 @@ def standardize_protein_name(name):
 # ===========================================================================
 # Gene identifier processing
 # ===========================================================================
+def build_var_indices(var_names, suffix=False) -> dict:
+  r""" Hash index mapping variable names to their column indices.
+
+  If `suffix=True`, the name after the last '_' (e.g. 'ENSG00000_CD4' ->
+  'CD4') is also mapped unless it is the exact name of another variable, and
+  ambiguous names (duplicated names or suffixes) are mapped to -1. Otherwise,
+  the last occurrence of a duplicated name is kept.
+  """
+  indices = {}
+  for i, name in enumerate(var_names):
+    indices[name] = -1 if (suffix and name in indices) else i
+  if suffix:
+    variants = {}
+    for i, name in enumerate(var_names):
+      name = str(name)
+      if '_' not in name:
+        continue
+      key = name.split('_')[-1]
+      if key in indices:
+        continue
+      variants[key] = -1 if key in variants else i
+    indices.update(variants)
+  return indices
+
+
 def get_gene_id2name():
   r""" Return the mapping from gene identifier to gene symbol (i.e. name)
   for PBMC 8k data
@@ -343,11 +629,19 @@ def get_gene_id2name():
 def is_categorical_dtype(X):
   if not isinstance(X.dtype, np.number):
     return True
+  if sparse.issparse(X):
+    X = X.data
   return np.all(X.astype(np.int64) == X)
 
 
 def is_binary_dtype(X):
   r""" return True if the data is binary values, i.e. 0 or 1 """
+  if sparse.issparse(X):
+    # only the stored values are checked, implicit zeros are assumed
+    values = np.unique(X.data.astype(np.float32))
+    if X.nnz < np.prod(X.shape):
+      values = np.union1d(values, [0.])
+    return sorted(values) == [0., 1.]
   return sorted(np.unique(X.astype(np.float32))) == [0., 1.]
 
 
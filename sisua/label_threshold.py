@@ -1,7 +1,7 @@
 from __future__ import absolute_import, division, print_function
 
 import os
-import pickle
+import tempfile
 import warnings
 from collections import defaultdict
 
@@ -10,12 +10,13 @@ import numpy as np
 import seaborn as sns
 from matplotlib import pyplot as plt
 from scipy import stats
+from scipy.special import logsumexp
 from tqdm import tqdm
 
 from odin.stats import describe
-from odin.utils import (ArgController, Progbar, UnitTimer, auto_logging,
-                        batching, catch_warnings_ignore, ctext, get_script_path,
-                        is_number, mpi, unique_labels)
+from odin.utils import (MPI, ArgController, Progbar, UnitTimer, auto_logging,
+                        batching, catch_warnings_ignore, cpu_count, ctext,
+                        get_script_path, is_number, mpi, unique_labels)
 from odin.visual import (Visualizer, generate_random_colors, merge_text_graph,
                          plot_confusion_matrix, plot_figure, plot_histogram,
                          plot_histogram_layers, plot_save, print_dist)
@@ -52,9 +53,10 @@ def _clipping_quartile(x, alpha=1.5, test_mode=False):
   return x
 
 
-def _log_norm(x, scale_factor=10000):
+def _log_norm(x, scale_factor=10000, x_sum=None):
   x = x.astype('float32')
-  x_sum = np.sum(x)
+  if x_sum is None:
+    x_sum = np.sum(x)
   return np.log1p(x / (x_sum + np.finfo(x.dtype).eps) * scale_factor)
 
 
@@ -86,6 +88,134 @@ def _draw_hist(x, ax, title, n_bins, show_yticks=True):
   return count, bins
 
 
+def _get_column(X, i):
+  r""" Return dense 1-D column of dense, sparse or memory-mapped matrix """
+  x = X[:, i]
+  if hasattr(x, 'toarray'):
+    x = x.toarray()
+  return np.asarray(x).ravel()
+
+
+def _fit_gmm_1d(data,
+                n_components,
+                max_iter=120,
+                tol=1e-3,
+                reg_covar=1e-6,
+                init=None,
+                max_elements=2**24):
+  r""" Vectorized Expectation-Maximization for 1-D diagonal GMM, all columns
+  (i.e. list of 1-D arrays with different lengths) are fitted at once as
+  padded and masked array, in chunks of columns so that each chunk has at
+  most `max_elements` of `[n_columns, n_samples, n_components]`.
+
+  Arguments:
+    init : None or tuple of (weights, means, variances) each of shape
+      `[n_columns, n_components]`. If None, initialized by 1-D k-means
+      started from the quantiles of each column.
+
+  Return:
+    weights, means, variances : arrays of shape `[n_columns, n_components]`
+    converged, n_iter, lower_bound : arrays of shape `[n_columns]`
+  """
+  n_cols = len(data)
+  K = int(n_components)
+  n_max = max(len(x) for x in data)
+  chunk = max(1, int(max_elements // (n_max * K)))
+  weights = np.empty((n_cols, K), dtype=np.float64)
+  means = np.empty((n_cols, K), dtype=np.float64)
+  variances = np.empty((n_cols, K), dtype=np.float64)
+  converged = np.zeros((n_cols,), dtype=np.bool_)
+  n_iter = np.zeros((n_cols,), dtype=np.int32)
+  lower_bound = np.full((n_cols,), -np.inf, dtype=np.float64)
+  for start in range(0, n_cols, chunk):
+    end = min(start + chunk, n_cols)
+    cols = data[start:end]
+    C = len(cols)
+    N = max(len(x) for x in cols)
+    X = np.zeros((C, N), dtype=np.float64)
+    M = np.zeros((C, N), dtype=np.float64)
+    for i, x in enumerate(cols):
+      X[i, :len(x)] = x
+      M[i, :len(x)] = 1.
+    n = np.sum(M, axis=1)
+    ### initialization
+    if init is None:
+      # batched 1-D k-means started from the quantiles, then the parameters
+      # are estimated from the hard assignment (the same as sklearn 'kmeans')
+      q = (np.arange(K) + 0.5) / K
+      m = np.stack([np.quantile(x, q) for x in cols])
+      # spread identical initial centers, otherwise, they cannot be separated
+      same = np.ptp(m, axis=1) == 0
+      if np.any(same):
+        std = np.sqrt(np.stack([np.var(x) for x in cols]))[same]
+        m[same] += std[:, None] * np.linspace(-0.5, 0.5, K)
+      for _ in range(max_iter):
+        labels = np.argmin(np.abs(X[:, :, None] - m[:, None, :]), axis=2)
+        resp = (labels[:, :, None] == np.arange(K)) * M[:, :, None]
+        nk = np.sum(resp, axis=1)
+        new_m = np.sum(resp * X[:, :, None], axis=1) / np.maximum(nk, 1)
+        new_m = np.where(nk > 0, new_m, m)
+        if np.allclose(new_m, m):
+          break
+        m = new_m
+      nk = nk + 10 * np.finfo(np.float64).eps
+      w = nk / n[:, None]
+      v = np.sum(resp * (X[:, :, None] - m[:, None, :])**2, axis=1) / nk + \
+        reg_covar
+    else:
+      w, m, v = [np.array(i[start:end], dtype=np.float64) for i in init]
+    ### EM
+    prev = np.full((C,), -np.inf)
+    done = np.zeros((C,), dtype=np.bool_)
+    for it in range(1, int(max_iter) + 1):
+      # E-step
+      log_prob = np.log(w)[:, None, :] - 0.5 * (
+          np.log(2 * np.pi * v)[:, None, :] +
+          (X[:, :, None] - m[:, None, :])**2 / v[:, None, :])
+      log_norm = logsumexp(log_prob, axis=2)
+      resp = np.exp(log_prob - log_norm[:, :, None]) * M[:, :, None]
+      curr = np.sum(log_norm * M, axis=1) / n
+      # M-step, the converged columns are kept fixed
+      nk = np.sum(resp, axis=1) + 10 * np.finfo(resp.dtype).eps
+      new_m = np.sum(resp * X[:, :, None], axis=1) / nk
+      new_v = np.sum(resp * (X[:, :, None] - new_m[:, None, :])**2,
+                     axis=1) / nk + reg_covar
+      new_w = nk / n[:, None]
+      active = ~done
+      m[active] = new_m[active]
+      v[active] = new_v[active]
+      w[active] = new_w[active]
+      n_iter[start:end][active] = it
+      lower_bound[start:end][active] = curr[active]
+      done |= np.abs(curr - prev) < tol
+      prev = curr
+      if np.all(done):
+        break
+    weights[start:end] = w
+    means[start:end] = m
+    variances[start:end] = v
+    converged[start:end] = done
+  return weights, means, variances, converged, n_iter, lower_bound
+
+
+def _create_gmm(weights, means, variances, random_state=None, converged=True,
+                n_iter=0, lower_bound=-np.inf):
+  r""" Create fitted 1-D diagonal `GaussianMixture` from its parameters """
+  gmm = GaussianMixture(n_components=len(weights),
+                        covariance_type='diag',
+                        random_state=random_state)
+  gmm.weights_ = np.asarray(weights, dtype=np.float64)
+  gmm.means_ = np.asarray(means, dtype=np.float64).reshape(-1, 1)
+  gmm.covariances_ = np.asarray(variances, dtype=np.float64).reshape(-1, 1)
+  gmm.precisions_ = 1. / gmm.covariances_
+  gmm.precisions_cholesky_ = 1. / np.sqrt(gmm.covariances_)
+  gmm.converged_ = bool(converged)
+  gmm.n_iter_ = int(n_iter)
+  gmm.lower_bound_ = float(lower_bound)
+  gmm.n_features_in_ = 1
+  return gmm
+
+
 class _DummyGMM():
   def __init__(self):
     self.means_ = None
@@ -118,6 +248,16 @@ class ProbabilisticEmbedding(BaseEstimator, DensityMixin, Visualizer):
     log_norm : bool
     clip_quartile : float
     ci_threshold : float
+    algorithm : {'sklearn', 'batched'}
+      'sklearn' fits one `GaussianMixture` (n_init=8) per column, 'batched'
+      fits all columns at once by a vectorized 1-D EM (initialized by 1-D
+      k-means), much faster for large number of columns.
+    n_jobs : int
+      number of processes for fitting the columns with 'sklearn' algorithm,
+      negative value means all CPUs but `|n_jobs| - 1`.
+    warm_start : bool
+      if True, refitting initializes the GMMs from the previously fitted
+      parameters (e.g. when fitting on new cells).
     random_state: int
     verbose: bool
 
@@ -130,6 +270,9 @@ class ProbabilisticEmbedding(BaseEstimator, DensityMixin, Visualizer):
                clip_quartile=0.,
                remove_zeros=True,
                ci_threshold=-0.68,
+               algorithm='sklearn',
+               n_jobs=1,
+               warm_start=False,
                random_state=8,
                verbose=False):
     super(ProbabilisticEmbedding, self).__init__()
@@ -145,6 +288,13 @@ class ProbabilisticEmbedding(BaseEstimator, DensityMixin, Visualizer):
     assert 0 <= np.abs(ci_threshold) <= 1
     self.ci_threshold = ci_threshold
 
+    algorithm = str(algorithm).lower().strip()
+    assert algorithm in ('sklearn', 'batched'), \
+      f"Only support algorithm 'sklearn' or 'batched', given: {algorithm}"
+    self.algorithm = algorithm
+    self.n_jobs = int(n_jobs)
+    self.warm_start = bool(warm_start)
+
     self.verbose = bool(verbose)
     self.random_state = random_state
     self._models = []
@@ -182,7 +332,9 @@ class ProbabilisticEmbedding(BaseEstimator, DensityMixin, Visualizer):
     ])
 
   # ******************** main ******************** #
-  def normalize(self, x, test_mode=False):
+  def normalize(self, x, test_mode=False, x_sum=None):
+    r""" `x_sum` is the sum used for log-normalization, if None, the sum of
+    `x` after removing the outliers """
     if x.ndim > 1:
       x = x.ravel()
     n_samples = len(x)
@@ -194,73 +346,259 @@ class ProbabilisticEmbedding(BaseEstimator, DensityMixin, Visualizer):
     if self.clip_quartile > 0:
       x = _clipping_quartile(x, alpha=self.clip_quartile, test_mode=test_mode)
     if self.log_norm:
-      x = _log_norm(x)
+      x = _log_norm(x, x_sum=x_sum)
     return x
 
-  def fit(self, X):
-    assert X.ndim == 2, "Only support input matrix but given: %s" % str(X.shape)
-    n_classes = X.shape[1]
-    it = tqdm(list(range(n_classes))) if self.verbose else range(n_classes)
-    for i in it:
-      # ====== normalizing ====== #
-      x_train = self.normalize(X[:, i], test_mode=False)
-      # ====== GMM ====== #
-      try:
+  def _fit_sklearn(self, x_train, init=None):
+    try:
+      if init is None:
         gmm = GaussianMixture(n_components=self.n_components_per_class,
                               covariance_type='diag',
                               init_params='kmeans',
                               n_init=8,
                               max_iter=120,
                               random_state=self.random_state)
+      else:
+        gmm = GaussianMixture(n_components=self.n_components_per_class,
+                              covariance_type='diag',
+                              weights_init=init.weights_,
+                              means_init=init.means_,
+                              precisions_init=init.precisions_,
+                              n_init=1,
+                              max_iter=120,
+                              random_state=self.random_state)
+      gmm.fit(x_train[:, np.newaxis])
+    except ValueError as e:
+      if "ill-defined empirical covariance" in str(e):
+        gmm = _DummyGMM()
         gmm.fit(x_train[:, np.newaxis])
-      except ValueError as e:
-        if "ill-defined empirical covariance" in str(e):
-          gmm = _DummyGMM()
-          gmm.fit(x_train[:, np.newaxis])
-        else:
-          import traceback
-          traceback.print_exc()
-          raise e
-      # ====== save GMM ====== #
-      means_ = gmm.means_.ravel()
-      order = np.argsort(means_)
+      else:
+        import traceback
+        traceback.print_exc()
+        raise e
+    return gmm
+
+  def _fit_batched(self, data, init=None):
+    K = self.n_components_per_class
+    gmms = [None] * len(data)
+    # columns with less distinct values than components are ill-defined
+    valid = []
+    for i, x in enumerate(data):
+      if len(np.unique(x)) < K:
+        gmms[i] = _DummyGMM()
+        gmms[i].fit(x[:, np.newaxis])
+      else:
+        valid.append(i)
+    # the columns with previous GMM are warm-started, the others (e.g. the
+    # previous model is `_DummyGMM`) are initialized by k-means
+    if init is None:
+      init = [None] * len(data)
+    warm = [i for i in valid if isinstance(init[i], GaussianMixture)]
+    cold = [i for i in valid if not isinstance(init[i], GaussianMixture)]
+    for cols, warm_start in ((cold, False), (warm, True)):
+      if len(cols) == 0:
+        continue
+      init_params = None
+      if warm_start:
+        init_params = (np.stack([init[i].weights_ for i in cols]),
+                       np.stack([init[i].means_.ravel() for i in cols]),
+                       np.stack([init[i].covariances_.ravel() for i in cols]))
+      weights, means, variances, converged, n_iter, lower_bound = _fit_gmm_1d(
+          [data[i] for i in cols],
+          n_components=K,
+          max_iter=120,
+          init=init_params)
+      for j, i in enumerate(cols):
+        gmms[i] = _create_gmm(weights[j],
+                              means[j],
+                              variances[j],
+                              random_state=self.random_state,
+                              converged=converged[j],
+                              n_iter=n_iter[j],
+                              lower_bound=lower_bound[j])
+    return gmms
+
+  def fit(self, X, column_sums=None):
+    r""" Fit a GMM for each column of `X`
+
+    Arguments:
+      X : a matrix `[n_samples, n_classes]`
+      column_sums : an array `[n_classes]` (optional), the sums used for
+        log-normalizing the columns instead of the sums of `X`, e.g. the sums
+        of the whole dataset when `X` is only a subsample of it.
+    """
+    assert X.ndim == 2, "Only support input matrix but given: %s" % str(X.shape)
+    n_classes = X.shape[1]
+    if column_sums is not None:
+      column_sums = np.asarray(column_sums, dtype='float32').ravel()
+      assert len(column_sums) == n_classes, \
+        f"Expect {n_classes} column sums, but given: {len(column_sums)}"
+    # previous models for warm-starting
+    init = [None] * n_classes
+    if self.warm_start and self.n_classes == n_classes:
+      init = [None if isinstance(gmm, _DummyGMM) else gmm \
+        for _, gmm in self._models]
+    # ====== normalizing ====== #
+    normalize = lambda i: self.normalize(
+        _get_column(X, i),
+        test_mode=False,
+        x_sum=None if column_sums is None else column_sums[i])
+    # ====== GMM ====== #
+    if self.algorithm == 'batched':
+      gmms = self._fit_batched([normalize(i) for i in range(n_classes)],
+                               init=init)
+    else:
+      n_jobs = self.n_jobs if self.n_jobs > 0 else \
+        max(1, cpu_count() + 1 + self.n_jobs)
+      if n_jobs == 1 or n_classes == 1:
+        it = tqdm(list(range(n_classes))) if self.verbose else range(n_classes)
+        gmms = [self._fit_sklearn(normalize(i), init[i]) for i in it]
+      else:
+        gmms = [None] * n_classes
+        fit_column = lambda i: (i, self._fit_sklearn(normalize(i), init[i]))
+        for i, gmm in MPI(list(range(n_classes)),
+                          func=fit_column,
+                          ncpu=min(n_jobs, n_classes),
+                          batch=1):
+          gmms[i] = gmm
+    # ====== save GMM ====== #
+    self._models = []
+    self._stacked = None
+    for gmm in gmms:
+      order = np.argsort(gmm.means_.ravel())
       self._models.append((order, gmm))
+    return self
 
   def fit_transform(self, X, return_probabilities=True):
     self.fit(X)
     return self.predict_proba(X) if return_probabilities else self.predict(X)
 
-  def _predict(self, X, threshold):
-    assert X.shape[1] == self.n_classes, "Number of classes mis-match"
-    y = []
+  # ******************** vectorized prediction ******************** #
+  def _stacked_parameters(self):
+    r""" All GMMs parameters packed into arrays of shape
+    `[n_classes, n_components]` sorted by increasing means, the `_DummyGMM`
+    is represented by identical components at its mean. """
+    params = getattr(self, '_stacked', None)
+    if params is not None and params[0].shape[0] == self.n_classes:
+      return params
+    K = max([len(order) for order, _ in self._models] + [1])
+    weights = np.full((self.n_classes, K), 1. / K)
+    means = np.empty((self.n_classes, K))
+    variances = np.empty((self.n_classes, K))
+    dummy = np.zeros((self.n_classes,), dtype=np.bool_)
     for i, (order, gmm) in enumerate(self._models):
-      x_test = self.normalize(X[:, i], test_mode=True)
-      # binary thresholding
       if isinstance(gmm, _DummyGMM):
-        x_out = gmm.predict(x_test)
-      elif threshold is not None:
-        ci = stats.norm.interval(
-            np.abs(threshold),
-            loc=gmm.means_[order[self.positive_component]],
-            scale=np.sqrt(1 / gmm.precisions_[order[self.positive_component]]))
-        x_out = (x_test >=
-                 (ci[0] if threshold < 0 else ci[1])).astype('float32')
-      # probabilizing
+        dummy[i] = True
+        means[i] = gmm.means_[0]
+        variances[i] = 1. / gmm.precisions_[0]
       else:
-        probas = gmm.predict_proba(
-            x_test[:, np.newaxis]).T[order][self.positive_component:]
-        x_out = np.mean(probas, axis=0)
-      x_out = x_out[:, np.newaxis]
-      y.append(x_out)
-    return np.concatenate(y, axis=1)
-
-  def predict(self, X):
-    return self._predict(X, threshold=self.ci_threshold)
+        weights[i] = gmm.weights_[order]
+        means[i] = gmm.means_.ravel()[order]
+        variances[i] = gmm.covariances_.ravel()[order]
+    self._stacked = (weights, means, variances, dummy)
+    return self._stacked
+
+  def _normalization_statistics(self, X, batch_size):
+    r""" Column statistics for normalizing in test mode (i.e. the quartile
+    clipping range and the column sums), computed over all rows so the
+    streaming chunks are normalized the same as the whole matrix. """
+    n_samples, n_classes = X.shape
+    low, high = None, None
+    if self.clip_quartile > 0:
+      if isinstance(X, np.ndarray) and not isinstance(X, np.memmap):
+        q1, q3 = np.percentile(X.astype('float32'), q=[25, 75], axis=0)
+      else:  # only one column is loaded at a time
+        q1, q3 = np.stack([
+            np.percentile(_get_column(X, i).astype('float32'), q=[25, 75])
+            for i in range(n_classes)
+        ],
+                          axis=1)
+      iqr = q3 - q1
+      low = q1 - self.clip_quartile * iqr
+      high = q3 + self.clip_quartile * iqr
+    total = np.zeros((n_classes,), dtype=np.float64)
+    if self.log_norm:
+      for s, e in batching(batch_size=batch_size, n=n_samples):
+        x = self._dense_chunk(X[s:e])
+        if low is not None:
+          x = np.clip(x, low, high)
+        total += np.sum(x, axis=0)
+    return low, high, total.astype('float32')
+
+  def _dense_chunk(self, x):
+    if hasattr(x, 'toarray'):
+      x = x.toarray()
+    x = np.asarray(x, dtype='float32')
+    assert np.all(x >= 0), "Only support non-negative values"
+    return x
 
-  def predict_proba(self, X):
-    return self._predict(X, threshold=None)
+  def _normalize_chunk(self, x, statistics):
+    low, high, total = statistics
+    x = self._dense_chunk(x)
+    if low is not None:
+      x = np.clip(x, low, high)
+    if self.log_norm:
+      x = np.log1p(x / (total + np.finfo(x.dtype).eps) * 10000)
+    return x
 
-  def score_samples(self, X):
+  def _log_prob(self, x):
+    r""" Return log-probability of shape `[n_samples, n_classes, n_comp]` """
+    weights, means, variances, _ = self._stacked_parameters()
+    x = x[:, :, np.newaxis].astype(np.float64)
+    # zero variance of `_DummyGMM`, its outputs are replaced anyway
+    with np.errstate(divide='ignore', invalid='ignore'):
+      return np.log(weights) - 0.5 * (np.log(2 * np.pi * variances) +
+                                      (x - means)**2 / variances)
+
+  def _predict(self, X, threshold, batch_size=None, out=None):
+    r""" Thresholding (if `threshold` is given) or the probabilities of the
+    positive components for all columns at once, `X` is processed in chunks
+    of `batch_size` rows (if None, choose the chunk to keep the temporary
+    `[batch_size, n_classes, n_components]` arrays below 16M elements).
+    The results are written to `out` (e.g. a memory-mapped array) if given.
+    """
+    assert X.shape[1] == self.n_classes, "Number of classes mis-match"
+    weights, means, variances, dummy = self._stacked_parameters()
+    if batch_size is None:
+      batch_size = max(1, 2**24 // (self.n_classes * means.shape[1]))
+    statistics = self._normalization_statistics(X, batch_size)
+    # thresholds of the positive component
+    if threshold is not None:
+      z = stats.norm.ppf(0.5 + np.abs(threshold) / 2)
+      loc = means[:, self.positive_component]
+      scale = np.sqrt(variances[:, self.positive_component])
+      cutoff = loc - z * scale if threshold < 0 else loc + z * scale
+      cutoff = np.where(dummy, means[:, 0], cutoff)
+    if out is None:
+      y = np.empty(shape=X.shape, dtype='float32')
+    else:
+      assert out.shape == X.shape, \
+        f"Output shape {out.shape} mismatch input shape {X.shape}"
+      y = out
+    for s, e in batching(batch_size=batch_size, n=X.shape[0]):
+      x_test = self._normalize_chunk(X[s:e], statistics)
+      # binary thresholding
+      if threshold is not None:
+        y[s:e] = x_test >= cutoff
+      # probabilizing
+      else:
+        log_prob = self._log_prob(x_test)
+        resp = np.exp(log_prob -
+                      logsumexp(log_prob, axis=2, keepdims=True))
+        probas = np.mean(resp[:, :, self.positive_component:], axis=2)
+        y[s:e] = np.where(dummy, x_test >= means[:, 0], probas)
+    return y
+
+  def predict(self, X, batch_size=None, out=None):
+    return self._predict(X,
+                         threshold=self.ci_threshold,
+                         batch_size=batch_size,
+                         out=out)
+
+  def predict_proba(self, X, batch_size=None, out=None):
+    return self._predict(X, threshold=None, batch_size=batch_size, out=out)
+
+  def score_samples(self, X, batch_size=None):
     """Compute the weighted log probabilities for each sample.
 
     Parameters
@@ -274,12 +612,16 @@ class ProbabilisticEmbedding(BaseEstimator, DensityMixin, Visualizer):
     log_prob : array, shape (n_samples,)
         Log probabilities of each data point in X.
     """
-    scores = []
-    for x, (order, gmm) in zip(X.T, self._models):
-      x = self.normalize(x, test_mode=True)
-      s = gmm.score_samples(x[:, np.newaxis])[:, np.newaxis]
-      scores.append(s)
-    return np.mean(np.hstack(scores), axis=1)
+    assert X.shape[1] == self.n_classes, "Number of classes mis-match"
+    _, means, _, _ = self._stacked_parameters()
+    if batch_size is None:
+      batch_size = max(1, 2**24 // (self.n_classes * means.shape[1]))
+    statistics = self._normalization_statistics(X, batch_size)
+    scores = np.empty(shape=(X.shape[0],), dtype=np.float64)
+    for s, e in batching(batch_size=batch_size, n=X.shape[0]):
+      x_test = self._normalize_chunk(X[s:e], statistics)
+      scores[s:e] = np.mean(logsumexp(self._log_prob(x_test), axis=2), axis=1)
+    return scores
 
   def score(self, X, y=None):
     """Compute the per-sample average log-likelihood of the given data X.
@@ -469,6 +811,65 @@ class ProbabilisticEmbedding(BaseEstimator, DensityMixin, Visualizer):
 # ===========================================================================
 # Main
 # ===========================================================================
+def _read_csv(path, chunk_size=100000):
+  r""" Return the column names and an iterator of float32 chunks of
+  `chunk_size` rows parsed by the C engine of `pandas`, the header is
+  detected from the first line (if not all values are numbers). """
+  import pandas as pd
+  with open(path, 'r') as f:
+    header = f.readline().strip().split(',')
+  has_header = not all(is_number(i, string_number=True) for i in header)
+  if has_header:
+    names = np.array(header)
+  else:
+    names = np.array(['#%d' % i for i in range(len(header))])
+  reader = pd.read_csv(path,
+                       header=None,
+                       skiprows=1 if has_header else 0,
+                       dtype=np.float32,
+                       chunksize=int(chunk_size),
+                       engine='c')
+  return names, (np.ascontiguousarray(chunk.values) for chunk in reader)
+
+
+def _stream_csv(path, chunk_size=100000, n_samples=100000, seed=1):
+  r""" Parse the CSV file chunk by chunk into a memory-mapped float32 matrix
+  (backed by an anonymous temporary file), a uniform subsample of
+  `n_samples` rows (reservoir sampling) and the column sums are collected in
+  the same pass.
+
+  Return:
+    names, X, X_sample, column_sums
+  """
+  names, chunks = _read_csv(path, chunk_size=chunk_size)
+  n_features = len(names)
+  rand = np.random.RandomState(seed)
+  f = tempfile.TemporaryFile()
+  sample = np.empty(shape=(n_samples, n_features), dtype='float32')
+  column_sums = np.zeros(shape=(n_features,), dtype=np.float64)
+  n = 0
+  for x in chunks:
+    assert x.shape[1] == n_features, \
+      f"Expect {n_features} columns, but given chunk: {x.shape}"
+    x.tofile(f)
+    column_sums += np.sum(x, axis=0, dtype=np.float64)
+    # fill the reservoir, then replace its rows with decreasing probability
+    m = x.shape[0]
+    n_fill = min(m, max(0, n_samples - n))
+    sample[n:n + n_fill] = x[:n_fill]
+    if n_fill < m:
+      ids = rand.randint(0, np.arange(n + n_fill, n + m) + 1)
+      mask = ids < n_samples
+      sample[ids[mask]] = x[n_fill:][mask]
+    n += m
+  f.flush()
+  if n == 0:
+    X = np.empty(shape=(0, n_features), dtype='float32')
+  else:
+    X = np.memmap(f, dtype='float32', mode='r', shape=(n, n_features))
+  return names, X, sample[:min(n, n_samples)], column_sums.astype('float32')
+
+
 def get_arguments():
   args = ArgController().add(
       "input", "Name of the dataset or path to csv file").add(
@@ -477,27 +878,26 @@ def get_arguments():
                  1).add("-norm", "method for normalizing: raw, log", 'log',
                         ('log', 'raw')).add(
                             "-outpath",
-                            "y_bin and y_prob will be saved to this path",
-                            '').add("-figpath",
-                                    "path for saving analysis figure",
-                                    '/tmp/tmp.pdf').add(
-                                        "--verbose",
-                                        "Enable verbose and saving diagnosis",
-                                        False).parse()
+                            "y_bin.npy and y_prob.npy will be saved to this "
+                            "path", '').add(
+                                "-figpath", "path for saving analysis figure",
+                                '/tmp/tmp.pdf').add(
+                                    "-chunk",
+                                    "number of csv rows processed at a time",
+                                    100000).add(
+                                        "-sample",
+                                        "number of rows sampled for fitting",
+                                        100000).add(
+                                            "--verbose",
+                                            "Enable verbose and saving "
+                                            "diagnosis", False).parse()
   inp = str(args.input)
+  y_train = None
+  column_sums = None
   if os.path.exists(inp):
     assert os.path.isfile(inp), "%s must be path to a file" % inp
-    data = []
-    with open(inp, 'r') as f:
-      for line in f:
-        data.append(line.strip().split(','))
-    data = np.array(data)
-    if all(is_number(i, string_number=True) for i in data[0]):
-      y_prot = data.astype('float32')
-      y_prot_names = np.array(['#%d' % i for i in range(y_prot.shape[1])])
-    else:
-      y_prot = data[1:].astype('float32')
-      y_prot_names = data[0]
+    y_prot_names, y_prot, y_train, column_sums = _stream_csv(
+        inp, chunk_size=int(args.chunk), n_samples=int(args.sample))
     outpath = args.outpath
   else:
     from sisua.data import get_dataset
@@ -508,17 +908,22 @@ def get_arguments():
   return {
       'y_prot': y_prot,
       'y_prot_names': y_prot_names,
+      'y_train': y_train,
+      'column_sums': column_sums,
       'n_components': int(args.n),
       'index': int(args.idx),
       'log_norm': True if args.norm == 'log' else False,
       'outpath': outpath if len(outpath) > 0 else None,
       'figpath': args.figpath if len(args.figpath) > 0 else None,
+      'batch_size': int(args.chunk),
       'verbose': bool(args.verbose)
   }
 
 
 def main(y_prot,
          y_prot_names,
+         y_train=None,
+         column_sums=None,
          n_components=2,
          index=1,
          log_norm=True,
@@ -527,10 +932,16 @@ def main(y_prot,
          ci_threshold=-0.68,
          outpath=None,
          figpath=None,
+         batch_size=None,
          verbose=False):
+  r""" Fit the `ProbabilisticEmbedding` on `y_train` (if None, the whole
+  `y_prot`), then predict `y_prot` chunk by chunk, the results are written to
+  memory-mapped `y_bin.npy` and `y_prob.npy` at `outpath` (if given). """
+  if y_train is None:
+    y_train = y_prot
   if outpath is not None:
-    bin_path = os.path.join(outpath, 'y_bin')
-    prob_path = os.path.join(outpath, 'y_prob')
+    bin_path = os.path.join(outpath, 'y_bin.npy')
+    prob_path = os.path.join(outpath, 'y_prob.npy')
   if verbose:
     print("Start label thresholding:")
     print("  Output path:", ctext(outpath, 'yellow'))
@@ -539,8 +950,9 @@ def main(y_prot,
   if verbose:
     print("  Protein labels:", ctext(', '.join(y_prot_names), 'cyan'))
     print("  Protein matrix:", ctext(y_prot.shape, 'cyan'))
+    print("  Fitting matrix:", ctext(y_train.shape, 'cyan'))
   # ====== already binarized ====== #
-  if len(np.unique(y_prot)) == 2:
+  if len(np.unique(y_train)) == 2:
     warnings.warn("y is already binarized!")
     exit()
   # ====== PB ====== #
@@ -551,12 +963,22 @@ def main(y_prot,
                               remove_zeros=remove_zeros,
                               ci_threshold=ci_threshold,
                               verbose=verbose)
-  pb.fit(y_prot)
-  y_bin = pb.predict(y_prot)
-  y_prob = pb.predict_proba(y_prot)
+  pb.fit(y_train, column_sums=column_sums)
+  y_bin, y_prob = None, None
+  if outpath is not None:
+    y_bin = np.lib.format.open_memmap(bin_path,
+                                      mode='w+',
+                                      dtype='float32',
+                                      shape=y_prot.shape)
+    y_prob = np.lib.format.open_memmap(prob_path,
+                                       mode='w+',
+                                       dtype='float32',
+                                       shape=y_prot.shape)
+  y_bin = pb.predict(y_prot, batch_size=batch_size, out=y_bin)
+  y_prob = pb.predict_proba(y_prot, batch_size=batch_size, out=y_prob)
   if verbose:
     print("  Thresholded values:")
-    print("   Original     :", ctext(describe(y_prot, shorten=True),
+    print("   Original     :", ctext(describe(y_train, shorten=True),
                                      'lightcyan'))
     print("   Binarized    :", ctext(describe(y_bin, shorten=True),
                                      'lightcyan'))
@@ -564,19 +986,16 @@ def main(y_prot,
                                      'lightcyan'))
   # ====== save the results ====== #
   if outpath is not None:
-    with open(bin_path, 'wb') as f:
-      pickle.dump(y_bin, f)
-      if verbose:
-        print("  Save binarized data to:", ctext(bin_path, 'yellow'))
-    with open(prob_path, 'wb') as f:
-      pickle.dump(y_prob, f)
-      if verbose:
-        print("  Save probabilized data to:", ctext(prob_path, 'yellow'))
+    y_bin.flush()
+    y_prob.flush()
+    if verbose:
+      print("  Save binarized data to:", ctext(bin_path, 'yellow'))
+      print("  Save probabilized data to:", ctext(prob_path, 'yellow'))
   # ====== save figure ====== #
   if figpath is not None:
-    pb.boxplot(y_prot, y_prot_names).plot_diagnosis(
-        y_prot, y_prot_names).plot_distribution(
-            y_prot, y_prot_names).save_figures(path=figpath, verbose=verbose)
+    pb.boxplot(y_train, y_prot_names).plot_diagnosis(
+        y_train, y_prot_names).plot_distribution(
+            y_train, y_prot_names).save_figures(path=figpath, verbose=verbose)
 
 
 if __name__ == '__main__':
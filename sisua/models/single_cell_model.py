@@ -41,9 +41,16 @@ __all__ = [
 ]
 
 
-def _to_data(x, batch_size=64) -> Dataset:
+def _to_data(x, batch_size=64, ordered=False) -> Dataset:
+  r""" If `ordered=True`, the dataset iterates all the samples in the original
+  order (i.e. no shuffling and the remainder batch is kept) """
   if isinstance(x, SingleCellOMIC):
-    inputs = x.create_dataset(batch_size=batch_size)
+    if ordered:
+      inputs = x.create_dataset(batch_size=batch_size,
+                                shuffle=0,
+                                drop_remainder=False)
+    else:
+      inputs = x.create_dataset(batch_size=batch_size)
   elif isinstance(x, DatasetV2):
     inputs = x
   # given numpy ndarrays
@@ -57,10 +64,59 @@ def _to_data(x, batch_size=64) -> Dataset:
         inputs.add_omic(omic=om_random, X=arr)
     inputs = inputs.create_dataset(inputs.omics,
                                    batch_size=batch_size,
-                                   drop_remainder=True)
+                                   drop_remainder=not ordered,
+                                   shuffle=0 if ordered else 1000)
   return inputs
 
 
+def _n_samples(x) -> int:
+  r""" Number of samples, or None if unknown (i.e. a `tf.data.Dataset`) """
+  if isinstance(x, SingleCellOMIC):
+    return x.n_obs
+  if isinstance(x, DatasetV2):
+    return None
+  return tf.nest.flatten(x)[0].shape[0]
+
+
+# ===========================================================================
+# Reducers for predict_reduced
+# ===========================================================================
+def _sample_mean(d) -> tf.Tensor:
+  x = d.mean()
+  # [sample_shape, batch_size, n_features]
+  if x.shape.ndims == 3:
+    x = tf.reduce_mean(x, axis=0)
+  return x
+
+
+def _reduce_mean(pX_Z, qZ_X, data):
+  r""" Mean of each output distribution, averaged over the MCMC samples """
+  return tuple(_sample_mean(p) for p in tf.nest.flatten(pX_Z))
+
+
+def _reduce_latent_mean(pX_Z, qZ_X, data):
+  r""" Mean of each latent distribution """
+  return tuple(_sample_mean(q) for q in tf.nest.flatten(qZ_X))
+
+
+def _reduce_log_prob(pX_Z, qZ_X, data):
+  r""" Log-likelihood of each cell marginalized over the MCMC samples, only
+  for the outputs which have the corresponding inputs """
+  llk = []
+  for p, x in zip(tf.nest.flatten(pX_Z), tf.nest.flatten(data['inputs'])):
+    l = p.log_prob(x)
+    if l.shape.ndims == 1:
+      l = tf.expand_dims(l, axis=0)
+    n = tf.cast(tf.shape(l)[0], l.dtype)
+    llk.append(tf.reduce_logsumexp(l, axis=0) - tf.math.log(n))
+  return tuple(llk)
+
+
+_REDUCERS = dict(mean=_reduce_mean,
+                 latent_mean=_reduce_latent_mean,
+                 log_prob=_reduce_log_prob)
+
+
 # ===========================================================================
 # SingleCell model
 # ===========================================================================
@@ -210,6 +266,120 @@ class SingleCellModel(BetaVAE, Visualizer):
         Z = concat_distributions(Z, axis=0)
     return X, Z
 
+  def predict_reduced(self,
+                      inputs,
+                      reducers=('mean', 'latent_mean'),
+                      sample_shape=(),
+                      batch_size=32,
+                      path=None,
+                      verbose=True,
+                      device="GPU"):
+    r""" Predict on minibatches and only keep the reduced outputs, the
+    distributions are reduced inside a compiled `tf.function` and the
+    results are written into preallocated arrays as the batches complete.
+
+    Arguments:
+      inputs : `SingleCellOMIC`, `numpy.ndarray` (or list of them) or
+        `tf.data.Dataset`. The samples are predicted in the original order.
+      reducers : list of reducers, a reducer is a name in
+        {'mean', 'latent_mean', 'log_prob'} or a callable
+        `reducer(pX_Z, qZ_X, data)` that returns a Tensor (or tuple of
+        Tensors) with the batch as the first dimension (the name of the
+        callable is used as key). A dictionary mapping name to reducer is
+        also accepted.
+        - 'mean' : mean of the outputs, averaged over the MCMC samples.
+        - 'latent_mean' : mean of the latents.
+        - 'log_prob' : log-likelihood of the inputs for each cell.
+      path : a String (optional), folder for storing the results as
+        memory-mapped `.npy` files.
+
+    Return:
+      a Dictionary : mapping the reducer's name to an array, or tuple of
+        arrays in case of multiple outputs (or latents).
+
+    Example:
+    ```
+    results = model.predict_reduced(x_test, reducers=['mean', 'latent_mean'])
+    imputed, Z = results['mean'], results['latent_mean']
+    ```
+    """
+    assert device in ("CPU", "GPU"), \
+      f"Only support device CPU or GPU, but given: {device}"
+    if not isinstance(reducers, dict):
+      reducers = OrderedDict([
+          (r, r) if isinstance(r, string_types) else (r.__name__, r)
+          for r in tf.nest.flatten(reducers)
+      ])
+    fn_reducers = OrderedDict()
+    for name, fn in reducers.items():
+      if isinstance(fn, string_types):
+        assert fn in _REDUCERS, \
+          f"Unknown reducer '{fn}', support: {list(_REDUCERS.keys())}"
+        fn = _REDUCERS[fn]
+      assert callable(fn), f"Reducer must be callable, but given: {fn}"
+      fn_reducers[name] = fn
+    n = _n_samples(inputs)
+    if n is None and path is not None:
+      raise ValueError("Unknown number of samples for tf.data.Dataset, "
+                       "cannot preallocate memory-mapped outputs.")
+    if path is not None and not os.path.exists(path):
+      os.makedirs(path)
+    inputs = _to_data(inputs, batch_size=batch_size, ordered=True)
+
+    @tf.function(experimental_relax_shapes=True)
+    def reduce_step(data):
+      pX_Z, qZ_X = self(**data, training=False, sample_shape=sample_shape)
+      return {
+          name: tuple(tf.nest.flatten(fn(pX_Z, qZ_X, data)))
+          for name, fn in fn_reducers.items()
+      }
+
+    def allocate(name, shape, dtype):
+      if n is None:
+        return []
+      if path is None:
+        return np.empty(shape=(n,) + shape, dtype=dtype)
+      return np.lib.format.open_memmap(os.path.join(path, f"{name}.npy"),
+                                       mode='w+',
+                                       dtype=dtype,
+                                       shape=(n,) + shape)
+
+    ## making predictions
+    outputs = OrderedDict()
+    start = 0
+    prog = tqdm(inputs, desc="Predicting", disable=not bool(verbose))
+    with tf.device(f"/{device}:0"):
+      for data in prog:
+        end = start
+        for name, tensors in reduce_step(data).items():
+          if name not in outputs:
+            outputs[name] = [
+                allocate(f"{name}{i}" if len(tensors) > 1 else name,
+                         tuple(t.shape[1:]), t.dtype.as_numpy_dtype)
+                for i, t in enumerate(tensors)
+            ]
+          for arr, t in zip(outputs[name], tensors):
+            t = t.numpy()
+            end = start + t.shape[0]
+            if isinstance(arr, list):
+              arr.append(t)
+            else:
+              arr[start:end] = t
+        start = end
+      prog.clear()
+      prog.close()
+    ## finalize the arrays
+    results = OrderedDict()
+    for name, arrays in outputs.items():
+      arrays = tuple(
+          np.concatenate(x, axis=0) if isinstance(x, list) else x[:start]
+          for x in arrays)
+      for x in arrays:
+        if isinstance(x, np.memmap):
+          x.flush()
+      results[name] = arrays[0] if len(arrays) == 1 else arrays
+    return results
+
   def fit(self,
           train: Union[SingleCellOMIC, DatasetV2],
           valid: Union[SingleCellOMIC, DatasetV2] = None,
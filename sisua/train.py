@@ -17,17 +17,21 @@ from sisua.data import (CONFIG_PATH, DATA_DIR, EXP_DIR, OMIC, SingleCellOMIC,
 from sisua.models import (NetConf, RVmeta, get_all_models,
                           get_model)
 
-os.environ['CUDA_VISIBLE_DEVICES'] = '0'
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
-
-tf.random.set_seed(8)
-np.random.seed(8)
-
 
 # ===========================================================================
 # Helpers
 # ===========================================================================
+def _initialize_runtime(seed=8):
+  r""" Devices, logging and global seeds for running the experiments, called
+  when `SisuaExperimenter` is created instead of when this module is imported
+  """
+  os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+  os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+  os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
+  tf.random.set_seed(seed)
+  np.random.seed(seed)
+
+
 def _from_config(cfg, fn, overrides={}):
   assert callable(fn)
   spec = inspect.getfullargspec(fn)
@@ -49,6 +53,7 @@ def _from_config(cfg, fn, overrides={}):
 class SisuaExperimenter(Experimenter):
 
   def __init__(self):
+    _initialize_runtime()
     super().__init__(save_path=EXP_DIR,
                      config_path=CONFIG_PATH,
                      exclude_keys=["train", "verbose"],
@@ -118,16 +123,20 @@ class SisuaExperimenter(Experimenter):
   def on_train(self, cfg, output_dir, model_dir):
     self.model.set_metadata(self.sco)
     train, valid = self.train.split(0.9)
-    train.corrupt(dropout_rate=cfg.dataset.dropout_rate,
-                  retain_rate=cfg.dataset.retain_rate,
-                  inplace=True)
     if cfg.verbose:
       print(train)
+    # a fresh corruption of the training data for every epoch, note: the
+    # library statistics fed to the model are computed from the uncorrupted
+    # counts (`corrupt(inplace=True)` used to recompute them from the
+    # corrupted matrix)
     train = train.create_dataset(self.omics,
                                  labels_percent=cfg.dataset.labels_percent,
                                  batch_size=cfg.dataset.batch_size,
                                  drop_remainder=True,
-                                 shuffle=1000)
+                                 shuffle=1000,
+                                 corruption=dict(
+                                     dropout_rate=cfg.dataset.dropout_rate,
+                                     retain_rate=cfg.dataset.retain_rate))
     valid = valid.create_dataset(self.omics,
                                  labels_percent=cfg.dataset.labels_percent,
                                  batch_size=cfg.dataset.batch_size,
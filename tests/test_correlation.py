@@ -0,0 +1,99 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.stats import pearsonr, spearmanr
+
+from sisua.data import correlation
+from sisua.data.correlation import correlation_matrix, paired_correlation
+
+np.random.seed(8)
+
+
+class CorrelationTest(unittest.TestCase):
+
+  def test_against_scipy(self):
+    x1 = np.random.poisson(2, size=(200, 13)).astype(np.float32)
+    x2 = np.random.poisson(1, size=(200, 7)).astype(np.float32)
+    x2[:, 3] = 1.  # constant column
+    pearson, spearman = correlation_matrix(x1,
+                                           sparse.csr_matrix(x2),
+                                           method=('pearson', 'spearman'),
+                                           block_size=4)
+    self.assertEqual(pearson.shape, (13, 7))
+    for i in range(x1.shape[1]):
+      for j in range(x2.shape[1]):
+        if j == 3:
+          self.assertTrue(np.isnan(pearson[i, j]) and np.isnan(spearman[i, j]))
+          continue
+        self.assertAlmostEqual(pearson[i, j], pearsonr(x1[:, i], x2[:, j])[0])
+        self.assertAlmostEqual(spearman[i, j],
+                               spearmanr(x1[:, i], x2[:, j]).correlation)
+
+  def test_pairwise_nan(self):
+    x = np.random.rand(100, 11)
+    x[np.random.rand(*x.shape) < 0.1] = np.nan
+    corr = correlation_matrix(x, block_size=3)
+    self.assertTrue(np.allclose(corr, pd.DataFrame(x).corr().values))
+    self.assertTrue(np.allclose(corr, corr.T))
+
+  def test_float32_and_memory_budget(self):
+    x = np.random.rand(500, 40)
+    s64, p64 = correlation_matrix(x, x, method=('spearman', 'pearson'))
+    s32, p32 = correlation_matrix(x,
+                                  x,
+                                  method=('spearman', 'pearson'),
+                                  dtype='float32',
+                                  max_memory=0.1)
+    self.assertEqual(s32.dtype, np.float32)
+    self.assertTrue(np.allclose(s32, s64, atol=1e-5))
+    self.assertTrue(np.allclose(p32, p64, atol=1e-5))
+    self.assertTrue(np.allclose(p64, np.corrcoef(x.T)))
+
+  def test_cached_blocks(self):
+    x1 = np.random.rand(100, 40)
+    x2 = np.random.rand(100, 30)
+    x2[np.random.rand(*x2.shape) < 0.1] = np.nan
+    methods = ('pearson', 'spearman')
+    expected = None
+    # each block is standardized once (4 blocks of x1 and 3 blocks of x2),
+    # unless the cache exceeds the memory budget
+    for x, y, cache_memory, n_calls in [
+        (x1, x2, correlation._CACHE_MEMORY, (4 + 3) * 2),
+        (x1, x2, 0, (4 + 4 * 3) * 2),
+        (x1, None, correlation._CACHE_MEMORY, 4 * 2),
+    ]:
+      with mock.patch.object(correlation, '_CACHE_MEMORY', cache_memory), \
+        mock.patch.object(correlation,
+                          '_Standardized',
+                          wraps=correlation._Standardized) as standardized:
+        outputs = correlation_matrix(x, y, method=methods, block_size=10)
+      self.assertEqual(standardized.call_count, n_calls)
+      if y is None:
+        self.assertTrue(np.allclose(outputs[0], np.corrcoef(x1.T)))
+      elif expected is None:
+        expected = outputs
+      else:
+        for i, j in zip(outputs, expected):
+          self.assertTrue(np.allclose(i, j, equal_nan=True))
+
+  def test_paired(self):
+    x1 = np.random.poisson(2, size=(300, 9)).astype(np.float64)
+    x2 = np.random.rand(300, 9)
+    x2[np.random.rand(*x2.shape) < 0.1] = np.nan
+    for method in ('pearson', 'spearman'):
+      full = correlation_matrix(x1, x2, method=method)
+      paired = paired_correlation(sparse.csr_matrix(x1),
+                                  x2,
+                                  method=method,
+                                  block_size=4)
+      self.assertEqual(paired.shape, (9,))
+      self.assertTrue(np.allclose(paired, np.diag(full)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,44 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+from scipy import sparse
+
+from sisua.data.utils import apply_artificial_corruption
+
+np.random.seed(8)
+
+
+class CorruptionTest(unittest.TestCase):
+
+  def test_sparse_dense_reproducible(self):
+    x = np.random.poisson(1, size=(1000, 50)).astype(np.float32)
+    nnz = np.count_nonzero(x)
+    for dist in ('binomial', 'uniform'):
+      dense, rows = apply_artificial_corruption(x,
+                                                dropout=0.3,
+                                                distribution=dist,
+                                                copy=True,
+                                                block_size=128,
+                                                return_rows=True)
+      # the CSR data is corrupted inplace with the same random blocks
+      csr = sparse.csr_matrix(x)
+      apply_artificial_corruption(csr,
+                                  dropout=0.3,
+                                  distribution=dist,
+                                  block_size=128)
+      self.assertTrue(np.all(csr.toarray() == dense))
+      self.assertTrue(np.all(dense <= x))
+      self.assertTrue(set(np.nonzero(np.any(dense != x, 1))[0]) <= set(rows))
+      # only the selected entries (30% of non-zeros) are changed
+      self.assertLessEqual(np.sum(dense != x), int(0.3 * nnz))
+      self.assertLess(np.count_nonzero(dense), nnz)
+      # reproducible
+      self.assertTrue(
+          np.all(dense == apply_artificial_corruption(
+              x, dropout=0.3, distribution=dist, copy=True, block_size=128)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,262 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+import numpy as np
+import tensorflow as tf
+from scipy import sparse
+
+from sisua.data import OMIC, SingleCellOMIC
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+np.random.seed(8)
+
+_N_OBS = 101
+_BATCH_SIZE = 32
+
+
+def _numpy(x):
+  if isinstance(x, tf.SparseTensor):
+    x = tf.sparse.to_dense(x)
+  return x.numpy()
+
+
+def _batches(ds):
+  r""" List of batches, each batch is a tuple `(inputs, library, mask)` of
+  numpy arrays, the sparse batches are densified """
+  batches = []
+  for data in ds:
+    batches.append(
+        ([_numpy(x) for x in tf.nest.flatten(data['inputs'])],
+         [_numpy(x) for x in tf.nest.flatten(data['library'])],
+         _numpy(data['mask'])))
+  return batches
+
+
+class CreateDatasetTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = mkdtemp()
+    x = np.random.poisson(1, size=(_N_OBS, 40)).astype(np.float32)
+    # the first gene identifies the cell, whatever the batch order
+    x[:, 0] = np.arange(_N_OBS) + 1
+    y = np.random.poisson(5, size=(_N_OBS, 4)).astype(np.float32)
+    y[:, 0] = np.arange(_N_OBS) + 1
+    self.x = x
+    self.y = y
+    self.scos = dict(dense=self._sco(x), csr=self._sco(sparse.csr_matrix(x)))
+    # memory-mapped `.npy` and `SparseMmapWriter` stores
+    for name in ('dense', 'csr'):
+      path = self.scos[name].save(os.path.join(self.path, name))
+      self.scos[f'memmap_{name}'] = SingleCellOMIC.open(path)
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def _sco(self, x):
+    sco = SingleCellOMIC(x, name='tiny')
+    sco.add_omic(OMIC.proteomic, self.y,
+                 np.array([f'P{i}' for i in range(self.y.shape[1])]))
+    return sco
+
+  def _library(self, sco, omic):
+    return np.concatenate(sco.get_library_size(omic), axis=-1)
+
+  def test_gather_and_slices(self):
+    omics = OMIC.transcriptomic | OMIC.proteomic
+    for name, sco in self.scos.items():
+      library = [self._library(sco, om) for om in omics]
+      for labels_percent in (0., 0.5):
+        for drop_remainder in (False, True):
+          kw = dict(omics=omics,
+                    labels_percent=labels_percent,
+                    batch_size=_BATCH_SIZE,
+                    drop_remainder=drop_remainder,
+                    shuffle=0)
+          msg = f"{name} {kw}"
+          gather = _batches(sco.create_dataset(pipeline='gather', **kw))
+          slices = _batches(sco.create_dataset(pipeline='slices', **kw))
+          n_batches = _N_OBS // _BATCH_SIZE + (0 if drop_remainder else 1)
+          self.assertEqual(len(gather), n_batches, msg)
+          self.assertEqual(len(slices), n_batches, msg)
+          start = 0
+          for (x1, l1, m1), (x2, l2, m2) in zip(gather, slices):
+            n = x1[0].shape[0]
+            end = start + n
+            for a, b, c in zip(x1, x2, (self.x, self.y)):
+              self.assertTrue(np.array_equal(a, b), msg)
+              self.assertTrue(np.array_equal(a, c[start:end]), msg)
+            for a, b, c in zip(l1, l2, library):
+              self.assertTrue(np.allclose(a, b), msg)
+              self.assertTrue(np.allclose(a, c[start:end]), msg)
+            # the mask of labelled cells
+            shape = (n,) if labels_percent == 0 else (n, 1)
+            self.assertEqual(m1.shape, shape, msg)
+            self.assertEqual(m2.shape, shape, msg)
+            self.assertEqual(m1.dtype, np.bool_, msg)
+            start = end
+          # the last batch is kept
+          if not drop_remainder:
+            self.assertEqual(start, _N_OBS, msg)
+            self.assertEqual(gather[-1][0][0].shape[0],
+                             _N_OBS % _BATCH_SIZE, msg)
+
+  def test_sparse_batch(self):
+    for name, sco in self.scos.items():
+      kw = dict(omics=OMIC.transcriptomic | OMIC.proteomic,
+                batch_size=_BATCH_SIZE,
+                shuffle=0)
+      for data, dense in zip(
+          sco.create_dataset(sparse_batch=True, **kw),
+          sco.create_dataset(sparse_batch=False, **kw)):
+        x, y = data['inputs']
+        # only the sparse OMIC is returned as `tf.SparseTensor`
+        self.assertEqual(isinstance(x, tf.SparseTensor), 'csr' in name)
+        self.assertNotIsInstance(y, tf.SparseTensor)
+        for a, b in zip((x, y), dense['inputs']):
+          self.assertTrue(np.array_equal(_numpy(a), _numpy(b)), name)
+
+  def test_shuffle(self):
+    for name, sco in self.scos.items():
+      library = self._library(sco, OMIC.transcriptomic)
+      for pipeline in ('gather', 'slices'):
+        ds = sco.create_dataset(OMIC.transcriptomic,
+                                batch_size=_BATCH_SIZE,
+                                shuffle=1000,
+                                pipeline=pipeline)
+        epochs = []
+        for _ in range(2):
+          ids = []
+          for x, l, _ in _batches(ds):
+            x, l = x[0], l[0]
+            idx = x[:, 0].astype(np.int64) - 1
+            self.assertTrue(np.array_equal(x, self.x[idx]))
+            self.assertTrue(np.allclose(l, library[idx]))
+            ids.append(idx)
+          ids = np.concatenate(ids)
+          # a permutation of all cells
+          self.assertTrue(np.array_equal(np.sort(ids), np.arange(_N_OBS)),
+                          f"{name} {pipeline}")
+          self.assertFalse(np.array_equal(ids, np.arange(_N_OBS)))
+          epochs.append(ids)
+        # reshuffled every epoch
+        self.assertFalse(np.array_equal(epochs[0], epochs[1]))
+
+  def test_benchmark_dataset(self):
+    for name, sco in self.scos.items():
+      for sparse_batch in (False, True):
+        throughput = sco.benchmark_dataset(n_batches=2,
+                                           verbose=False,
+                                           batch_size=_BATCH_SIZE,
+                                           sparse_batch=sparse_batch)
+        self.assertGreater(throughput, 0, name)
+
+  # ====== on-the-fly corruption ====== #
+  def _corrupted(self, sco, shuffle=0, **kwargs):
+    kw = dict(omics=OMIC.transcriptomic | OMIC.proteomic,
+              batch_size=_BATCH_SIZE,
+              shuffle=shuffle)
+    kw.update({
+        k: kwargs.pop(k)
+        for k in ('pipeline', 'sparse_batch')
+        if k in kwargs
+    })
+    corruption = dict(dropout_rate=0.5, retain_rate=0.2)
+    corruption.update(kwargs)
+    return sco.create_dataset(corruption=corruption, **kw)
+
+  def _check_corrupted(self, batches, library, uniform=False):
+    n_changed = 0
+    for (x, y), (l, _), _ in batches:
+      # the cells are identified by the uncorrupted proteomic
+      idx = y[:, 0].astype(np.int64) - 1
+      org = self.x[idx]
+      self.assertTrue(np.array_equal(y, self.y[idx]))
+      self.assertTrue(np.all(x <= org))
+      self.assertTrue(np.all(x[org == 0] == 0))
+      if uniform:
+        self.assertTrue(np.all((x == org) | (x == 0)))
+      # the library size of the original data
+      self.assertTrue(np.allclose(l, library[idx]))
+      n_changed += np.sum(x != org)
+    self.assertGreater(n_changed, 0)
+
+  def test_fixed_corruption(self):
+    for name, sco in self.scos.items():
+      outputs = []
+      for pipeline in ('gather', 'slices'):
+        ds = self._corrupted(sco, pipeline=pipeline, fixed=True)
+        # two iterations and two separately built datasets
+        for batches in (_batches(ds), _batches(ds),
+                        _batches(
+                            self._corrupted(sco, pipeline=pipeline,
+                                            fixed=True))):
+          outputs.append(np.concatenate([x[0] for x, _, _ in batches]))
+        # the corruption only depends on the cell index, not the order
+        rows = []
+        for _ in range(2):
+          batches = _batches(
+              self._corrupted(sco, shuffle=1000, pipeline=pipeline,
+                              fixed=True))
+          x = np.concatenate([x[0] for x, _, _ in batches])
+          y = np.concatenate([x[1] for x, _, _ in batches])
+          rows.append(x[np.argsort(y[:, 0])])
+        outputs += rows
+      for x in outputs[1:]:
+        self.assertTrue(np.array_equal(outputs[0], x), name)
+      self.assertFalse(np.array_equal(outputs[0], self.x), name)
+
+  def test_fresh_corruption(self):
+    for name, sco in self.scos.items():
+      for pipeline in ('gather', 'slices'):
+        ds = self._corrupted(sco, pipeline=pipeline, fixed=False)
+        epochs = [
+            np.concatenate([x[0] for x, _, _ in _batches(ds)])
+            for _ in range(2)
+        ]
+        self.assertFalse(np.array_equal(epochs[0], epochs[1]),
+                         f"{name} {pipeline}")
+
+  def test_corrupted_values(self):
+    for name, sco in self.scos.items():
+      library = self._library(sco, OMIC.transcriptomic)
+      for pipeline in ('gather', 'slices'):
+        for fixed in (True, False):
+          for distribution in ('binomial', 'uniform'):
+            ds = self._corrupted(sco,
+                                 shuffle=1000,
+                                 pipeline=pipeline,
+                                 fixed=fixed,
+                                 distribution=distribution)
+            self._check_corrupted(_batches(ds),
+                                  library,
+                                  uniform=distribution == 'uniform')
+
+  def test_sparse_batch_corruption(self):
+    for name in ('csr', 'memmap_csr'):
+      sco = self.scos[name]
+      library = self._library(sco, OMIC.transcriptomic)
+      # only the non-zero values are corrupted
+      for data in self._corrupted(sco, sparse_batch=True, fixed=False):
+        x = data['inputs'][0]
+        self.assertIsInstance(x, tf.SparseTensor)
+        idx = data['inputs'][1].numpy()[:, 0].astype(np.int64) - 1
+        rows, cols = np.nonzero(self.x[idx])
+        self.assertTrue(
+            np.array_equal(x.indices.numpy(), np.stack([rows, cols], axis=1)))
+      self._check_corrupted(
+          _batches(self._corrupted(sco, sparse_batch=True, fixed=False)),
+          library)
+      # the same fixed corruption as the dense batches
+      for sparse_batch, dense in zip(
+          _batches(self._corrupted(sco, sparse_batch=True, fixed=True)),
+          _batches(self._corrupted(sco, sparse_batch=False, fixed=True))):
+        self.assertTrue(np.array_equal(sparse_batch[0][0], dense[0][0]))
+
+
+if __name__ == '__main__':
+  unittest.main()
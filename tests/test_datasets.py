@@ -2,8 +2,9 @@ from __future__ import absolute_import, division, print_function
 
 import itertools
 import os
+import shutil
 import unittest
-from tempfile import mkstemp
+from tempfile import mkdtemp, mkstemp
 
 import numpy as np
 import pandas as pd
@@ -77,6 +78,26 @@ class SisuaDataset(unittest.TestCase):
     _equal(self, train, train1)
     _equal(self, test, test1)
 
+  def test_store(self):
+    ds = get_dataset('8kmy')
+    path = mkdtemp()
+    try:
+      ds.save(path, remove_exist=True)
+      sco = ds.__class__.open(path)
+      self.assertEqual(sco.shape, ds.shape)
+      self.assertEqual(sco.omics, ds.omics)
+      for om in ds.omics:
+        self.assertTrue(np.all(sco.numpy(om) == ds.numpy(om)))
+        self.assertTrue(np.all(sco.stats(om) == ds.stats(om)))
+        self.assertTrue(np.all(sco.get_var_names(om) == ds.get_var_names(om)))
+      self.assertEqual(sco.numpy(dtype=np.float64).dtype, np.float64)
+      # inplace transformation must not modify the read-only store
+      sco.normalize(log1p=True)
+      self.assertTrue(np.allclose(sco.X, np.log1p(ds.X)))
+      self.assertTrue(np.all(ds.__class__.open(path).X == ds.X))
+    finally:
+      shutil.rmtree(path)
+
   def test_corruption(self):
     ds = get_dataset('8kmy')
     ds1 = ds.corrupt(dropout_rate=0.25, inplace=False)
@@ -0,0 +1,155 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+
+from sisua.data import download
+
+np.random.seed(8)
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+  data = b''
+
+  def log_message(self, *args):
+    pass
+
+  def _headers(self, start, end, status):
+    self.send_response(status)
+    self.send_header('Accept-Ranges', 'bytes')
+    self.send_header('Content-Length', str(end - start))
+    if status == 206:
+      self.send_header('Content-Range',
+                       f'bytes {start}-{end - 1}/{len(self.data)}')
+    self.end_headers()
+
+  def do_HEAD(self):
+    self._headers(0, len(self.data), 200)
+
+  def do_GET(self):
+    match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+    start, end, status = 0, len(self.data), 200
+    if match:
+      start = int(match.group(1))
+      if len(match.group(2)) > 0:
+        end = int(match.group(2)) + 1
+      status = 206
+      if start >= len(self.data):
+        self.send_error(416)
+        return
+    self._headers(start, end, status)
+    self.wfile.write(self.data[start:end])
+
+
+class DownloadTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.data = np.random.bytes(3 * 1024 * 1024 + 17)
+    self.md5 = md5(self.data).hexdigest()
+    self.src = os.path.join(self.path, 'src.bin')
+    with open(self.src, 'wb') as f:
+      f.write(self.data)
+    _RangeHandler.data = self.data
+    self.server = HTTPServer(('127.0.0.1', 0), _RangeHandler)
+    self.url = f'http://127.0.0.1:{self.server.server_port}/data.bin'
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.path)
+    os.environ.pop(download.MIRROR_ENV, None)
+
+  def _read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  def test_file_url_and_md5(self):
+    out = os.path.join(self.path, 'out.bin')
+    download.fetch_url(f'file://{self.src}', out, md5=self.md5, verbose=False)
+    self.assertEqual(self._read(out), self.data)
+    with self.assertRaises(RuntimeError):
+      download.fetch_url(f'file://{self.src}',
+                         os.path.join(self.path, 'bad.bin'),
+                         md5='0' * 32,
+                         verbose=False)
+    self.assertFalse(os.path.exists(os.path.join(self.path, 'bad.bin.part')))
+
+  def test_mirror(self):
+    mirror = os.path.join(self.path, 'mirror')
+    os.makedirs(mirror)
+    shutil.copy(self.src, os.path.join(mirror, 'out.bin'))
+    os.environ[download.MIRROR_ENV] = mirror
+    out = os.path.join(self.path, 'out.bin')
+    download.fetch_url('http://127.0.0.1:1/unreachable.bin',
+                       out,
+                       md5=self.md5,
+                       verbose=False)
+    self.assertEqual(self._read(out), self.data)
+
+  def test_resume(self):
+    out = os.path.join(self.path, 'out.bin')
+    with open(out + '.part', 'wb') as f:
+      f.write(self.data[:12345])
+    download.fetch_url(self.url, out, md5=self.md5, verbose=False)
+    self.assertEqual(self._read(out), self.data)
+
+  def test_complete_or_stale_part(self):
+    out = os.path.join(self.path, 'out.bin')
+    # complete partial file, no request for an unsatisfiable range
+    with open(out + '.part', 'wb') as f:
+      f.write(self.data)
+    download.fetch_url(self.url, out, md5=self.md5, verbose=False)
+    self.assertEqual(self._read(out), self.data)
+    # larger than the remote file, restart from scratch
+    os.remove(out)
+    with open(out + '.part', 'wb') as f:
+      f.write(self.data + b'stale')
+    download.fetch_url(self.url, out, md5=self.md5, verbose=False)
+    self.assertEqual(self._read(out), self.data)
+
+  def test_mirror_md5_mismatch(self):
+    mirror = os.path.join(self.path, 'mirror')
+    os.makedirs(mirror)
+    with open(os.path.join(mirror, 'out.bin'), 'wb') as f:
+      f.write(b'outdated ' + self.data)
+    os.environ[download.MIRROR_ENV] = mirror
+    out = os.path.join(self.path, 'out.bin')
+    # the mismatched mirror is skipped, the original URL is used
+    download.fetch_url(self.url, out, md5=self.md5, verbose=False)
+    self.assertEqual(self._read(out), self.data)
+    # all candidates failed
+    os.remove(out)
+    with self.assertRaises(RuntimeError) as e:
+      download.fetch_url(self.url, out, md5='0' * 32, verbose=False)
+    self.assertEqual(str(e.exception).count('MD5 mismatch'), 2)
+    self.assertFalse(os.path.exists(out + '.part'))
+    self.assertFalse(os.path.exists(out))
+
+  def test_parallel_segments(self):
+    threshold = download._PARALLEL_THRESHOLD
+    download._PARALLEL_THRESHOLD = 1024
+    try:
+      out = os.path.join(self.path, 'out.bin')
+      # an interrupted segment is resumed
+      with open(out + '.part1', 'wb') as f:
+        f.write(self.data[len(self.data) // 3 + 1:][:100])
+      download.fetch_url(self.url, out, md5=self.md5, n_segments=3,
+                         verbose=False)
+      self.assertEqual(self._read(out), self.data)
+      self.assertEqual(sorted(os.listdir(self.path)), ['out.bin', 'src.bin'])
+    finally:
+      download._PARALLEL_THRESHOLD = threshold
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,44 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import subprocess
+import sys
+import unittest
+
+# maximum seconds for `import sisua.data`, override by environment variable
+_BUDGET = float(os.environ.get('SISUA_IMPORT_BUDGET', 3.0))
+
+_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import %s
+print(time.perf_counter() - start)
+print(int(any(m == 'tensorflow' or m.startswith('tensorflow.')
+              for m in sys.modules)))
+"""
+
+
+def _import(module):
+  # a fresh interpreter, so nothing is imported beforehand
+  outputs = subprocess.check_output([sys.executable, '-c', _SCRIPT % module],
+                                    env=dict(os.environ))
+  duration, has_tf = outputs.decode('utf-8').strip().split('\n')[-2:]
+  return float(duration), bool(int(has_tf))
+
+
+class ImportTimeTest(unittest.TestCase):
+
+  def test_import_data(self):
+    duration, has_tf = _import('sisua.data')
+    self.assertFalse(has_tf, "`import sisua.data` must not import TensorFlow")
+    self.assertLess(
+        duration, _BUDGET,
+        f"`import sisua.data` takes {duration:.2f}s, budget {_BUDGET:.2f}s")
+
+  def test_import_sisua(self):
+    _, has_tf = _import('sisua')
+    self.assertFalse(has_tf, "`import sisua` must not import TensorFlow")
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,49 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+from scipy import sparse
+
+from sisua.analysis.imputation_benchmarks import (ImputationScorer,
+                                                  imputation_scores)
+
+np.random.seed(8)
+
+
+def _naive_scores(original, corrupted, imputed):
+  d = np.abs(original - imputed)
+  cells = [
+      np.median(np.abs(o - i))
+      for o, c, i in zip(original, corrupted, imputed)
+      if np.sum(o) != np.sum(c)
+  ]
+  return np.median(d), np.mean(cells), np.std(cells)
+
+
+class ImputationScoresTest(unittest.TestCase):
+
+  def test_single_pass_scores(self):
+    rand = np.random.RandomState(1)
+    X = rand.poisson(2, size=(1001, 53)).astype(np.float32)
+    C = X * (rand.rand(*X.shape) > 0.2)
+    I = (X + rand.randn(*X.shape)).astype(np.float32)
+    med, mean, std = _naive_scores(X, C, I)
+    for x, c in ((X, C), (sparse.csr_matrix(X), sparse.csr_matrix(C))):
+      scores = imputation_scores(x, c, I, batch_size=77, max_distances=None)
+      self.assertAlmostEqual(scores['imputation_med'], med, places=5)
+      # the exact median is the default
+      self.assertEqual(imputation_scores(x, c, I, batch_size=77), scores)
+      self.assertAlmostEqual(scores['imputation_mean'], mean, places=5)
+      self.assertAlmostEqual(scores['imputation_std'], std, places=5)
+    # the median is estimated from a subsample of the distances
+    scorer = ImputationScorer(max_distances=5000)
+    for s in range(0, X.shape[0], 100):
+      scorer.update(X[s:s + 100], C[s:s + 100], I[s:s + 100])
+    scores = scorer.result()
+    self.assertAlmostEqual(scores['imputation_med'], med, places=1)
+    self.assertAlmostEqual(scores['imputation_mean'], mean, places=5)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,117 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+from unittest import mock
+
+import numpy as np
+from scipy import sparse
+
+from sisua import label_threshold
+from sisua.label_threshold import (ProbabilisticEmbedding, _DummyGMM,
+                                   _stream_csv)
+
+np.random.seed(8)
+
+
+def _protein_counts(n_proteins=12):
+  rand = np.random.RandomState(1)
+  X = []
+  for _ in range(n_proteins):
+    neg = rand.negative_binomial(5, 0.5, size=600)
+    pos = rand.negative_binomial(20, 0.1, size=400)
+    X.append(rand.permutation(np.concatenate([neg, pos])))
+  return np.stack(X, axis=1).astype(np.float32)
+
+
+class ProbabilisticEmbeddingTest(unittest.TestCase):
+
+  def test_batched_algorithm(self):
+    X = _protein_counts()
+    pbe1 = ProbabilisticEmbedding(algorithm='sklearn').fit(X)
+    pbe2 = ProbabilisticEmbedding(algorithm='batched').fit(X)
+    self.assertEqual(pbe1.n_classes, pbe2.n_classes)
+    # the same optimum is reached, up to the tolerance of EM
+    for i in range(X.shape[1]):
+      llk = [
+          pbe._models[i][1].score(pbe.normalize(X[:, i])[:, np.newaxis])
+          for pbe in (pbe1, pbe2)
+      ]
+      self.assertAlmostEqual(llk[0], llk[1], delta=1e-2 * abs(llk[0]) + 1e-3)
+    self.assertGreaterEqual(np.mean(pbe1.predict(X) == pbe2.predict(X)), 0.99)
+
+  def test_warm_start(self):
+    X = _protein_counts()
+    for algo in ('sklearn', 'batched'):
+      pbe = ProbabilisticEmbedding(algorithm=algo, warm_start=True)
+      pbe.fit(X[:500])
+      pbe.fit(X[500:])
+      # refitting replaces the models
+      self.assertEqual(pbe.n_classes, X.shape[1])
+      self.assertTrue(np.all(np.isfinite(pbe.score_samples(X))))
+
+  def test_batched_warm_start_per_column(self):
+    X = _protein_counts()
+    X_constant = np.array(X)
+    X_constant[:, 0] = 5
+    pbe = ProbabilisticEmbedding(algorithm='batched', warm_start=True)
+    pbe.fit(X_constant)
+    self.assertIsInstance(pbe._models[0][1], _DummyGMM)
+    previous_means = np.stack(
+        [gmm.means_.ravel() for _, gmm in pbe._models[1:]])
+    # the column of `_DummyGMM` is initialized by k-means, the others are
+    # initialized from the previous models
+    with mock.patch.object(label_threshold,
+                           '_fit_gmm_1d',
+                           wraps=label_threshold._fit_gmm_1d) as fit_gmm:
+      pbe.fit(X)
+    self.assertEqual(fit_gmm.call_count, 2)
+    (cold, ), cold_kw = fit_gmm.call_args_list[0]
+    (warm, ), warm_kw = fit_gmm.call_args_list[1]
+    self.assertEqual((len(cold), len(warm)), (1, X.shape[1] - 1))
+    self.assertIsNone(cold_kw['init'])
+    self.assertTrue(np.allclose(warm_kw['init'][1], previous_means))
+    self.assertFalse(any(isinstance(gmm, _DummyGMM) for _, gmm in pbe._models))
+
+  def test_streaming_prediction(self):
+    X = _protein_counts()
+    pbe = ProbabilisticEmbedding(clip_quartile=1.5).fit(X)
+    X_sparse = sparse.csr_matrix(X)
+    for fn in (pbe.predict, pbe.predict_proba, pbe.score_samples):
+      y1 = fn(X)
+      y2 = fn(X_sparse, batch_size=77)
+      self.assertEqual(y1.shape[0], X.shape[0])
+      self.assertTrue(np.allclose(y1, y2))
+
+  def test_stream_csv(self):
+    X = _protein_counts(n_proteins=5)
+    path = mkdtemp()
+    try:
+      csv_path = os.path.join(path, 'adt.csv')
+      with open(csv_path, 'w') as f:
+        f.write(','.join(f'CD{i}' for i in range(X.shape[1])) + '\n')
+        for x in X:
+          f.write(','.join(str(int(i)) for i in x) + '\n')
+      names, X1, X_sample, column_sums = _stream_csv(csv_path,
+                                                     chunk_size=77,
+                                                     n_samples=300)
+      self.assertEqual(list(names), [f'CD{i}' for i in range(X.shape[1])])
+      self.assertTrue(np.all(np.asarray(X1) == X))
+      self.assertTrue(np.allclose(column_sums, np.sum(X, axis=0)))
+      # the sample contains distinct rows of X
+      self.assertEqual(X_sample.shape, (300, X.shape[1]))
+      rows = set(map(tuple, X))
+      self.assertTrue(all(tuple(x) in rows for x in X_sample))
+      # fitting on the sample, predicting on the whole data
+      pbe = ProbabilisticEmbedding().fit(X_sample, column_sums=column_sums)
+      y = np.empty(X.shape, dtype='float32')
+      self.assertTrue(pbe.predict_proba(X1, batch_size=100, out=y) is y)
+      self.assertTrue(np.mean(pbe.predict(X1) == (X > 30)) > 0.9)
+    finally:
+      shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,102 @@
+from __future__ import absolute_import, division, print_function
+
+import itertools
+import unittest
+from concurrent.futures import Future
+
+import numpy as np
+from sklearn.metrics import silhouette_score
+
+from sisua.analysis.latent_benchmarks import (clustering_scores,
+                                              sampled_silhouette_score,
+                                              unsupervised_clustering_accuracy)
+
+np.random.seed(8)
+
+
+def _brute_force_accuracy(y, y_pred):
+  u = np.unique(np.concatenate((y, y_pred)))
+  best = 0.
+  for perm in itertools.permutations(u):
+    mapping = dict(zip(u, perm))
+    y_map = np.array([mapping[i] for i in y_pred])
+    best = max(best, np.mean(y_map == y))
+  return best
+
+
+def _blobs(n=300, n_labels=3, dim=5):
+  labels = np.random.randint(0, n_labels, size=n)
+  centers = np.random.randn(n_labels, dim) * 5
+  latent = centers[labels] + np.random.randn(n, dim)
+  return latent.astype(np.float32), labels
+
+
+class LatentBenchmarksTest(unittest.TestCase):
+
+  def test_unsupervised_clustering_accuracy(self):
+    for n_clusters, n in itertools.product((1, 2, 3, 5), (1, 7, 50)):
+      y = np.random.randint(0, n_clusters, size=n)
+      y_pred = np.random.randint(0, n_clusters, size=n)
+      # arbitrary cluster ids of the prediction
+      y_pred = y_pred * 3 + 1
+      acc, ind = unsupervised_clustering_accuracy(y, y_pred)
+      self.assertAlmostEqual(acc, _brute_force_accuracy(y, y_pred))
+      self.assertEqual(ind.shape[1], 2)
+    # a relabelled prediction is perfectly accurate
+    y = np.random.randint(0, 4, size=100)
+    self.assertEqual(unsupervised_clustering_accuracy(y, (y + 1) % 4)[0], 1.)
+
+  def test_sampled_silhouette_score(self):
+    latent, labels = _blobs(n=1000)
+    full = silhouette_score(latent, labels)
+    # all points are used
+    score, (low, high) = sampled_silhouette_score(latent,
+                                                  labels,
+                                                  n_samples=None)
+    self.assertAlmostEqual(score, full, places=5)
+    self.assertTrue(low <= score <= high)
+    # subsample, deterministic given the random_state
+    score, (low, high) = sampled_silhouette_score(latent,
+                                                  labels,
+                                                  n_samples=300,
+                                                  random_state=1)
+    self.assertEqual(
+        score,
+        sampled_silhouette_score(latent,
+                                 labels,
+                                 n_samples=300,
+                                 random_state=1)[0])
+    self.assertTrue(low <= score <= high)
+    self.assertLess(abs(score - full), 0.05)
+
+  def test_clustering_scores(self):
+    latent, labels = _blobs()
+    exact = clustering_scores(latent, labels, n_labels=3, n_init=10)
+    self.assertEqual(sorted(exact.keys()), ['ARI', 'ASW', 'NMI', 'UCA'])
+    self.assertAlmostEqual(exact['ASW'], silhouette_score(latent, labels))
+    self.assertGreater(exact['UCA'], 0.9)
+    scores = clustering_scores(latent,
+                               labels,
+                               n_labels=3,
+                               mini_batch=True,
+                               silhouette_size=100)
+    self.assertIn('ASW_ci', scores)
+    self.assertGreater(scores['UCA'], 0.9)
+    # one-hot labels
+    scores = clustering_scores(latent,
+                               np.eye(3)[labels],
+                               n_labels=3,
+                               n_init=10)
+    self.assertEqual(scores, exact)
+
+  def test_asynchronous(self):
+    latent, labels = _blobs()
+    kw = dict(n_labels=3, n_init=10, prediction_algorithm='knn')
+    future = clustering_scores(latent, labels, asynchronous=True, **kw)
+    self.assertIsInstance(future, Future)
+    self.assertEqual(future.result(timeout=120),
+                     clustering_scores(latent, labels, **kw))
+
+
+if __name__ == '__main__':
+  unittest.main()
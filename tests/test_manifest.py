@@ -0,0 +1,110 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import pickle
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+import numpy as np
+
+from odin.utils.crypto import md5_folder
+from sisua.data.utils import validate_data_dir, write_manifest
+
+np.random.seed(8)
+
+
+def _read(path):
+  with open(path, 'rb') as f:
+    return f.read()
+
+
+def _write(path, data):
+  with open(path, 'wb') as f:
+    f.write(data)
+
+
+class ManifestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = mkdtemp()
+    self.path = os.path.join(self.root, 'preprocessed')
+    self.manifest = self.path + '.manifest'
+    validate_data_dir(self.path, md5='')
+    self.X = os.path.join(self.path, 'X')
+    _write(self.X, np.random.rand(1000).tobytes())
+    os.makedirs(os.path.join(self.path, 'meta'))
+    _write(os.path.join(self.path, 'meta', 'rowname'), b'cell1\ncell2')
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def assertRemoved(self):
+    self.assertTrue(os.path.isdir(self.path))
+    self.assertEqual(os.listdir(self.path), [])
+    self.assertFalse(os.path.exists(self.manifest))
+
+  def test_valid(self):
+    md5 = write_manifest(self.path)
+    self.assertEqual(md5, md5_folder(self.path))
+    # the manifest is stored outside, the MD5 of the folder is unchanged
+    self.assertTrue(os.path.isfile(self.manifest))
+    self.assertEqual(md5_folder(self.path), md5)
+    for expected in (md5, ''):
+      for verify in (False, True):
+        validate_data_dir(self.path, md5=expected, verify=verify)
+        self.assertTrue(os.path.isfile(self.X))
+    # mismatch the expected MD5
+    validate_data_dir(self.path, md5='0' * 32)
+    self.assertRemoved()
+
+  def test_touched_same_content(self):
+    write_manifest(self.path)
+    st = os.stat(self.X)
+    os.utime(self.X, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    validate_data_dir(self.path, md5='')
+    self.assertTrue(os.path.isfile(self.X))
+    # the new stat is recorded, no rehash the next time
+    with open(self.manifest, 'rb') as f:
+      (size, mtime), _ = pickle.load(f)['files']['X']
+    self.assertEqual((size, mtime), (st.st_size, st.st_mtime_ns + 10**9))
+
+  def test_corrupted(self):
+    write_manifest(self.path)
+    data = _read(self.X)
+    _write(self.X, data[:-8] + b'corrupt!')
+    validate_data_dir(self.path, md5='')
+    self.assertRemoved()
+
+  def test_corrupted_same_stat(self):
+    write_manifest(self.path)
+    st = os.stat(self.X)
+    data = _read(self.X)
+    _write(self.X, data[:-8] + b'corrupt!')
+    os.utime(self.X, ns=(st.st_atime_ns, st.st_mtime_ns))
+    # only detected by rehashing
+    validate_data_dir(self.path, md5='')
+    self.assertTrue(os.path.isfile(self.X))
+    validate_data_dir(self.path, md5='', verify=True)
+    self.assertRemoved()
+
+  def test_added_file(self):
+    write_manifest(self.path)
+    _write(os.path.join(self.path, 'extra'), b'extra')
+    validate_data_dir(self.path, md5='')
+    self.assertRemoved()
+
+  def test_no_manifest(self):
+    md5 = md5_folder(self.path)
+    # preprocessed by older version, hashed once and the manifest is created
+    validate_data_dir(self.path, md5=md5)
+    self.assertTrue(os.path.isfile(self.X))
+    self.assertTrue(os.path.isfile(self.manifest))
+    # incomplete preprocessing (no manifest, no known MD5)
+    os.remove(self.manifest)
+    validate_data_dir(self.path, md5='')
+    self.assertRemoved()
+
+
+if __name__ == '__main__':
+  unittest.main()
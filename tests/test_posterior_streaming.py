@@ -0,0 +1,104 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from sisua.analysis.posterior import Posterior
+from sisua.data import OMIC, SingleCellOMIC
+from sisua.models import VAE, NetConf, RVmeta
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+np.random.seed(8)
+tf.random.set_seed(8)
+
+
+def _tiny_model(n_genes=12, n_prots=3, n_cells=100):
+  x = np.random.poisson(2, size=(n_cells, n_genes)).astype(np.float32)
+  y = np.random.poisson(5, size=(n_cells, n_prots)).astype(np.float32)
+  sco = SingleCellOMIC(x, name='tiny')
+  sco.add_omic(OMIC.proteomic, y, np.array([f'P{i}' for i in range(n_prots)]))
+  model = VAE(outputs=RVmeta(n_genes, 'zinbd', True, 'transcriptomic'),
+              latents=RVmeta(2, 'diag', True, 'Latents'),
+              encoder=NetConf([16], batchnorm=False),
+              decoder=NetConf([16], batchnorm=False))
+  model.fit(sco, epochs=2, verbose=False)
+  return model, sco
+
+
+class PosteriorStreamingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def _posterior(self, model, sco, **kwargs):
+    # the same seed gives the same corruption and the same MCMC samples,
+    # the number of cells is not a multiple of the batch size
+    tf.random.set_seed(8)
+    return Posterior(model,
+                     sco,
+                     batch_size=16,
+                     sample_shape=3,
+                     random_state=1,
+                     verbose=False,
+                     **kwargs)
+
+  def test_streaming_equivalence(self):
+    model, sco = _tiny_model()
+    name = OMIC.transcriptomic.name
+    ref = self._posterior(model, sco, name='ref')
+    for spill_dir in (None, self.path):
+      pos = self._posterior(model,
+                            sco,
+                            streaming=True,
+                            spill_dir=spill_dir,
+                            name='stream')
+      # log-likelihood
+      llk_ref = ref.cal_llk(name)
+      llk = pos.cal_llk(name)
+      self.assertEqual(sorted(llk.keys()), sorted(llk_ref.keys()))
+      for key, val in llk_ref.items():
+        self.assertAlmostEqual(float(llk[key]), float(val), places=3, msg=key)
+      # imputed means
+      for omic in (OMIC.itranscriptomic, OMIC.latent):
+        self.assertTrue(
+            np.allclose(pos.dataset.numpy(omic),
+                        ref.dataset.numpy(omic),
+                        rtol=1e-4,
+                        atol=1e-5), str(omic))
+      # imputation scores, the exact median included
+      scores_ref = ref.cal_imputation_scores()
+      scores = pos.cal_imputation_scores()
+      for key, val in scores_ref.items():
+        self.assertAlmostEqual(float(scores[key]),
+                               float(val),
+                               places=4,
+                               msg=key)
+      # latents
+      self.assertTrue(
+          np.allclose(pos.latents.mean().numpy(),
+                      ref.latents.mean().numpy(),
+                      rtol=1e-4,
+                      atol=1e-5))
+      # outputs are reduced to the means, memory-mapped with spill_dir
+      for data_type in ('reconstructed', 'imputed'):
+        x = pos.get_data(name, data_type)
+        x_ref = ref.get_data(name, data_type).mean().numpy().mean(axis=0)
+        self.assertEqual(x.shape, (sco.n_obs, sco.get_dim(name)))
+        self.assertTrue(np.allclose(x, x_ref, rtol=1e-4, atol=1e-5))
+        self.assertEqual(isinstance(x, np.memmap), spill_dir is not None)
+        if spill_dir is not None:
+          path = os.path.join(spill_dir, f"stream_{name}_{data_type}.npy")
+          self.assertTrue(np.array_equal(np.load(path, mmap_mode='r'), x))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,155 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+import numpy as np
+import tensorflow as tf
+from scipy.special import logsumexp
+
+from sisua.data import SingleCellOMIC
+from sisua.models import VAE, NetConf, RVmeta
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+np.random.seed(8)
+tf.random.set_seed(8)
+
+# the number of cells is not a multiple of the batch size
+_N_OBS = 101
+_BATCH_SIZE = 16
+
+
+def _tiny_model(n_genes=12):
+  x = np.random.poisson(2, size=(_N_OBS, n_genes)).astype(np.float32)
+  sco = SingleCellOMIC(x, name='tiny')
+  model = VAE(outputs=RVmeta(n_genes, 'zinbd', True, 'transcriptomic'),
+              latents=RVmeta(2, 'diag', True, 'Latents'),
+              encoder=NetConf([16], batchnorm=False),
+              decoder=NetConf([16], batchnorm=False))
+  model.fit(sco, epochs=2, verbose=False)
+  return model, sco
+
+
+# custom reducers, the MCMC samples are moved to the second dimension
+def sample_means(pX_Z, qZ_X, data):
+  return tf.transpose(pX_Z.mean(), (1, 0, 2))
+
+
+def sample_llk(pX_Z, qZ_X, data):
+  return tf.transpose(pX_Z.log_prob(data['inputs']))
+
+
+class PredictReducedTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.model, cls.sco = _tiny_model()
+
+  def setUp(self):
+    self.path = mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def _ordered(self):
+    return self.sco.create_dataset(batch_size=_BATCH_SIZE,
+                                   shuffle=0,
+                                   drop_remainder=False)
+
+  def test_reducers(self):
+    # enough samples for the standard error of the MCMC estimates
+    n_samples = 200
+    X, Z = self.model.predict(self._ordered(),
+                              sample_shape=n_samples,
+                              verbose=False)
+    mean = X.mean().numpy()
+    latent_mean = Z.mean().numpy()
+    self.assertEqual(latent_mean.shape[0], _N_OBS)
+    # SingleCellOMIC and numpy inputs are iterated in the original order
+    for inputs in (self.sco, self.sco.numpy()):
+      results = self.model.predict_reduced(
+          inputs,
+          reducers=['mean', 'latent_mean', 'log_prob', sample_means,
+                    sample_llk],
+          sample_shape=n_samples,
+          batch_size=_BATCH_SIZE,
+          verbose=False)
+      # custom reducers are keyed by their name
+      self.assertEqual(
+          list(results.keys()),
+          ['mean', 'latent_mean', 'log_prob', 'sample_means', 'sample_llk'])
+      for x in results.values():
+        self.assertEqual(x.shape[0], _N_OBS)
+      self.assertTrue(
+          np.allclose(results['latent_mean'], latent_mean, rtol=1e-5,
+                      atol=1e-6))
+      # reduced from the same MCMC samples
+      self.assertTrue(
+          np.allclose(results['mean'],
+                      np.mean(results['sample_means'], axis=1),
+                      rtol=1e-5,
+                      atol=1e-6))
+      self.assertTrue(
+          np.allclose(results['log_prob'],
+                      logsumexp(results['sample_llk'], axis=1) -
+                      np.log(n_samples),
+                      rtol=1e-5,
+                      atol=1e-4))
+      # the same expectation as `predict`, the latents are sampled in both
+      # cases, so the difference is bounded by the MCMC standard error
+      stderr = np.std(mean, axis=0) / np.sqrt(n_samples)
+      stderr = np.sqrt(stderr**2 + np.var(results['sample_means'], axis=1) /
+                       n_samples)
+      self.assertTrue(
+          np.all(
+              np.abs(results['mean'] - np.mean(mean, axis=0)) <= 6 * stderr +
+              1e-4))
+
+  def test_memmap_outputs(self):
+    results = self.model.predict_reduced(self.sco,
+                                         reducers=['mean', 'latent_mean'],
+                                         batch_size=_BATCH_SIZE,
+                                         path=self.path,
+                                         verbose=False)
+    in_memory = self.model.predict_reduced(self.sco,
+                                           reducers=['latent_mean'],
+                                           batch_size=_BATCH_SIZE,
+                                           verbose=False)
+    for name in ('mean', 'latent_mean'):
+      x = results[name]
+      self.assertIsInstance(x, np.memmap)
+      self.assertEqual(x.shape[0], _N_OBS)
+      self.assertTrue(
+          np.array_equal(np.load(os.path.join(self.path, f'{name}.npy')), x))
+    self.assertTrue(
+        np.allclose(results['latent_mean'],
+                    in_memory['latent_mean'],
+                    rtol=1e-5,
+                    atol=1e-6))
+
+  def test_dataset_inputs(self):
+    # the number of samples is unknown, the batches are concatenated
+    results = self.model.predict_reduced(self._ordered(),
+                                         reducers=['latent_mean'],
+                                         verbose=False)
+    expected = self.model.predict_reduced(self.sco,
+                                          reducers=['latent_mean'],
+                                          batch_size=_BATCH_SIZE,
+                                          verbose=False)
+    self.assertTrue(
+        np.allclose(results['latent_mean'],
+                    expected['latent_mean'],
+                    rtol=1e-5,
+                    atol=1e-6))
+    with self.assertRaises(ValueError):
+      self.model.predict_reduced(self._ordered(),
+                                 reducers=['mean'],
+                                 path=self.path,
+                                 verbose=False)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,77 @@
+from __future__ import absolute_import, division, print_function
+
+import io
+import unittest
+
+import numpy as np
+from scipy import sparse
+from scipy.io import mmwrite
+
+from sisua.data.data_loader.dataset10x import _read_mtx, _read_table
+
+np.random.seed(8)
+
+
+def _mtx(x, comment='', field=None, symmetry=None) -> io.BytesIO:
+  f = io.BytesIO()
+  mmwrite(f, x, comment=comment, field=field, symmetry=symmetry)
+  f.seek(0)
+  return f
+
+
+class ReadMtxTest(unittest.TestCase):
+
+  def test_integer(self):
+    # 10x layout: [n_features, n_cells]
+    x = sparse.random(300, 120, density=0.1, format='coo', random_state=1)
+    x = (x * 1000).astype(np.int64)
+    x.eliminate_zeros()
+    # small chunks, so the body is split in many pieces
+    for chunk_size in (64, 1000, 64 * 1024**2):
+      y = _read_mtx(_mtx(x, comment='counts\nsecond line'),
+                    n_threads=3,
+                    chunk_size=chunk_size)
+      self.assertTrue(sparse.isspmatrix_csr(y))
+      self.assertEqual(y.dtype, np.uint16)
+      self.assertEqual(y.shape, (120, 300))
+      self.assertTrue(np.all(y.toarray() == x.T.toarray()))
+
+  def test_integer_overflow(self):
+    x = sparse.coo_matrix(np.array([[0, 70000], [3, 0]]))
+    y = _read_mtx(_mtx(x, field='integer'))
+    self.assertEqual(y.dtype, np.float32)
+    self.assertTrue(np.all(y.toarray() == x.T.toarray()))
+
+  def test_real(self):
+    x = sparse.random(50, 40, density=0.2, format='coo', random_state=2)
+    y = _read_mtx(_mtx(x, field='real'), chunk_size=128)
+    self.assertEqual(y.dtype, np.float32)
+    self.assertTrue(np.allclose(y.toarray(), x.T.toarray()))
+
+  def test_empty(self):
+    x = sparse.coo_matrix((20, 10), dtype=np.int64)
+    y = _read_mtx(_mtx(x, field='integer'))
+    self.assertEqual(y.shape, (10, 20))
+    self.assertEqual(y.nnz, 0)
+
+  def test_mmread_fallback(self):
+    # dense array and symmetric formats are not written by 10x
+    x = np.random.rand(6, 4)
+    y = _read_mtx(_mtx(x))
+    self.assertTrue(np.allclose(y.toarray(), x.T))
+    x = sparse.coo_matrix(np.array([[1, 2, 0], [2, 0, 5], [0, 5, 3]]))
+    y = _read_mtx(_mtx(x, symmetry='symmetric'))
+    self.assertTrue(np.all(y.toarray() == x.T.toarray()))
+
+  def test_read_table(self):
+    text = b"ENSG01\tCD4\tGene Expression\nENSG02\tCD8A\tGene Expression\n"
+    table = _read_table(io.BytesIO(text), sep='\t')
+    self.assertEqual(table.shape, (2, 3))
+    self.assertEqual(table[1, 1], 'CD8A')
+    # quotes and the 'NA' gene are kept as is
+    table = _read_table(io.BytesIO(b'"A",NA\nB,C\n'), sep=',')
+    self.assertEqual(table.tolist(), [['"A"', 'NA'], ['B', 'C']])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,144 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from sisua.analysis import sc_metrics
+from sisua.analysis.sc_metrics import (ImputationError, MetricScheduler,
+                                       NegativeLogLikelihood, SingleCellMetric,
+                                       SingleCellMetricGroup)
+from sisua.data import SingleCellOMIC
+from sisua.models import VAE, NetConf, RVmeta
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+np.random.seed(8)
+tf.random.set_seed(8)
+
+
+def _tiny_model(n_genes, epochs=2):
+  x = np.random.poisson(2, size=(256, n_genes)).astype(np.float32)
+  sco = SingleCellOMIC(x, name='tiny')
+  model = VAE(outputs=RVmeta(n_genes, 'zinbd', True, 'transcriptomic'),
+              latents=RVmeta(2, 'diag', True, 'Latents'),
+              encoder=NetConf([16], batchnorm=False),
+              decoder=NetConf([16], batchnorm=False))
+  model.fit(sco, epochs=epochs, verbose=False)
+  return model, sco
+
+
+class _RecordMetric(SingleCellMetric):
+
+  def call(self, y_true, y_crpt, y_pred, latents, extras):
+    self.received = (y_true, y_crpt, y_pred, latents)
+    return {self.name: 0.}
+
+
+class _FailedMetric(SingleCellMetric):
+
+  def call(self, y_true, y_crpt, y_pred, latents, extras):
+    raise ValueError("failed on purpose")
+
+
+class SingleCellMetricsTest(unittest.TestCase):
+
+  def setUp(self):
+    sc_metrics._PREPARED_INPUTS.clear()
+
+  def test_prepared_inputs_cache(self):
+    inputs = [
+        np.random.poisson(1, size=(20, 5)).astype(np.float32)
+        for _ in range(sc_metrics._MAX_PREPARED_INPUTS + 4)
+    ]
+    prepared = [sc_metrics._prepare_inputs(x, dropout_rate=0.2) for x in inputs]
+    self.assertEqual(len(sc_metrics._PREPARED_INPUTS),
+                     sc_metrics._MAX_PREPARED_INPUTS)
+    # cache hit returns the same objects
+    y_true, y_crpt = sc_metrics._prepare_inputs(inputs[-1], dropout_rate=0.2)
+    self.assertIs(y_true[0], prepared[-1][0][0])
+    self.assertIs(y_crpt[0], prepared[-1][1][0])
+    # the least recently used are evicted
+    y_true, _ = sc_metrics._prepare_inputs(inputs[0], dropout_rate=0.2)
+    self.assertIsNot(y_true[0], prepared[0][0][0])
+    self.assertEqual(len(sc_metrics._PREPARED_INPUTS),
+                     sc_metrics._MAX_PREPARED_INPUTS)
+    # different arguments are different entries
+    _, y_crpt = sc_metrics._prepare_inputs(inputs[0], dropout_rate=0.)
+    self.assertIs(y_crpt[0], sc_metrics._prepare_inputs(inputs[0])[0][0])
+
+  def test_metric_scheduler(self):
+    model, sco = _tiny_model(n_genes=12, epochs=3)
+    scheduler = MetricScheduler([
+        NegativeLogLikelihood(inputs=sco, n_samples=64, freq=1),
+        ImputationError(inputs=sco, n_samples=64, dropout_rate=0.2, freq=2),
+    ])
+    scheduler.set_model(model)
+    # epoch 0: all metrics are submitted, nothing is ready yet
+    logs = {}
+    scheduler.on_epoch_end(0, logs)
+    self.assertEqual(len(scheduler._pending), 1)
+    scheduler._pending[0].result()
+    # epoch 1: the results of epoch 0 are merged into the logs
+    logs = {}
+    scheduler.on_epoch_end(1, logs)
+    for key in ('nllk0', 'imp_med', 'imp_mean'):
+      self.assertIn(key, logs)
+      self.assertTrue(np.isfinite(logs[key]))
+      self.assertEqual(logs[key + '_epoch'], 0)
+    # the evaluation is done by the shadow model with the same weights
+    self.assertIsNot(scheduler._shadow, model)
+    for w1, w2 in zip(scheduler._shadow.get_weights(), model.get_weights()):
+      self.assertTrue(np.allclose(w1, w2))
+    # the pending evaluations are finished and recorded to the history
+    scheduler.on_train_end()
+    history = model.history.history
+    self.assertEqual(len(scheduler._pending), 0)
+    self.assertIsNone(scheduler._executor)
+    self.assertIn('nllk0', history)
+    self.assertEqual(len(history['nllk0']), len(history['nllk0_epoch']))
+    self.assertEqual(history['nllk0_epoch'][-1], model.epochs)
+    self.assertIn(model.epochs, history['imp_med_epoch'])
+    # one prepared (subsampled) inputs for each corruption configuration
+    self.assertEqual(len(sc_metrics._PREPARED_INPUTS), 2)
+
+  def test_metric_group(self):
+    model, sco = _tiny_model(n_genes=12)
+    rec1 = _RecordMetric(inputs=sco, n_samples=64, name='rec1')
+    rec2 = _RecordMetric(inputs=sco, n_samples=64, name='rec2')
+    failed = _FailedMetric(inputs=sco, n_samples=64, name='failed')
+    nllk = NegativeLogLikelihood(inputs=sco, n_samples=64, sample_shape=2)
+    group = SingleCellMetricGroup([rec1, rec2, nllk, failed]).set_model(model)
+    # grouped by (id(y_crpt[0]), sample_shape, batch_size)
+    groups = group._groups(group.metrics)
+    self.assertEqual(len(groups), 2)
+    (y_true, y_crpt, sample_shape, batch_size), metrics = groups[0]
+    self.assertEqual(metrics, [rec1, rec2, failed])
+    self.assertEqual((sample_shape, batch_size), (1, 64))
+    self.assertIs(y_crpt[0], rec1.prepare_inputs()[1][0])
+    self.assertEqual(groups[1][1], [nllk])
+    self.assertEqual(groups[1][0][2], 2)
+    # one prediction pass for each group, dispatched to all its metrics
+    with self.assertWarns(UserWarning):
+      results = group.evaluate()
+    self.assertEqual(group.timing['predict'][0], 2)
+    for m in (rec1, rec2, nllk, failed):
+      self.assertEqual(group.timing[m.name][0], 1)
+    self.assertIs(rec1.received[0][0], y_true[0])
+    self.assertIs(rec1.received[1][0], y_crpt[0])
+    for i, j in zip(rec1.received[2:], rec2.received[2:]):
+      self.assertIs(i, j)
+    self.assertEqual(results['rec1'], 0.)
+    self.assertEqual(results['rec2'], 0.)
+    self.assertTrue(np.isfinite(results['nllk0']))
+    # the error is recorded, the other metrics are still evaluated
+    self.assertEqual(group.errors['failed'][0], 1)
+    self.assertIn('failed on purpose', group.errors['failed'][1])
+    self.assertIn('failed on purpose', group.report())
+    self.assertNotIn('rec1', group.errors)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,116 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+import numpy as np
+
+from sisua.data import SingleCellOMIC
+from sisua.data._single_cell_base import _is_memmap, _tensor_slices
+from sisua.data.utils import library_statistics
+
+np.random.seed(8)
+
+
+def _expected_stats(x):
+  total_counts = np.sum(np.asarray(x, dtype=np.float64), axis=1)
+  return np.hstack([total_counts[:, None]] +
+                   list(library_statistics(total_counts)))
+
+
+class SingleCellOMICTest(unittest.TestCase):
+
+  def test_var_indices_cache(self):
+    x = np.random.poisson(1, size=(50, 6)).astype(np.float32)
+    sco = SingleCellOMIC(x,
+                         gene_id=['ENSG1_CD4', 'CD8A', 'G2', 'G3', 'G4', 'G5'])
+    indices = sco.get_var_indices(suffix=True)
+    self.assertEqual(indices['CD4'], 0)
+    self.assertEqual(indices['CD8A'], 1)
+    # cached in `uns`
+    self.assertIs(indices, sco.get_var_indices(suffix=True))
+    self.assertIsNot(indices, sco.get_var_indices(suffix=False))
+    # subsetting the variables invalidates the cache
+    sco._inplace_subset_var(np.array([False, True, True, True, True, True]))
+    for suffix in (True, False):
+      indices = sco.get_var_indices(suffix=suffix)
+      self.assertNotIn('CD4', indices)
+      self.assertNotIn('ENSG1_CD4', indices)
+      self.assertEqual(indices['CD8A'], 0)
+      self.assertEqual(len(indices), sco.n_vars)
+
+  def test_view_statistics(self):
+    x = np.random.poisson(2, size=(100, 20)).astype(np.float32)
+    ids = np.arange(0, 100, 3)
+    expected = _expected_stats(x)[ids]
+    # the same population statistics regardless of the call order
+    for parent_first in (True, False):
+      sco = SingleCellOMIC(x.copy())
+      if parent_first:
+        sco.stats()
+      view = sco[ids]
+      self.assertTrue(view.is_view)
+      self.assertTrue(np.allclose(view.stats(), expected))
+      self.assertTrue(np.allclose(view.local_mean(), sco.local_mean()[ids]))
+      self.assertTrue(view.is_view)
+      # the statistics are computed on the parent
+      self.assertIn('transcriptomic_stats', sco.obsm)
+
+  def test_incremental_statistics(self):
+    x = np.random.poisson(2, size=(100, 20)).astype(np.float32)
+    sco = SingleCellOMIC(x)
+    sco.stats()
+    X = sco.numpy()
+    rows = [1, 5, 7]
+    X[rows] += 1.
+    sco._calculate_statistics(rows=rows)
+    self.assertTrue(np.allclose(sco.stats(), _expected_stats(X)))
+    # invalidate and lazily recompute
+    X[10] += 1.
+    sco._calculate_statistics(rows=None)
+    self.assertNotIn('transcriptomic_stats', sco.obsm)
+    self.assertTrue(np.allclose(sco.stats(), _expected_stats(X)))
+
+  def test_corrupt_statistics(self):
+    x = np.random.poisson(2, size=(100, 20)).astype(np.float32)
+    sco = SingleCellOMIC(x.copy())
+    original = np.array(sco.stats())
+    sco.corrupt(dropout_rate=0.3, inplace=True)
+    # only the corrupted rows are updated, the stats are not dropped
+    self.assertIn('transcriptomic_stats', sco.obsm)
+    self.assertTrue(np.allclose(sco.stats(), _expected_stats(sco.numpy())))
+    self.assertFalse(np.allclose(sco.stats()[:, 0], original[:, 0]))
+
+  def test_filter_cells_statistics(self):
+    x = np.random.poisson(2, size=(100, 20)).astype(np.float32)
+    sco = SingleCellOMIC(x)
+    total_counts = np.array(sco.stats()[:, 0])
+    threshold = np.median(total_counts)
+    sco.filter_cells(min_counts=threshold)
+    self.assertEqual(sco.n_obs, np.sum(total_counts >= threshold))
+    # the library mean and variance of the remained population
+    self.assertTrue(np.allclose(sco.stats(), _expected_stats(sco.numpy())))
+
+  def test_memmap_tensor_slices(self):
+    path = mkdtemp()
+    try:
+      x = np.random.poisson(2, size=(100, 9)).astype(np.uint16)
+      np.save(os.path.join(path, 'x.npy'), x)
+      x = np.load(os.path.join(path, 'x.npy'), mmap_mode='r')
+      self.assertTrue(_is_memmap(x))
+      # the last block is incomplete
+      for block_size in (1, 7, 256):
+        ds = _tensor_slices(x, block_size=block_size)
+        rows = list(ds.as_numpy_iterator())
+        self.assertEqual(len(rows), x.shape[0])
+        rows = np.stack(rows)
+        self.assertEqual(rows.dtype, np.float32)
+        self.assertTrue(np.all(rows == x))
+    finally:
+      shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,95 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import pickle
+import shutil
+import unittest
+from functools import partial
+from tempfile import mkdtemp
+
+import numpy as np
+
+from sisua.data import SingleCellOMIC
+from sisua.data.cache import (get_snapshot_path, read_snapshot,
+                              write_snapshot)
+
+np.random.seed(8)
+
+
+def _loader(override=False, verbose=False, filtered=True):
+  pass
+
+
+class SnapshotCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = mkdtemp()
+    self.raw = os.path.join(self.path, 'raw.csv')
+    with open(self.raw, 'w') as f:
+      f.write('raw data')
+    self.x = np.random.poisson(2, size=(50, 8)).astype(np.float32)
+    self.sco = SingleCellOMIC(self.x, name='snapshot')
+    self.snapshot = os.path.join(self.path, 'snapshot')
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_snapshot_path(self):
+    path = get_snapshot_path('cortex', _loader)
+    self.assertEqual(path, get_snapshot_path('cortex', _loader))
+    self.assertNotEqual(path, get_snapshot_path('retina', _loader))
+    self.assertNotEqual(path,
+                        get_snapshot_path('cortex',
+                                          partial(_loader, filtered=False)))
+
+  def test_hit_and_miss(self):
+    self.assertIsNone(read_snapshot(self.snapshot))
+    write_snapshot(self.snapshot, self.sco, raw_files=[self.raw])
+    self.assertFalse(
+        any('.tmp' in name for name in os.listdir(self.path)))
+    sco = read_snapshot(self.snapshot)
+    self.assertIsNotNone(sco)
+    self.assertEqual(sco.name, self.sco.name)
+    self.assertTrue(np.all(sco.X == self.x))
+    self.assertTrue(np.all(sco.obs_names == self.sco.obs_names))
+    self.assertTrue(np.all(sco.var_names == self.sco.var_names))
+    # the raw data could be removed, the snapshot is self-contained
+    os.remove(self.raw)
+    self.assertIsNotNone(read_snapshot(self.snapshot))
+
+  def test_invalidation(self):
+    write_snapshot(self.snapshot, self.sco, raw_files=[self.raw])
+    # touched but the same content, the new stat is recorded
+    st = os.stat(self.raw)
+    os.utime(self.raw, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    self.assertIsNotNone(read_snapshot(self.snapshot))
+    with open(os.path.join(self.snapshot, 'fingerprint'), 'rb') as f:
+      (stat, _), = pickle.load(f).values()
+    self.assertEqual(stat[1], st.st_mtime_ns + 10**9)
+    # changed content
+    with open(self.raw, 'w') as f:
+      f.write('new raw data')
+    self.assertIsNone(read_snapshot(self.snapshot))
+    self.assertFalse(os.path.exists(self.snapshot))
+
+  def test_replace_invalid_snapshot(self):
+    # e.g. the removal of an old snapshot was interrupted
+    os.makedirs(os.path.join(self.snapshot, 'store'))
+    self.assertIsNone(read_snapshot(self.snapshot))
+    write_snapshot(self.snapshot, self.sco, raw_files=[self.raw])
+    self.assertTrue(np.all(read_snapshot(self.snapshot).X == self.x))
+
+  def test_read_only_warm_load(self):
+    write_snapshot(self.snapshot, self.sco, raw_files=[self.raw])
+    sco = read_snapshot(self.snapshot)
+    self.assertIsInstance(sco.numpy(), np.memmap)
+    self.assertFalse(sco.numpy().flags.writeable)
+    # inplace transformation loads the OMIC into memory, the snapshot is
+    # unchanged
+    sco.corrupt(dropout_rate=0.5, inplace=True)
+    self.assertFalse(np.all(sco.numpy() == self.x))
+    self.assertTrue(np.all(read_snapshot(self.snapshot).X == self.x))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,105 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+import numpy as np
+from scipy import sparse
+
+from sisua.data.sparse_mmap import (SparseMmapWriter, is_sparse_mmap,
+                                    read_sparse_mmap, write_sparse_mmap)
+
+np.random.seed(8)
+
+
+class SparseMmapTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_write_read(self):
+    X = sparse.random(1000, 300, density=0.05, format='csr', random_state=1)
+    X = (X * 100).astype(np.uint16)
+    X.eliminate_zeros()
+    outpath = write_sparse_mmap(os.path.join(self.path, 'X'),
+                                X,
+                                batch_size=77)
+    self.assertTrue(is_sparse_mmap(outpath))
+    Y = read_sparse_mmap(outpath)
+    self.assertTrue(isinstance(Y.data, np.memmap))
+    self.assertEqual(Y.shape, X.shape)
+    self.assertEqual(Y.dtype, np.uint16)
+    self.assertEqual(abs(Y - X).sum(), 0)
+    # casting only the data
+    Y = read_sparse_mmap(outpath, dtype=np.float32)
+    self.assertEqual(Y.dtype, np.float32)
+    self.assertTrue(np.all(Y[10:20].toarray() == X[10:20].toarray()))
+
+  def test_append_dense_and_empty(self):
+    path = os.path.join(self.path, 'X')
+    x = np.random.randint(0, 3, size=(50, 8))
+    with SparseMmapWriter(path, n_features=8, dtype='float32') as f:
+      f.write(x[:20])
+      f.write(sparse.csr_matrix(x[20:]))
+      self.assertEqual(f.shape, (50, 8))
+    self.assertTrue(np.all(read_sparse_mmap(path).toarray() == x))
+    with SparseMmapWriter(path, n_features=8, remove_exist=True) as f:
+      pass
+    self.assertEqual(read_sparse_mmap(path).shape, (0, 8))
+
+  def test_streaming_highly_variable_genes(self):
+    import scanpy as sc
+    from sisua.data.data_loader.childhood_leukemia_cALL import \
+      _normalized_moments
+    from sisua.data.utils import dispersion_gene_subset
+    X = sparse.random(600, 400, density=0.1, format='csr', random_state=1)
+    X.data = np.random.negative_binomial(2, 0.3, size=X.nnz) + 1.
+    X = X.astype(np.uint16)
+    cells = np.sort(np.random.choice(600, 500, replace=False))
+    genes = np.where(np.asarray((X[cells] > 0).sum(axis=0)).ravel() >= 3)[0]
+    path = write_sparse_mmap(os.path.join(self.path, 'X'), X)
+    mean, var = _normalized_moments(read_sparse_mmap(path),
+                                    cells=cells,
+                                    genes=genes,
+                                    target_sum=100,
+                                    batch_size=64)
+    # the in-memory scanpy pipeline
+    adata = sc.AnnData(X[cells][:, genes].astype(np.float32))
+    sc.pp.normalize_total(adata, target_sum=100)
+    x = adata.X.toarray().astype(np.float64)
+    self.assertTrue(np.allclose(mean, np.mean(x, axis=0), rtol=1e-5))
+    self.assertTrue(np.allclose(var, np.var(x, axis=0, ddof=1), rtol=1e-4))
+    for kw in [
+        dict(n_top_genes=50),
+        dict(min_mean=0.0125, max_mean=3, min_disp=0.5),
+    ]:
+      expected = sc.pp.filter_genes_dispersion(adata.X,
+                                               flavor='seurat',
+                                               log=False,
+                                               **kw)
+      subset = dispersion_gene_subset(mean, var, **kw)
+      self.assertTrue(np.sum(subset) > 0)
+      # only the genes tied at the cut-off could differ (float precision)
+      mismatch = subset != expected['gene_subset']
+      if 'n_top_genes' in kw:
+        disp = np.nan_to_num(expected['dispersions_norm'])
+        cut_off = np.sort(disp)[::-1][kw['n_top_genes'] - 1]
+        self.assertTrue(np.allclose(disp[mismatch], cut_off, rtol=1e-5))
+      else:
+        self.assertFalse(np.any(mismatch))
+
+  def test_unique_genes(self):
+    from sisua.data.data_loader.childhood_leukemia_cALL import _unique_genes
+    colname = np.array(['CD3D', 'MT-CO1', 'TAL1', 'CD3D', 'CD19', 'TAL1'])
+    ids = _unique_genes(colname)
+    self.assertTrue(np.array_equal(ids, [1, 4]))
+    self.assertEqual(len(np.unique(colname[ids])), len(ids))
+
+
+if __name__ == '__main__':
+  unittest.main()
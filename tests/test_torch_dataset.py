@@ -0,0 +1,122 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import pickle
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+import numpy as np
+from scipy import sparse
+
+from sisua.data.sparse_mmap import read_sparse_mmap, write_sparse_mmap
+
+try:
+  import torch
+  from sisua.data.torch_dataset import (SingleCellTorchDataset,
+                                        create_dataloader)
+except ImportError:
+  torch = None
+
+np.random.seed(8)
+
+
+@unittest.skipIf(torch is None, "pip install torch")
+class TorchDatasetTest(unittest.TestCase):
+
+  def setUp(self):
+    self.path = mkdtemp()
+    n_obs = 203
+    x = sparse.random(n_obs, 30, density=0.2, format='csr', random_state=1)
+    x = (x * 100).astype(np.float32).toarray()
+    # the first feature identifies the cell, whatever the batch order
+    x[:, 0] = np.arange(n_obs) + 1
+    self.x = x
+    self.library = np.stack([np.arange(n_obs), np.sum(x, axis=1)],
+                            axis=1).astype(np.float32)
+    memmap = np.lib.format.open_memmap(os.path.join(self.path, 'x.npy'),
+                                       mode='w+',
+                                       dtype=np.float32,
+                                       shape=x.shape)
+    memmap[:] = x
+    memmap.flush()
+    self.omics = dict(
+        dense=x,
+        csr=sparse.csr_matrix(x),
+        memmap=np.load(os.path.join(self.path, 'x.npy'), mmap_mode='r'),
+        sparse_mmap=read_sparse_mmap(
+            write_sparse_mmap(os.path.join(self.path, 'X'), x)),
+    )
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def _check_batch(self, x, library, n_rows=None):
+    x = x.numpy()
+    library = library.numpy()
+    ids = x[:, 0].astype(np.int64) - 1
+    if n_rows is not None:
+      self.assertEqual(len(ids), n_rows)
+    self.assertTrue(np.all(x == self.x[ids]))
+    self.assertTrue(np.all(library == self.library[ids]))
+    return ids
+
+  def test_dataloader(self):
+    for name, omic in self.omics.items():
+      for num_workers in (0, 2):
+        for shuffle in (False, True):
+          msg = f"{name} num_workers={num_workers} shuffle={shuffle}"
+          loader = create_dataloader([omic], [self.library],
+                                     batch_size=32,
+                                     shuffle=shuffle,
+                                     num_workers=num_workers)
+          ids = []
+          for data in loader:
+            self.assertEqual(data['inputs'].dtype, torch.float32, msg)
+            self.assertEqual(data['mask'].shape, (data['inputs'].shape[0],))
+            ids.append(self._check_batch(data['inputs'], data['library']))
+          ids = np.concatenate(ids)
+          # every cell exactly once, in order if not shuffled
+          self.assertTrue(
+              np.array_equal(np.sort(ids), np.arange(self.x.shape[0])), msg)
+          if not shuffle:
+            self.assertTrue(
+                np.array_equal(ids, np.arange(self.x.shape[0])), msg)
+
+  def test_multiple_omics(self):
+    omics = list(self.omics.values())
+    for num_workers in (0, 2):
+      loader = create_dataloader(omics, [self.library] * len(omics),
+                                 labels_percent=0.5,
+                                 batch_size=64,
+                                 drop_remainder=True,
+                                 num_workers=num_workers)
+      n_batches = 0
+      for data in loader:
+        ids = [
+            self._check_batch(x, l, n_rows=64)
+            for x, l in zip(data['inputs'], data['library'])
+        ]
+        for i in ids[1:]:
+          self.assertTrue(np.array_equal(ids[0], i))
+        self.assertEqual(data['mask'].dtype, torch.bool)
+        n_batches += 1
+      self.assertEqual(n_batches, self.x.shape[0] // 64)
+
+  def test_pickle(self):
+    # the workers re-open the memory-mapped buffers instead of copying them
+    dataset = SingleCellTorchDataset(list(self.omics.values()),
+                                     [self.library] * len(self.omics))
+    restored = pickle.loads(pickle.dumps(dataset))
+    memmap, sparse_mmap = restored.inputs[2], restored.inputs[3]
+    self.assertIsInstance(memmap, np.memmap)
+    self.assertIsInstance(sparse_mmap.indices, np.memmap)
+    index = np.random.permutation(self.x.shape[0])[:50]
+    data = restored[index]
+    for x, l in zip(data['inputs'], data['library']):
+      self.assertTrue(
+          np.array_equal(self._check_batch(x, l, n_rows=50), np.sort(index)))
+
+
+if __name__ == '__main__':
+  unittest.main()